@@ -0,0 +1,72 @@
+"""
+Micro-benchmark: búsqueda de texto completo sobre el espejo local de correos.
+
+Requiere un PostgreSQL local con las tablas creadas (variables DB_* del .env).
+Inserta N correos sintéticos con ids 'bench-search-*', mide la latencia de varias
+consultas (índice GIN de `search_vector` + ts_headline de la primera página) y los borra.
+
+    python benchmarks/bench_email_search.py [50000]
+"""
+import os
+import sys
+import time
+import random
+from datetime import datetime, timedelta
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.infrastructure.database.postgres import init_db, upsert_emails, search_emails_db, db_connection
+
+WORDS = (
+    "factura pago pedido envío reunión contrato presupuesto incidencia soporte cliente "
+    "proveedor entrega retraso descuento garantía devolución invoice meeting delivery "
+    "contract refund support order quote"
+).split()
+QUERIES = ["factura pendiente", "retraso entrega", "refund order", "contrato -garantía", '"reunión de seguimiento"']
+
+def make_rows(n):
+    rng = random.Random(42)
+    base = datetime.now()
+    return [{
+        "id": f"bench-search-{i}",
+        "subject": " ".join(rng.choices(WORDS, k=5)),
+        "sender": f"user{i % 500}@empresa.com",
+        "body": " ".join(rng.choices(WORDS, k=150)),
+        "date": (base - timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S"),
+        "is_read": False
+    } for i in range(n)]
+
+def cleanup():
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM emails WHERE id LIKE %s", ('bench-search-%',))
+        conn.commit()
+        cur.close()
+
+def main(n):
+    if not init_db():
+        print("No se pudo conectar a PostgreSQL (revisa las variables DB_*).")
+        sys.exit(1)
+
+    cleanup()
+    upsert_emails(make_rows(n))
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("ANALYZE emails")
+        conn.commit()
+        cur.close()
+
+    print(f"{n} correos indexados")
+    print(f"{'consulta':<28} | {'resultados':>10} | {'ms (mediana de 5)':>17}")
+    for q in QUERIES:
+        timings = []
+        for _ in range(5):
+            start = time.perf_counter()
+            results = search_emails_db(q, limit=20)
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"{q:<28} | {len(results):>10} | {sorted(timings)[2]:>17.1f}")
+    cleanup()
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,78 @@
+"""
+Benchmark de indexación: fragmentos/segundo al generar embeddings de un PDF sintético.
+
+Compara `encode` fragmento a fragmento (comportamiento anterior) con el pipeline por lotes.
+Con --db además indexa el documento en PostgreSQL (variables DB_* del .env) y lo borra al terminar.
+
+    python benchmarks/bench_embedding.py [--pages 200] [--batch-size 32] [--db]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import fitz  # PyMuPDF
+
+PARAGRAPH = (
+    "El equipo de soporte técnico revisa las incidencias recibidas por correo y las clasifica "
+    "según el producto, la urgencia y el cliente. Cada manual incluye procedimientos de instalación, "
+    "mantenimiento preventivo y resolución de averías frecuentes. "
+)
+
+def make_pdf(path, pages):
+    doc = fitz.open()
+    for n in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(page.rect + (40, 40, -40, -40), f"Página {n + 1}\n" + PARAGRAPH * 12, fontsize=9)
+    doc.save(path)
+    doc.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--db", action="store_true", help="indexar también en PostgreSQL")
+    args = parser.parse_args()
+
+    from src.domain.knowledge import embedder
+    from src.domain.knowledge.chunker import chunk_text
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "manual_sintetico.pdf")
+        make_pdf(pdf_path, args.pages)
+        chunks = chunk_text("".join(embedder.iter_pdf_pages(pdf_path)))
+        print(f"{args.pages} páginas -> {len(chunks)} fragmentos")
+
+        model = embedder.embedding_model.get()
+        start = time.perf_counter()
+        for chunk in chunks:
+            model.encode(chunk)
+        per_chunk = time.perf_counter() - start
+        print(f"encode por fragmento : {len(chunks) / per_chunk:8.1f} fragmentos/s")
+
+        start = time.perf_counter()
+        for _ in embedder.embed_chunks(chunks, args.batch_size):
+            pass
+        batched = time.perf_counter() - start
+        print(f"encode por lotes ({args.batch_size:>3}): {len(chunks) / batched:8.1f} fragmentos/s")
+
+        if args.db:
+            from src.infrastructure.database.postgres import init_db, db_connection
+            init_db()
+            filename = "bench_manual_sintetico.pdf"
+            start = time.perf_counter()
+            ok, message, _ = embedder.process_and_index_file(pdf_path, filename, batch_size=args.batch_size)
+            total = time.perf_counter() - start
+            print(f"indexación completa  : {len(chunks) / total:8.1f} fragmentos/s ({message})")
+            with db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute("DELETE FROM knowledge_files WHERE filename = %s", (filename,))
+                conn.commit()
+                cur.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark de extracción en streaming: PDF sintético de 1.000 páginas.
+
+Compara la extracción secuencial concatenando el texto (comportamiento anterior) con
+`iter_pdf_pages` en un pool de procesos alimentando `iter_chunks`, y mide el pico de
+memoria de cada variante (del proceso principal). La ganancia del pool depende del nº de CPUs. No necesita el modelo de embeddings ni PostgreSQL.
+
+    python benchmarks/bench_ingestion.py [--pages 1000] [--workers 4]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import fitz  # PyMuPDF
+
+from bench_embedding import make_pdf
+
+def legacy_extract(pdf_path):
+    text = ""
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            text += page.get_text()
+    return text
+
+def measure(label, fn):
+    start = time.perf_counter()
+    chunks = fn()
+    elapsed = time.perf_counter() - start
+    # Segunda pasada solo para la memoria: tracemalloc ralentiza el proceso principal
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{label:<28}: {elapsed:6.2f}s  {chunks:6d} fragmentos  pico {peak / (1 << 20):7.1f} MB")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1))
+    args = parser.parse_args()
+
+    from src.domain.knowledge import embedder
+    from src.domain.knowledge.chunker import chunk_text, iter_chunks, get_chunker
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, "manual_sintetico.pdf")
+        make_pdf(pdf_path, args.pages)
+        print(f"{args.pages} páginas, {os.path.getsize(pdf_path) / (1 << 20):.1f} MB")
+
+        measure("secuencial + texto completo", lambda: len(chunk_text(legacy_extract(pdf_path))))
+        measure("streaming, 1 proceso", lambda: sum(
+            1 for _ in iter_chunks(embedder.iter_pdf_pages(pdf_path, workers=1))))
+        measure(f"streaming, {args.workers} procesos", lambda: sum(
+            1 for _ in iter_chunks(embedder.iter_pdf_pages(pdf_path, workers=args.workers))))
+        chunker = get_chunker("structure")
+        measure("fragmentador por tokens", lambda: sum(
+            1 for _ in chunker.chunk(embedder.iter_file_blocks(pdf_path, "manual_sintetico.pdf"))))
+
+if __name__ == "__main__":
+    main()
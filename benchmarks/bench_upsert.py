@@ -0,0 +1,58 @@
+"""
+Micro-benchmark: upsert fila a fila vs. upsert masivo de correos.
+
+Requiere un PostgreSQL local con las tablas creadas (variables DB_* del .env).
+Los correos de prueba usan ids con prefijo 'bench-' y se borran al terminar cada ronda.
+
+    python benchmarks/bench_upsert.py [100 1000 10000]
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.infrastructure.database.postgres import init_db, upsert_email, upsert_emails, db_connection
+
+def make_rows(n):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return [{
+        "id": f"bench-{i}",
+        "subject": f"Asunto {i}",
+        "sender": "bench@empresa.com",
+        "body": "",
+        "date": now,
+        "is_read": False
+    } for i in range(n)]
+
+def cleanup():
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM emails WHERE id LIKE %s", ('bench-%',))
+        conn.commit()
+        cur.close()
+
+def timed(fn, rows):
+    cleanup()
+    start = time.perf_counter()
+    fn(rows)
+    elapsed = time.perf_counter() - start
+    cleanup()
+    return elapsed
+
+def main(sizes):
+    if not init_db():
+        print("No se pudo conectar a PostgreSQL (revisa las variables DB_*).")
+        sys.exit(1)
+
+    print(f"{'filas':>8} | {'fila a fila (s)':>16} | {'masivo (s)':>11} | {'mejora':>7}")
+    for n in sizes:
+        rows = make_rows(n)
+        per_row = timed(lambda rs: [upsert_email(r) for r in rs], rows)
+        bulk = timed(upsert_emails, rows)
+        print(f"{n:>8} | {per_row:>16.3f} | {bulk:>11.3f} | {per_row / bulk:>6.1f}x")
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [100, 1000, 10000])
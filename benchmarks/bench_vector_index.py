@@ -0,0 +1,97 @@
+"""
+Benchmark recall vs. latencia de los índices ANN de pgvector (HNSW e IVFFlat).
+
+Crea una tabla temporal `bench_vectors` con vectores sintéticos normalizados de 384 dimensiones,
+calcula el top-k exacto con numpy y mide recall@k y latencia media para varios valores de
+`hnsw.ef_search` / `ivfflat.probes`. Requiere PostgreSQL con pgvector (variables DB_* del .env).
+
+    python benchmarks/bench_vector_index.py [--rows 50000] [--queries 100] [--k 10]
+"""
+import os
+import sys
+import time
+import argparse
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+from psycopg2.extras import execute_values
+
+from src.infrastructure.database.postgres import db_connection, to_pgvector, vector_index_params, create_vector_index
+
+DIM = 384
+TABLE = "bench_vectors"
+
+def random_unit_vectors(n, rng):
+    v = rng.standard_normal((n, DIM)).astype(np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+def load_table(cur, vectors):
+    cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    cur.execute(f"CREATE TABLE {TABLE} (id INTEGER PRIMARY KEY, embedding vector({DIM}))")
+    execute_values(
+        cur, f"INSERT INTO {TABLE} (id, embedding) VALUES %s",
+        [(i, to_pgvector(v)) for i, v in enumerate(vectors)],
+        template="(%s, %s::vector)", page_size=1000
+    )
+    cur.execute(f"ANALYZE {TABLE}")
+
+def run_queries(cur, queries, truth, k, setting, value):
+    cur.execute("SELECT set_config(%s, %s, false)", (setting, str(value)))
+    hits, elapsed = 0, 0.0
+    for q, expected in zip(queries, truth):
+        literal = to_pgvector(q)
+        start = time.perf_counter()
+        cur.execute(
+            f"SELECT id FROM {TABLE} ORDER BY embedding <=> %s::vector LIMIT %s", (literal, k)
+        )
+        found = {row[0] for row in cur.fetchall()}
+        elapsed += time.perf_counter() - start
+        hits += len(found & set(expected))
+    return hits / (k * len(queries)), 1000 * elapsed / len(queries)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    data = random_unit_vectors(args.rows, rng)
+    queries = random_unit_vectors(args.queries, rng)
+    # Top-k exacto por similitud coseno (vectores normalizados -> producto escalar)
+    truth = np.argsort(-queries @ data.T, axis=1)[:, :args.k]
+
+    with db_connection() as conn:
+        if not conn:
+            print("No se pudo conectar a PostgreSQL (revisa las variables DB_*).")
+            sys.exit(1)
+        cur = conn.cursor()
+        load_table(cur, data)
+        conn.commit()
+
+        sweeps = {
+            "hnsw": ("hnsw.ef_search", [10, 40, 100, 200]),
+            "ivfflat": ("ivfflat.probes", [1, 5, 10, 20, 50]),
+        }
+        print(f"{args.rows} vectores, {args.queries} consultas, recall@{args.k}")
+        for method, (setting, values) in sweeps.items():
+            params = vector_index_params(args.rows, method)
+            cur.execute(f"DROP INDEX IF EXISTS {TABLE}_idx")
+            start = time.perf_counter()
+            create_vector_index(cur, method, params, table=TABLE, name=f"{TABLE}_idx")
+            conn.commit()
+            print(f"\n{method} {params} construido en {time.perf_counter() - start:.1f}s")
+            print(f"{setting:>16} | {'recall':>6} | {'latencia (ms)':>13}")
+            for value in values:
+                recall, latency = run_queries(cur, queries, truth, args.k, setting, value)
+                print(f"{value:>16} | {recall:>6.3f} | {latency:>13.2f}")
+
+        cur.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        conn.commit()
+        cur.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,44 @@
 import os
-from fastapi import FastAPI, HTTPException
+import json
+import asyncio
+import threading
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from llama_cpp import Llama
 
+from scheduler import InferenceScheduler, QueueFullError, JobCancelledError, wait_for_job, stream_job
+from prompt_cache import PromptStateCache
+
 app = FastAPI(title="Email AI - LLM GGUF Service")
 
 # Path al nuevo modelo Llama-3.2-3B
 MODEL_PATH = "/app/models/llama-3.2-3b-instruct-q4_k_m.gguf"
 
 llm = None
+# llama.cpp no es reentrante: nunca dos generaciones a la vez sobre la misma instancia
+llm_lock = threading.Lock()
+
+# Cola de inferencia: tamaño máximo, hilos de generación y timeout por petición (segundos)
+MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", 8))
+WORKERS = int(os.getenv("LLM_WORKERS", 1))
+REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 300))
+# Memoria máxima para estados de prompt ya evaluados (0 desactiva la caché)
+PROMPT_CACHE_MB = int(os.getenv("LLM_PROMPT_CACHE_MB", 1024))
+
+prompt_cache = PromptStateCache(capacity_bytes=PROMPT_CACHE_MB << 20)
+
+SYSTEM_CONTENT = (
+    "Eres un asistente de redacción de correos profesional. "
+    "Responde directamente al mensaje de forma breve, amable y sin inventar datos ni enlaces."
+)
+
+# Template oficial de Llama 3.2 Instruct: parte fija hasta el mensaje del usuario
+PROMPT_HEADER = (
+    f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n"
+    f"{SYSTEM_CONTENT}<|eot_id|>"
+    f"<|start_header_id|>user<|end_header_id|>\n\n"
+)
 
 class GenerateRequest(BaseModel):
     prompt: str
@@ -28,46 +58,104 @@ async def load_model():
             n_threads=int(os.getenv("CPU_THREADS", 2)), 
             verbose=False
         )
+        if PROMPT_CACHE_MB > 0:
+            # Reutiliza el KV de la cabecera de sistema + contexto entre peticiones. Todas las
+            # peticiones comparten la cabecera fija: coincidir solo en ella no es un acierto
+            prompt_cache.min_prefix_tokens = len(llm.tokenize(PROMPT_HEADER.encode("utf-8"), special=True)) + 1
+            llm.set_cache(prompt_cache)
         print("Model successfully loaded!")
     except Exception as e:
         print(f"FAILED to load model: {str(e)}")
+    scheduler.start()
 
-@app.post("/generate")
-async def generate_text(req: GenerateRequest):
-    if llm is None:
-        raise HTTPException(status_code=503, detail="Model is not loaded")
-        
-    try:
-        # Template oficial de Llama 3.2 Instruct
-        system_content = (
-            "Eres un asistente de redacción de correos profesional. "
-            "Responde directamente al mensaje de forma breve, amable y sin inventar datos ni enlaces."
-        )
-        
-        full_prompt = (
-            f"<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n\n"
-            f"{system_content}<|eot_id|>"
-            f"<|start_header_id|>user<|end_header_id|>\n\n"
-            f"{req.prompt}<|eot_id|>"
-            f"<|start_header_id|>assistant<|end_header_id|>\n\n"
-        )
-        
-        output = llm(
-            full_prompt,
-            max_tokens=min(req.max_tokens, 256),
+@app.on_event("shutdown")
+async def stop_scheduler():
+    scheduler.stop()
+
+def build_prompt(user_prompt):
+    return (
+        f"{PROMPT_HEADER}"
+        f"{user_prompt}<|eot_id|>"
+        f"<|start_header_id|>assistant<|end_header_id|>\n\n"
+    )
+
+def run_generation(job):
+    """
+    Ejecuta la generación en el hilo del scheduler. Se consume en modo stream para poder
+    cortar en el siguiente token si el cliente se ha desconectado o ha expirado.
+    """
+    pieces = []
+    n_tokens = 0
+    with llm_lock:
+        for chunk in llm(
+            job.prompt,
+            max_tokens=min(job.params["max_tokens"], 256),
             temperature=0.1,
             top_p=0.9,
             repeat_penalty=1.1,
             stop=["<|eot_id|>", "<|end_of_text|>", "---"],
-            echo=False
+            echo=False,
+            stream=True
+        ):
+            if job.cancelled:
+                break
+            text = chunk["choices"][0]["text"]
+            pieces.append(text)
+            n_tokens += 1
+            job.emit(text)
+    return "".join(pieces).strip(), n_tokens
+
+scheduler = InferenceScheduler(run_generation, max_queue=MAX_QUEUE, workers=WORKERS)
+
+def submit_job(req, on_token=None):
+    if llm is None:
+        raise HTTPException(status_code=503, detail="Model is not loaded")
+    try:
+        return scheduler.submit(build_prompt(req.prompt), {"max_tokens": req.max_tokens}, on_token=on_token)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=429,
+            detail="Inference queue is full",
+            headers={"Retry-After": str(e.retry_after)}
         )
-        
-        response_text = output["choices"][0]["text"].strip()
+
+@app.post("/generate")
+async def generate_text(req: GenerateRequest, request: Request):
+    job = submit_job(req)
+
+    try:
+        response_text = await wait_for_job(job, request, REQUEST_TIMEOUT)
         return {"response": response_text}
-        
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"Generation timed out after {REQUEST_TIMEOUT}s")
+    except JobCancelledError:
+        # El cliente ya no está escuchando; el código solo queda en los logs
+        raise HTTPException(status_code=499, detail="Client disconnected")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Inference error: {str(e)}")
 
+@app.post("/generate/stream")
+async def generate_stream(req: GenerateRequest, request: Request):
+    """Igual que /generate pero emite cada token como Server-Sent Event en cuanto se genera."""
+    tokens = asyncio.Queue()
+    job = submit_job(req, on_token=tokens.put_nowait)
+
+    async def events():
+        async for kind, value in stream_job(job, tokens, request, REQUEST_TIMEOUT):
+            if kind == "token":
+                payload = {"token": value}
+            elif kind == "done":
+                payload = {"done": True, "response": value.strip()}
+            else:
+                payload = {"error": value}
+            yield f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get("/metrics")
+async def metrics():
+    return {**scheduler.metrics(), "prompt_cache": prompt_cache.stats()}
+
 @app.get("/health")
 async def health_check():
     return {
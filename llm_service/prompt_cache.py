@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+
+
+def longest_token_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class PromptStateCache:
+    """
+    Caché de estados de llama.cpp (KV cache tras evaluar un prompt) con desalojo LRU
+    acotado en bytes. Sigue la interfaz de `llama_cpp.LlamaRAMCache` para usarse con
+    `Llama.set_cache`, y además cuenta aciertos y tokens reutilizados.
+
+    Las claves son secuencias de tokens (prompt + respuesta). La búsqueda devuelve el estado
+    con el prefijo común más largo, así que en la práctica la entrada queda indexada por la
+    cabecera de sistema + contexto RAG + correo: si solo cambia la instrucción final, llama.cpp
+    restaura ese estado y solo evalúa los tokens nuevos.
+
+    No define `__len__` a propósito: `Llama` comprueba `if self.cache:` y una caché vacía
+    sería falsa y nunca llegaría a llenarse.
+    """
+
+    def __init__(self, capacity_bytes=1 << 30, min_prefix_tokens=1):
+        self.capacity_bytes = capacity_bytes
+        # Un prefijo más corto que esto no compensa restaurar un estado; el servicio lo sube
+        # por encima de la cabecera de sistema fija, que comparten todas las peticiones
+        self.min_prefix_tokens = min_prefix_tokens
+        self.cache_state = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+
+    @staticmethod
+    def _state_size(state):
+        return getattr(state, "llama_state_size", 0) or 0
+
+    @property
+    def cache_size(self):
+        return sum(self._state_size(state) for state in self.cache_state.values())
+
+    def _find_longest_prefix_key(self, key):
+        best_key, best_len = None, self.min_prefix_tokens - 1
+        for k in self.cache_state.keys():
+            prefix_len = longest_token_prefix(k, key)
+            if prefix_len > best_len:
+                best_key, best_len = k, prefix_len
+        return best_key, max(best_len, 0)
+
+    def __getitem__(self, key):
+        key = tuple(key)
+        with self._lock:
+            found, prefix_len = self._find_longest_prefix_key(key)
+            if found is None:
+                self.misses += 1
+                raise KeyError("Key not found")
+            self.hits += 1
+            self.reused_tokens += prefix_len
+            self.cache_state.move_to_end(found)
+            return self.cache_state[found]
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._find_longest_prefix_key(tuple(key))[0] is not None
+
+    def __setitem__(self, key, value):
+        key = tuple(key)
+        with self._lock:
+            self.cache_state.pop(key, None)
+            self.cache_state[key] = value
+            while len(self.cache_state) > 1 and self.cache_size > self.capacity_bytes:
+                self.cache_state.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.cache_state.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.cache_state),
+                "size_mb": round(self.cache_size / (1 << 20), 1),
+                "capacity_mb": round(self.capacity_bytes / (1 << 20), 1),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "avg_reused_tokens": round(self.reused_tokens / self.hits, 1) if self.hits else 0.0,
+                "evictions": self.evictions,
+            }
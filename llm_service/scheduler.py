@@ -0,0 +1,239 @@
+import math
+import time
+import queue
+import asyncio
+import threading
+from collections import deque
+
+
+class QueueFullError(Exception):
+    """La cola de inferencia está llena; `retry_after` estima en segundos cuándo reintentar."""
+
+    def __init__(self, retry_after):
+        super().__init__("Inference queue is full")
+        self.retry_after = retry_after
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+class Job:
+    """Petición de generación encolada. El resultado se entrega en `future` (del event loop)."""
+
+    def __init__(self, prompt, params, loop, on_token=None):
+        self.prompt = prompt
+        self.params = params
+        self.loop = loop
+        self.on_token = on_token
+        self.future = loop.create_future()
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """Marca el trabajo como cancelado; el worker lo descarta o corta la generación en el siguiente token."""
+        self._cancelled.set()
+        if not self.future.done():
+            self.loop.call_soon_threadsafe(self._cancel_future)
+
+    def _cancel_future(self):
+        if not self.future.done():
+            self.future.cancel()
+
+    def emit(self, text):
+        """Entrega un token al consumidor en streaming (desde el hilo del worker)."""
+        if self.on_token is not None:
+            self.loop.call_soon_threadsafe(self.on_token, text)
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _resolve(self, result=None, error=None):
+        def apply():
+            if self.future.done():
+                return
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(result)
+        self.loop.call_soon_threadsafe(apply)
+
+
+class InferenceScheduler:
+    """
+    Cola acotada de peticiones + hilo(s) dedicado(s) de inferencia.
+
+    llama.cpp no es reentrante y bloquea la CPU durante toda la generación: ejecutarlo en
+    el event loop congela el servicio (incluido /health). Aquí las peticiones esperan en una
+    cola de tamaño `max_queue` (si se llena se rechazan con un Retry-After estimado) y los
+    workers las procesan de una en una con `generate_fn(job)`, que devuelve (texto, nº tokens)
+    y debe consultar `job.cancelled` para abortar generaciones de clientes que se han ido.
+    """
+
+    def __init__(self, generate_fn, max_queue=8, workers=1):
+        self.generate_fn = generate_fn
+        self.max_queue = max_queue
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._queue_times = deque(maxlen=100)
+        self._service_times = deque(maxlen=100)
+        self._token_rates = deque(maxlen=100)
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.cancelled = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"inference-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def _avg(self, values, default):
+        return sum(values) / len(values) if values else default
+
+    def retry_after(self):
+        """Segundos estimados hasta que haya hueco: trabajos por delante x tiempo medio de servicio."""
+        ahead = self._queue.qsize() + self.in_flight
+        return max(1, math.ceil(ahead * self._avg(self._service_times, 10.0) / self.workers))
+
+    def submit(self, prompt, params, loop=None, on_token=None):
+        job = Job(prompt, params, loop or asyncio.get_running_loop(), on_token=on_token)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFullError(self.retry_after())
+        return job
+
+    def _worker(self):
+        while not self._stop.is_set():
+            job = self._queue.get()
+            if job is None:
+                break
+            if job.cancelled:
+                with self._lock:
+                    self.cancelled += 1
+                continue
+
+            job.started_at = time.monotonic()
+            with self._lock:
+                self.in_flight += 1
+                self._queue_times.append(job.started_at - job.enqueued_at)
+            try:
+                text, n_tokens = self.generate_fn(job)
+                elapsed = time.monotonic() - job.started_at
+                with self._lock:
+                    self._service_times.append(elapsed)
+                    if n_tokens and elapsed > 0:
+                        self._token_rates.append(n_tokens / elapsed)
+                    if job.cancelled:
+                        self.cancelled += 1
+                    else:
+                        self.completed += 1
+                if job.cancelled:
+                    job._resolve(error=JobCancelledError())
+                else:
+                    job._resolve(result=text)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                job._resolve(error=e)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "queue_length": self._queue.qsize(),
+                "queue_capacity": self.max_queue,
+                "workers": self.workers,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "cancelled": self.cancelled,
+                "avg_time_in_queue_s": round(self._avg(self._queue_times, 0.0), 3),
+                "max_time_in_queue_s": round(max(self._queue_times, default=0.0), 3),
+                "avg_generation_s": round(self._avg(self._service_times, 0.0), 3),
+                "tokens_per_second": round(self._avg(self._token_rates, 0.0), 2),
+            }
+
+
+async def wait_for_job(job, request, timeout, poll_interval=0.5):
+    """
+    Espera el resultado de `job` vigilando si el cliente HTTP se desconecta.
+    Cancela el trabajo (y lanza JobCancelledError o asyncio.TimeoutError) si el cliente
+    se va o si se supera `timeout` segundos.
+    """
+    deadline = job.loop.time() + timeout
+    while True:
+        done, _ = await asyncio.wait({job.future}, timeout=poll_interval)
+        if done:
+            if job.future.cancelled():
+                raise JobCancelledError()
+            return job.future.result()
+        if await request.is_disconnected():
+            job.cancel()
+            raise JobCancelledError()
+        if job.loop.time() >= deadline:
+            job.cancel()
+            raise asyncio.TimeoutError()
+
+
+async def stream_job(job, tokens, request, timeout, poll_interval=0.5):
+    """
+    Produce los eventos de un trabajo en streaming: ("token", texto) por cada token y al final
+    ("done", respuesta completa) o ("error", mensaje). `tokens` es la asyncio.Queue que recibe
+    `job.emit`. Cancela el trabajo si el cliente se desconecta o se supera `timeout`.
+    """
+    deadline = job.loop.time() + timeout
+    try:
+        while True:
+            getter = asyncio.ensure_future(tokens.get())
+            done, _ = await asyncio.wait(
+                {getter, job.future}, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED
+            )
+            if getter in done:
+                yield "token", getter.result()
+                continue
+            getter.cancel()
+
+            if job.future.done():
+                # Los tokens se encolan antes de resolver el futuro: vaciamos lo pendiente
+                while not tokens.empty():
+                    yield "token", tokens.get_nowait()
+                if job.future.cancelled():
+                    return
+                error = job.future.exception()
+                if error is not None:
+                    yield "error", f"Inference error: {error}"
+                else:
+                    yield "done", job.future.result()
+                return
+            if await request.is_disconnected():
+                job.cancel()
+                return
+            if job.loop.time() >= deadline:
+                job.cancel()
+                yield "error", f"Generation timed out after {timeout}s"
+                return
+    finally:
+        if not job.future.done():
+            job.cancel()
@@ -1,12 +1,12 @@
-from fastapi import APIRouter, UploadFile, File
-from fastapi.responses import HTMLResponse
+from fastapi import APIRouter, UploadFile, File, Request
+from fastapi.responses import HTMLResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
+from datetime import datetime
 from pathlib import Path
 import os
 
-from ..services import email_service, config_service, knowledge_service
-from ..app_state import app_state
+from ..services import email_service, config_service, knowledge_service, status_service, job_service, mailbox_service
 
 router = APIRouter()
 
@@ -19,6 +19,30 @@ class EmailSendRequest(BaseModel):
     item_id: str
     custom_prompt: Optional[str] = None
     language: Optional[str] = 'es'
+    mailbox: Optional[str] = None
+
+class JobRequest(BaseModel):
+    email_ids: List[str]
+    custom_prompt: Optional[str] = None
+    language: Optional[str] = 'es'
+    mailbox: Optional[str] = None
+
+class PendingJobsRequest(BaseModel):
+    custom_prompt: Optional[str] = None
+    language: Optional[str] = 'es'
+    mailbox: Optional[str] = None
+
+class MailboxRequest(BaseModel):
+    address: str
+    display_name: Optional[str] = None
+    tenant: Optional[str] = None
+    username: Optional[str] = None
+    password: Optional[str] = None
+    server: Optional[str] = None
+    enabled: Optional[bool] = None
+
+class EmbeddingModelRequest(BaseModel):
+    model_name: str
 
 class ConfigRequest(BaseModel):
     exchange_user: str
@@ -51,21 +75,52 @@ async def health():
     return {"status": "ok", "service": "email_app_api"}
 
 @router.get("/api/status")
-async def get_status():
-    """Get application status"""
-    return app_state
+async def get_status(mailbox: Optional[str] = None):
+    """Get application status (`mailbox` narrows the per-mailbox section)"""
+    return await status_service.get_status(mailbox)
+
+@router.get("/api/metrics")
+async def get_metrics():
+    """Runtime metrics (pools, caches, workers, event bus)"""
+    return await status_service.get_metrics()
+
+@router.get("/api/events")
+async def events(request: Request, mailbox: Optional[str] = None):
+    """Live dashboard updates as Server-Sent Events (only global and `mailbox` events if given)"""
+    return StreamingResponse(
+        status_service.event_stream(request, mailbox=mailbox),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # =========== Email Routes ===========
 
 @router.get("/api/emails")
-async def list_emails(offset: int = 0, limit: int = 10):
-    """List emails with pagination"""
-    return await email_service.list_emails(offset, limit)
+async def list_emails(
+    offset: int = 0,
+    limit: int = 10,
+    before: Optional[str] = None,
+    status: Optional[str] = None,
+    sender: Optional[str] = None,
+    is_read: Optional[bool] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    mailbox: Optional[str] = None
+):
+    """List emails. Pass `before` (the previous page's `next_cursor`) for keyset pagination"""
+    return await email_service.list_emails(
+        offset, min(max(limit, 1), 100), before, status, sender, is_read, date_from, date_to, mailbox
+    )
+
+@router.get("/api/emails/search")
+async def search_emails(q: str, limit: int = 20, hybrid: bool = False, mailbox: Optional[str] = None):
+    """Full-text search over stored emails (`hybrid=true` blends in semantic similarity)"""
+    return await email_service.search_emails(q, min(max(limit, 1), 100), hybrid, mailbox)
 
 @router.get("/api/emails/{item_id:path}")
-async def email_detail(item_id: str):
+async def email_detail(item_id: str, mailbox: Optional[str] = None):
     """Get email detail"""
-    return await email_service.get_email_detail(item_id)
+    return await email_service.get_email_detail(item_id, mailbox)
 
 @router.post("/api/emails/generate-answer")
 async def generate_answer(req: EmailSendRequest):
@@ -73,23 +128,52 @@ async def generate_answer(req: EmailSendRequest):
     return await email_service.generate_answer(
         req.item_id,
         req.custom_prompt,
-        req.language
+        req.language,
+        req.mailbox
+    )
+
+@router.post("/api/emails/generate-answer/stream")
+async def generate_answer_stream(req: EmailSendRequest):
+    """Generate AI response for email, streaming tokens as Server-Sent Events"""
+    return StreamingResponse(
+        email_service.generate_answer_stream(req.item_id, req.custom_prompt, req.language, req.mailbox),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 @router.post("/api/emails/save-draft")
 async def save_draft(req: EmailSendRequest):
     """Save email draft"""
-    return await email_service.save_draft_email(req.item_id, req.body)
+    return await email_service.save_draft_email(req.item_id, req.body, req.mailbox)
 
 @router.patch("/api/emails/{item_id:path}/read")
-async def mark_as_read(item_id: str, read: bool = True):
+async def mark_as_read(item_id: str, read: bool = True, mailbox: Optional[str] = None):
     """Mark email as read/unread"""
-    return await email_service.mark_email_as_read(item_id, read)
+    return await email_service.mark_email_as_read(item_id, read, mailbox)
 
 @router.delete("/api/emails/{item_id:path}")
-async def delete_email(item_id: str):
+async def delete_email(item_id: str, mailbox: Optional[str] = None):
     """Delete email"""
-    return await email_service.delete_email_async(item_id)
+    return await email_service.delete_email_async(item_id, mailbox)
+
+# =========== Mailbox Routes ===========
+
+@router.get("/api/mailboxes")
+async def list_mailboxes():
+    """List registered mailboxes with their sync state"""
+    return await mailbox_service.list_registered_mailboxes()
+
+@router.post("/api/mailboxes")
+async def save_mailbox(req: MailboxRequest):
+    """Add or update a mailbox (empty credentials use the global Exchange settings)"""
+    return await mailbox_service.register_mailbox(
+        req.address, req.display_name, req.tenant, req.username, req.password, req.server, req.enabled
+    )
+
+@router.delete("/api/mailboxes/{address}")
+async def delete_mailbox(address: str):
+    """Remove a mailbox and its stored emails"""
+    return await mailbox_service.remove_mailbox(address)
 
 # =========== Config Routes ===========
 
@@ -110,6 +194,29 @@ async def update_config(req: ConfigRequest):
         req.ai_temp
     )
 
+# =========== Job Routes ===========
+
+@router.post("/api/jobs")
+async def enqueue_jobs(req: JobRequest):
+    """Queue background AI answer generation for one or more emails"""
+    return await job_service.enqueue_answers(req.email_ids, req.custom_prompt, req.language, req.mailbox)
+
+@router.post("/api/jobs/pending")
+async def enqueue_pending_jobs(req: Optional[PendingJobsRequest] = None):
+    """Queue background AI answer generation for every pending email"""
+    req = req or PendingJobsRequest()
+    return await job_service.enqueue_pending_answers(req.custom_prompt, req.language, req.mailbox)
+
+@router.get("/api/jobs")
+async def job_stats(mailbox: Optional[str] = None):
+    """Job queue counters and jobs in progress"""
+    return await job_service.get_queue_stats(mailbox)
+
+@router.get("/api/jobs/{job_id}")
+async def job_status(job_id: int, mailbox: Optional[str] = None):
+    """Get the status of a background job"""
+    return await job_service.get_job_status(job_id, mailbox)
+
 # =========== Knowledge Routes ===========
 
 @router.get("/api/knowledge")
@@ -117,6 +224,16 @@ async def list_knowledge():
     """List knowledge documents"""
     return await knowledge_service.list_knowledge_documents()
 
+@router.post("/api/knowledge/model")
+async def swap_embedding_model(req: EmbeddingModelRequest):
+    """Swap the embedding model"""
+    return await knowledge_service.swap_embedding_model(req.model_name)
+
+@router.delete("/api/knowledge/model")
+async def unload_embedding_model():
+    """Unload the embedding model"""
+    return await knowledge_service.unload_embedding_model()
+
 @router.post("/api/knowledge/upload")
 async def upload_document(file: UploadFile = File(...)):
     """Upload knowledge document"""
@@ -124,9 +241,8 @@ async def upload_document(file: UploadFile = File(...)):
     temp_dir = Path.cwd() / "temp_uploads"
     temp_dir.mkdir(exist_ok=True, parents=True)
     
-    file_path = str(temp_dir / file.filename)
-    
-    with open(file_path, "wb") as buffer:
-        buffer.write(await file.read())
+    filename = Path(file.filename).name
+    file_path = str(temp_dir / filename)
+    await knowledge_service.spool_upload(file, file_path)
     
-    return await knowledge_service.upload_knowledge_document(file_path, file.filename)
+    return await knowledge_service.upload_knowledge_document(file_path, filename)
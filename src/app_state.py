@@ -1,10 +1,205 @@
-# Estado global compartido entre FastAPI y el motor de processing
-app_state = {
-    "status": "Iniciando...",
-    "exchange_connected": False,
-    "emails_processed": 0,
-    "emails": [],
-    "current_email": None,
-    "last_error": None,
-    "active_tasks": []
-}
+import os
+import time
+import logging
+import threading
+from dataclasses import dataclass, field, fields, replace, asdict
+from typing import Optional, Tuple
+
+from .core.events import event_bus
+
+logger = logging.getLogger("AppState")
+
+# memory: estado por proceso. postgres: compartido entre workers de uvicorn (--workers N)
+STATE_BACKEND = os.getenv("APP_STATE_BACKEND", "memory").lower()
+# Con backend postgres, antigüedad máxima (s) de la copia local antes de releerla
+STATE_REFRESH_SECS = float(os.getenv("APP_STATE_REFRESH_SECS", "1"))
+
+
+@dataclass(frozen=True)
+class StateData:
+    """Estado compartido entre FastAPI y el motor de processing. Inmutable: cada cambio crea una copia."""
+    status: str = "Iniciando..."
+    exchange_connected: bool = False
+    emails_processed: int = 0
+    current_email: Optional[dict] = None
+    last_error: Optional[str] = None
+    last_sync: Optional[dict] = None
+    active_tasks: Tuple[dict, ...] = ()
+    # Estado de cada buzón del registro: {dirección: {status, connected, last_sync, last_error, ...}}
+    mailboxes: dict = field(default_factory=dict)
+
+
+FIELDS = frozenset(f.name for f in fields(StateData))
+
+
+class PostgresStateBackend:
+    """Guarda el estado en la tabla `app_state` (una fila JSONB) para compartirlo entre procesos."""
+
+    def __init__(self, refresh_secs=STATE_REFRESH_SECS):
+        from .infrastructure.database import postgres
+        self.db = postgres
+        self.refresh_secs = refresh_secs
+
+    def load(self):
+        return self.db.load_app_state()
+
+    def merge(self, changes):
+        self.db.merge_app_state(changes)
+
+    def increment(self, key, n):
+        return self.db.increment_app_state(key, n)
+
+    def set_task(self, task_id, task):
+        self.db.set_app_state_task(str(task_id), task)
+
+    def set_mailbox(self, address, info):
+        return self.db.set_app_state_mailbox(address, info)
+
+
+class AppState:
+    """
+    Estado de la aplicación seguro entre hilos.
+
+    Las escrituras (`update`, `increment`, `add_task`, `remove_task`) se serializan con un
+    lock y sustituyen el snapshot entero (copy-on-write), así que leer (`snapshot`, `get`,
+    `state[...]`) no necesita lock y nunca ve una escritura a medias. `version` crece con
+    cada cambio. Con un `backend` los cambios se escriben también ahí y la copia local se
+    refresca cada `backend.refresh_secs` segundos.
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._data = StateData()
+        self._version = 0
+        self._dict = self._as_dict(self._data)
+        self._synced_at = 0.0
+
+    @staticmethod
+    def _as_dict(data):
+        snapshot = asdict(data)
+        snapshot["active_tasks"] = list(snapshot["active_tasks"])
+        return snapshot
+
+    def _commit(self, data):
+        # Llamar con self._lock adquirido
+        self._data = data
+        self._version += 1
+        self._dict = self._as_dict(data)
+
+    def _write_backend(self, method, *args):
+        if self.backend is None:
+            return None
+        try:
+            return getattr(self.backend, method)(*args)
+        except Exception as e:
+            logger.error(f"Error escribiendo estado compartido ({method}): {e}")
+            return None
+
+    # --- Lectura ---
+
+    @property
+    def version(self):
+        return self._version
+
+    def snapshot(self):
+        """(versión, dict) del estado actual. El dict no se modifica nunca: no hace falta copiarlo."""
+        if self.backend is not None and time.monotonic() - self._synced_at > self.backend.refresh_secs:
+            self.refresh()
+        return self._version, self._dict
+
+    def get(self, key, default=None):
+        return self.snapshot()[1].get(key, default)
+
+    def __getitem__(self, key):
+        return self.snapshot()[1][key]
+
+    def refresh(self):
+        """Relee el estado compartido del backend (procesos distintos escriben en él)."""
+        self._synced_at = time.monotonic()
+        try:
+            shared = self.backend.load()
+        except Exception as e:
+            logger.error(f"Error leyendo estado compartido: {e}")
+            return
+        if not shared:
+            return
+        changes = {k: v for k, v in shared.items() if k in FIELDS}
+        if isinstance(changes.get("active_tasks"), dict):
+            changes["active_tasks"] = tuple(changes["active_tasks"].values())
+        with self._lock:
+            self._commit(replace(self._data, **changes))
+
+    # --- Escritura ---
+
+    def update(self, publish=True, **changes):
+        """Aplica `changes` y (por defecto) los publica como evento `status` en /api/events."""
+        unknown = set(changes) - FIELDS
+        if unknown:
+            raise KeyError(f"Campos de estado desconocidos: {sorted(unknown)}")
+        with self._lock:
+            self._commit(replace(self._data, **changes))
+        self._write_backend("merge", changes)
+        if publish:
+            event_bus.publish("status", changes)
+
+    def increment(self, key, n=1):
+        """Incrementa un contador de forma atómica y devuelve el nuevo valor."""
+        with self._lock:
+            value = getattr(self._data, key) + n
+            self._commit(replace(self._data, **{key: value}))
+        shared = self._write_backend("increment", key, n)
+        if shared is not None and shared != value:
+            # Otros procesos también han contado: el valor bueno es el de la DB
+            value = shared
+            with self._lock:
+                self._commit(replace(self._data, **{key: value}))
+        event_bus.publish("status", {key: value})
+        return value
+
+    def set_mailbox(self, address, publish=True, **info):
+        """
+        Actualiza el estado de un buzón (lo escribe su worker de sincronización).
+        `exchange_connected` pasa a ser True si al menos un buzón está conectado. Con
+        backend, solo se escribe la entrada de `address` en la fila compartida.
+        """
+        with self._lock:
+            mailboxes = {**self._data.mailboxes, address: {**self._data.mailboxes.get(address, {}), **info}}
+            connected = any(m.get("connected") for m in mailboxes.values())
+            self._commit(replace(self._data, mailboxes=mailboxes, exchange_connected=connected))
+        self._apply_shared_mailboxes(self._write_backend("set_mailbox", address, info))
+        if publish:
+            event_bus.publish("mailbox", {"mailbox": address, **info})
+
+    def remove_mailbox(self, address):
+        with self._lock:
+            mailboxes = {k: v for k, v in self._data.mailboxes.items() if k != address}
+            connected = any(m.get("connected") for m in mailboxes.values())
+            self._commit(replace(self._data, mailboxes=mailboxes, exchange_connected=connected))
+        self._apply_shared_mailboxes(self._write_backend("set_mailbox", address, None))
+
+    def _apply_shared_mailboxes(self, shared):
+        # El backend escribe solo la entrada de este buzón: los demás los mantienen otros procesos
+        if shared is not None:
+            with self._lock:
+                self._commit(replace(self._data, **shared))
+
+    def add_task(self, task):
+        with self._lock:
+            self._commit(replace(self._data, active_tasks=self._data.active_tasks + (task,)))
+        self._write_backend("set_task", task["job_id"], task)
+
+    def remove_task(self, job_id):
+        with self._lock:
+            tasks = tuple(t for t in self._data.active_tasks if t["job_id"] != job_id)
+            self._commit(replace(self._data, active_tasks=tasks))
+        self._write_backend("set_task", job_id, None)
+
+
+def build_app_state():
+    if STATE_BACKEND == "postgres":
+        return AppState(backend=PostgresStateBackend())
+    return AppState()
+
+
+app_state = build_app_state()
@@ -0,0 +1,99 @@
+import json
+import asyncio
+import logging
+import threading
+from datetime import datetime
+
+logger = logging.getLogger("EventBus")
+
+
+class Subscription:
+    """Cola acotada de un cliente. Si el cliente no consume, se descartan los eventos más antiguos."""
+
+    def __init__(self, maxsize):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def put(self, event):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout=None):
+        """Siguiente evento, o None si pasan `timeout` segundos sin ninguno."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class EventBus:
+    """
+    Bus de eventos en memoria para los dashboards conectados (/api/events).
+
+    `publish` puede llamarse desde cualquier hilo (el bucle de sincronización corre en
+    un hilo aparte): el reparto a las colas de los suscriptores se hace siempre en el
+    event loop de la API. Un cliente lento solo pierde sus propios eventos antiguos.
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._loop = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.published = 0
+
+    def attach_loop(self, loop):
+        self._loop = loop
+
+    def subscribe(self):
+        subscription = Subscription(self.queue_size)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+
+    def publish(self, event_type, data=None):
+        with self._lock:
+            self._next_id += 1
+            self.published += 1
+            event = {
+                "id": self._next_id,
+                "type": event_type,
+                "data": data if data is not None else {},
+                "ts": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            }
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return event
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._dispatch(event)
+        else:
+            loop.call_soon_threadsafe(self._dispatch, event)
+        return event
+
+    def _dispatch(self, event):
+        for subscription in list(self._subscribers):
+            subscription.put(event)
+
+    def stats(self):
+        return {
+            "subscribers": len(self._subscribers),
+            "published": self.published,
+            "dropped": sum(s.dropped for s in self._subscribers),
+        }
+
+
+def format_sse(event):
+    payload = json.dumps(event["data"], ensure_ascii=False, default=str)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {payload}\n\n"
+
+
+event_bus = EventBus()
@@ -0,0 +1,70 @@
+import time
+import threading
+
+
+class TokenBucket:
+    """
+    Limitador token bucket seguro entre hilos: `rate_per_minute` permisos por minuto con
+    ráfagas de hasta `burst`. Lo comparten los workers de todos los buzones de un mismo
+    tenant, de modo que un tenant con muchos buzones no satura su servidor EWS.
+    """
+
+    def __init__(self, rate_per_minute, burst=1, clock=time.monotonic):
+        if rate_per_minute <= 0:
+            raise ValueError("rate_per_minute debe ser mayor que 0")
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1, burst)
+        self._clock = clock
+        self._tokens = float(self.burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+        self.granted = 0
+        self.throttled = 0
+
+    def _refill(self):
+        # Llamar con self._lock adquirido
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """
+        Consume un permiso si lo hay. Devuelve 0.0 si se concedió o los segundos que faltan
+        para el siguiente permiso.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.granted += 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, stop_event=None):
+        """
+        Espera (sin bloquear a los demás hilos) hasta obtener un permiso. Devuelve False si
+        `stop_event` se activa antes.
+        """
+        waited = False
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                if waited:
+                    self.throttled += 1
+                return True
+            waited = True
+            if stop_event is None:
+                time.sleep(delay)
+            elif stop_event.wait(delay):
+                return False
+
+    def stats(self):
+        with self._lock:
+            self._refill()
+            return {
+                "rate_per_minute": round(self.rate * 60, 3),
+                "burst": self.burst,
+                "available": round(self._tokens, 3),
+                "granted": self.granted,
+                "throttled": self.throttled,
+            }
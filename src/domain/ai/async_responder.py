@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+import httpx
+
+from .responder import build_payload
+
+logger = logging.getLogger("AsyncAIResponder")
+
+# Timeouts del cliente HTTP (segundos): conexión y lectura (tiempo máximo sin recibir datos)
+CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "300"))
+MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "10"))
+# Reintentos ante 503 / 429 / errores de conexión, con backoff exponencial y jitter
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))
+# Espera máxima que se acepta de un Retry-After; si el servicio pide más, no se reintenta
+RETRY_AFTER_MAX = float(os.getenv("LLM_RETRY_AFTER_MAX", "30"))
+# Circuit breaker: fallos consecutivos para abrirlo y segundos hasta probar de nuevo
+BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+BREAKER_RESET_SECS = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+# Solo se reintenta lo que no ha llegado a generar: 503 (modelo cargando) y 429 (saturado).
+# Un 500 o un 504 (timeout del propio servicio LLM) ya consumió la generación entera.
+RETRYABLE_STATUS = {503}
+THROTTLED_STATUS = 429
+
+
+def parse_retry_after(value, now=None):
+    """Segundos indicados por una cabecera Retry-After (entero o fecha HTTP), o None."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = now if now is not None else time.time()
+    return max(0.0, when.timestamp() - now)
+
+
+class LLMUnavailableError(Exception):
+    """El servicio LLM no responde o el circuit breaker está abierto."""
+
+
+class CircuitBreaker:
+    """
+    Corta las llamadas al servicio LLM tras `threshold` fallos seguidos. Pasados
+    `reset_timeout` segundos deja pasar una petición de prueba (half-open): si va bien
+    se cierra, si falla vuelve a abrirse.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET_SECS, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self._clock() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or (self.opened_at is None and self.failures >= self.threshold):
+                self.trips += 1
+                self.opened_at = self._clock()
+            self._probing = False
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+        }
+
+
+class AsyncAIResponder:
+    """
+    Cliente asíncrono del servicio LLM sobre un `httpx.AsyncClient` compartido (keep-alive):
+    no ocupa un hilo del pool durante la generación ni abre una conexión TCP por petición.
+    Debe usarse desde un único event loop (el de FastAPI); se cierra con `aclose()`.
+    """
+
+    def __init__(self, api_url=None, transport=None, breaker=None,
+                 max_retries=MAX_RETRIES, retry_backoff=RETRY_BACKOFF):
+        self.api_url = api_url or os.getenv('LLM_API_URL', 'http://llm_service:8000')
+        self.breaker = breaker or CircuitBreaker()
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._transport = transport
+        self._client = None
+        self.retries = 0
+
+    @property
+    def client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.api_url,
+                timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+                transport=self._transport,
+            )
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _delay(self, attempt):
+        # Full jitter: evita que varios clientes reintenten a la vez contra un servicio que arranca
+        return random.uniform(0, self.retry_backoff * (2 ** attempt))
+
+    async def _send(self, path, payload, stream=False):
+        """
+        Envía la petición con reintentos y circuit breaker. Devuelve la respuesta (abierta
+        si `stream`) o lanza LLMUnavailableError.
+        """
+        if not self.breaker.allow():
+            raise LLMUnavailableError("Circuit breaker abierto: servicio LLM no disponible")
+
+        for attempt in range(self.max_retries + 1):
+            error = None
+            retry_after = None
+            try:
+                request = self.client.build_request("POST", path, json=payload)
+                response = await self.client.send(request, stream=stream)
+                status = response.status_code
+                if status not in RETRYABLE_STATUS and status != THROTTLED_STATUS:
+                    # Los 5xx no reintentables también cuentan como fallo para el breaker
+                    if status >= 500:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                    return response
+                error = f"HTTP {status}"
+                if status == THROTTLED_STATUS:
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                await response.aclose()
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                error = str(e) or type(e).__name__
+            except httpx.HTTPError as e:
+                # Timeout de lectura o corte a mitad de generación: no merece reintento
+                self.breaker.record_failure()
+                raise LLMUnavailableError(str(e) or type(e).__name__) from e
+
+            if retry_after is not None and retry_after > RETRY_AFTER_MAX:
+                logger.warning(f"Servicio LLM saturado: pide esperar {retry_after:.0f}s, no se reintenta")
+                break
+            if attempt < self.max_retries:
+                self.retries += 1
+                delay = retry_after if retry_after is not None else self._delay(attempt)
+                logger.warning(f"Servicio LLM falló ({error}); reintento {attempt + 1} en {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+        self.breaker.record_failure()
+        raise LLMUnavailableError(f"Servicio LLM no disponible tras {attempt + 1} intentos: {error}")
+
+    async def generate_response(self, prompt, task='generation'):
+        """Versión asíncrona de `AIResponder.generate_response`: devuelve el texto o None."""
+        try:
+            logger.info(f"Enviando petición a LLM para tarea: {task}")
+            response = await self._send("/generate", build_payload(prompt, task))
+            response.raise_for_status()
+            return response.json().get('response', '')
+        except (LLMUnavailableError, httpx.HTTPError) as e:
+            logger.error(f"Error al comunicar con el servicio LLM: {e}")
+            return None
+
+    async def generate_stream(self, prompt, task='generation'):
+        """
+        Versión asíncrona de `AIResponder.generate_stream`: produce los tokens según llegan.
+        Lanza LLMUnavailableError o RuntimeError si la generación falla.
+        """
+        logger.info(f"Enviando petición en streaming a LLM para tarea: {task}")
+        response = await self._send("/generate/stream", build_payload(prompt, task), stream=True)
+        try:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = json.loads(line[len("data:"):].strip())
+                if "token" in event:
+                    yield event["token"]
+                elif event.get("error"):
+                    raise RuntimeError(event["error"])
+                elif event.get("done"):
+                    return
+        finally:
+            # Cerrar la respuesta corta la conexión y el servicio LLM cancela la generación
+            await response.aclose()
+
+    def stats(self):
+        return {"retries": self.retries, "circuit_breaker": self.breaker.stats()}
+
+
+_responder = None
+
+
+def get_async_responder():
+    """Instancia compartida por todo el proceso (un solo pool de conexiones)."""
+    global _responder
+    if _responder is None:
+        _responder = AsyncAIResponder()
+    return _responder
+
+
+async def close_async_responder():
+    if _responder is not None:
+        await _responder.aclose()
@@ -1,40 +1,55 @@
 import os
+import json
 import yaml
 import requests
 import logging
+from functools import lru_cache
 from dotenv import load_dotenv
 
 # Cargar variables de entorno
 load_dotenv()
 
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'config', 'config.yaml')
+
+
+@lru_cache(maxsize=1)
+def load_model_config():
+    """Sección `model` de config.yaml, leída una sola vez por proceso."""
+    with open(CONFIG_PATH, 'r') as f:
+        return (yaml.safe_load(f) or {}).get('model', {})
+
+
+def build_payload(prompt, task):
+    """Cuerpo de /generate con los parámetros de la tarea (o los generales del modelo)."""
+    model_config = load_model_config()
+    task_params = model_config.get('tasks', {}).get(task, {})
+    return {
+        "prompt": prompt,
+        "max_tokens": task_params.get('max_tokens', model_config.get('max_tokens', 512)),
+        "temperature": task_params.get('temperature', model_config.get('temperature', 0.7)),
+        "top_p": task_params.get('top_p', model_config.get('top_p', 0.9))
+    }
+
+
 class AIResponder:
     def __init__(self):
-        # Cargar configuración
-        config_path = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'config', 'config.yaml')
-        with open(config_path, 'r') as f:
-            self.config = yaml.safe_load(f)
-        
         # URL de la API del modelo (desde .env o valor por defecto)
         self.api_url = os.getenv('LLM_API_URL', 'http://llm_service:8000')
         self.generate_endpoint = f"{self.api_url}/generate"
+        self.stream_endpoint = f"{self.api_url}/generate/stream"
         
-        self.model_config = self.config.get('model', {})
+        self.model_config = load_model_config()
         self.tasks_config = self.model_config.get('tasks', {})
 
+    def _build_payload(self, prompt, task):
+        return build_payload(prompt, task)
+
     def generate_response(self, prompt, task='generation'):
         """
         Envía un prompt al servicio LLM y devuelve la respuesta generada.
         Permite especificar el tipo de tarea para ajustar parámetros (temp, tokens).
         """
-        # Obtener parámetros específicos de la tarea o los generales del modelo
-        task_params = self.tasks_config.get(task, {})
-        
-        payload = {
-            "prompt": prompt,
-            "max_tokens": task_params.get('max_tokens', self.model_config.get('max_tokens', 512)),
-            "temperature": task_params.get('temperature', self.model_config.get('temperature', 0.7)),
-            "top_p": task_params.get('top_p', self.model_config.get('top_p', 0.9))
-        }
+        payload = self._build_payload(prompt, task)
         
         try:
             logging.info(f"Enviando petición a LLM para tarea: {task}")
@@ -48,6 +63,28 @@ class AIResponder:
             logging.error(f"Error al comunicar con el servicio LLM: {str(e)}")
             return None
 
+    def generate_stream(self, prompt, task='generation'):
+        """
+        Igual que `generate_response` pero va devolviendo los tokens según los genera el
+        servicio LLM (Server-Sent Events de /generate/stream). Lanza RuntimeError si el
+        servicio informa de un error a mitad de la generación.
+        """
+        payload = self._build_payload(prompt, task)
+        logging.info(f"Enviando petición en streaming a LLM para tarea: {task}")
+        # (conexión, lectura): la lectura es el tiempo máximo entre dos tokens, no el total
+        with requests.post(self.stream_endpoint, json=payload, stream=True, timeout=(10, 300)) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                event = json.loads(line[len("data:"):].strip())
+                if "token" in event:
+                    yield event["token"]
+                elif event.get("error"):
+                    raise RuntimeError(event["error"])
+                elif event.get("done"):
+                    return
+
     def classify_email(self, email_body):
         """
         Ejemplo de uso específico: Clasificar un correo.
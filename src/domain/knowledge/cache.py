@@ -0,0 +1,94 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Tamaño y caducidad de las cachés de búsqueda
+CACHE_SIZE = int(os.getenv("KNOWLEDGE_CACHE_SIZE", "256"))
+CACHE_TTL = float(os.getenv("KNOWLEDGE_CACHE_TTL", "600"))
+
+
+class TTLCache:
+    """Caché LRU acotada en tamaño y en tiempo de vida, segura entre hilos."""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > self._clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, self._clock() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+def content_hash(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+# Embeddings de consultas (solo dependen del texto y del modelo)
+embedding_cache = TTLCache()
+# Top-k de resultados (dependen además del contenido de `documents`)
+result_cache = TTLCache()
+
+# Generación de la tabla `documents`: forma parte de la clave de resultados, así que
+# incrementarla invalida de golpe todo lo cacheado antes de una indexación.
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+def current_generation():
+    return _generation
+
+
+def bump_generation():
+    """Invalida los resultados cacheados tras modificar la tabla `documents`."""
+    global _generation
+    with _generation_lock:
+        _generation += 1
+    result_cache.clear()
+    return _generation
+
+
+def cache_stats():
+    return {
+        "generation": _generation,
+        "embeddings": embedding_cache.stats(),
+        "results": result_cache.stats(),
+    }
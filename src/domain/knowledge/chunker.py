@@ -0,0 +1,246 @@
+import os
+import re
+import math
+from dataclasses import dataclass, field
+from typing import Optional
+
+# Fragmentador por defecto: "structure" (tokens + títulos/páginas) o "words" (ventanas de palabras)
+DEFAULT_CHUNKER = os.getenv("KNOWLEDGE_CHUNKER", "structure").lower()
+# Tokens por fragmento (vacío = el máximo que admite el modelo) y solape entre fragmentos de una sección
+CHUNK_TOKENS = int(os.getenv("KNOWLEDGE_CHUNK_TOKENS") or 0) or None
+CHUNK_OVERLAP_TOKENS = int(os.getenv("KNOWLEDGE_CHUNK_OVERLAP_TOKENS", "32"))
+# Sin tokenizer se estima con palabras (WordPiece parte de media 1.5 tokens por palabra en español)
+FALLBACK_TOKENS_PER_WORD = 1.6
+FALLBACK_MAX_TOKENS = 254
+
+SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+")
+NUMBERED_HEADING = re.compile(r"^(\d+(?:\.\d+)*)\.?\s+\S")
+MARKDOWN_HEADING = re.compile(r"^(#{1,6})\s+(.+)$")
+
+
+@dataclass(frozen=True)
+class TextBlock:
+    """Párrafo extraído de un documento. `heading_level` > 0 si es un título (1 = nivel superior)."""
+    text: str
+    page: Optional[int] = None
+    heading_level: int = 0
+
+
+@dataclass(frozen=True)
+class Chunk:
+    text: str
+    metadata: dict = field(default_factory=dict)
+
+
+def heading_level(paragraph):
+    """
+    Nivel de título de un párrafo de texto plano (PDF/TXT), o 0 si no lo parece: una sola
+    línea corta sin puntuación final, numerada ("2.1 Instalación"), en mayúsculas o markdown.
+    """
+    markdown = MARKDOWN_HEADING.match(paragraph)
+    if markdown:
+        return len(markdown.group(1))
+    if "\n" in paragraph or len(paragraph) > 80 or len(paragraph.split()) > 12:
+        return 0
+    if paragraph[-1] in ".,;:" or not (paragraph[0].isupper() or paragraph[0].isdigit()):
+        return 0
+    numbered = NUMBERED_HEADING.match(paragraph)
+    if numbered:
+        return numbered.group(1).count(".") + 1
+    if paragraph.isupper():
+        return 1
+    return 0
+
+
+def iter_paragraphs(texts):
+    """Párrafos (separados por líneas en blanco) de un texto recibido por partes."""
+    carry = ""
+    for text in texts:
+        parts = re.split(r"\n\s*\n", carry + text)
+        carry = parts.pop()
+        for part in parts:
+            if part.strip():
+                yield part.strip()
+    if carry.strip():
+        yield carry.strip()
+
+
+def text_blocks(paragraphs, page=None):
+    for paragraph in paragraphs:
+        markdown = MARKDOWN_HEADING.match(paragraph)
+        text = markdown.group(2) if markdown else paragraph
+        yield TextBlock(text, page, heading_level(paragraph))
+
+
+class TokenCounter:
+    """Cuenta tokens con el tokenizer del modelo de embeddings (o los estima sin él)."""
+
+    def __init__(self, tokenizer=None, max_tokens=FALLBACK_MAX_TOKENS):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+
+    @classmethod
+    def from_model(cls, model):
+        tokenizer = getattr(model, "tokenizer", None)
+        max_seq_length = getattr(model, "max_seq_length", None)
+        if tokenizer is None or not max_seq_length:
+            return cls()
+        # [CLS] y [SEP] ocupan dos posiciones de la secuencia
+        return cls(tokenizer, max_seq_length - 2)
+
+    def count(self, text):
+        if self.tokenizer is None:
+            return math.ceil(len(text.split()) * FALLBACK_TOKENS_PER_WORD)
+        return len(self.tokenizer.tokenize(text))
+
+
+class WordChunker:
+    """Ventanas de palabras de tamaño fijo con solape (fragmentador anterior, sin metadatos)."""
+
+    def __init__(self, chunk_size=500, overlap=50):
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+
+    def chunk(self, blocks):
+        texts = (block.text + "\n" for block in blocks)
+        for text in iter_chunks(texts, self.chunk_size, self.overlap):
+            yield Chunk(text)
+
+
+class StructureChunker:
+    """
+    Agrupa párrafos hasta `max_tokens` tokens del modelo, de modo que ningún fragmento se
+    trunca al calcular su embedding. Un título o un cambio de página empiezan fragmento
+    nuevo; un párrafo demasiado largo se parte por frases y, si hace falta, por palabras.
+    Cada fragmento lleva en `metadata` su página, la ruta de secciones y sus tokens.
+    """
+
+    def __init__(self, counter=None, max_tokens=None, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+        self.counter = counter or TokenCounter()
+        self.max_tokens = min(max_tokens or self.counter.max_tokens, self.counter.max_tokens)
+        self.overlap_tokens = overlap_tokens
+
+    def _split_words(self, text):
+        piece, tokens = [], 0
+        for word in text.split():
+            n = self.counter.count(word)
+            if piece and tokens + n > self.max_tokens:
+                yield " ".join(piece), tokens
+                piece, tokens = [], 0
+            piece.append(word)
+            tokens += n
+        if piece:
+            yield " ".join(piece), tokens
+
+    def units(self, text):
+        """(texto, tokens) de un párrafo, partido si supera `max_tokens`."""
+        tokens = self.counter.count(text)
+        if tokens <= self.max_tokens:
+            yield text, tokens
+            return
+        for sentence in SENTENCE_END.split(text):
+            tokens = self.counter.count(sentence)
+            if tokens <= self.max_tokens:
+                yield sentence, tokens
+            else:
+                yield from self._split_words(sentence)
+
+    def chunk(self, blocks):
+        sections = []          # [(nivel, título)] de la sección actual
+        units = []             # [(texto, tokens)] del fragmento en curso
+        has_body = False
+        page = None
+
+        def emit():
+            metadata = {"tokens": sum(n for _, n in units)}
+            if page is not None:
+                metadata["page"] = page
+            if sections:
+                metadata["section"] = " > ".join(title for _, title in sections)
+            return Chunk("\n".join(text for text, _ in units), metadata)
+
+        def overlap(next_tokens):
+            # Últimas unidades del fragmento anterior que caben en el solape y junto a la siguiente
+            carried, total = [], 0
+            for text, n in reversed(units):
+                if total + n > self.overlap_tokens or total + n + next_tokens > self.max_tokens:
+                    break
+                carried.insert(0, (text, n))
+                total += n
+            return carried
+
+        for block in blocks:
+            if block.heading_level:
+                if has_body:
+                    yield emit()
+                    units, has_body = [], False
+                while sections and sections[-1][0] >= block.heading_level:
+                    sections.pop()
+                sections.append((block.heading_level, block.text))
+                if not units:
+                    page = block.page
+                units.extend(self.units(block.text))
+                continue
+
+            if block.page != page:
+                if has_body:
+                    yield emit()
+                    units, has_body = [], False
+                page = block.page
+
+            for text, n in self.units(block.text):
+                if units and sum(t for _, t in units) + n > self.max_tokens:
+                    if has_body:
+                        yield emit()
+                        units = overlap(n)
+                    else:
+                        # Solo títulos acumulados: no caben con el párrafo, van en su propio fragmento
+                        yield emit()
+                        units = []
+                units.append((text, n))
+                has_body = True
+
+        if units:
+            yield emit()
+
+
+CHUNKERS = {"structure": StructureChunker, "words": WordChunker}
+
+
+def get_chunker(name=None, model=None):
+    """Instancia el fragmentador `name` (KNOWLEDGE_CHUNKER) para el modelo de embeddings dado."""
+    name = name or DEFAULT_CHUNKER
+    if name not in CHUNKERS:
+        raise ValueError(f"Fragmentador desconocido: {name}")
+    if name == "structure":
+        return StructureChunker(TokenCounter.from_model(model), CHUNK_TOKENS)
+    return CHUNKERS[name]()
+
+
+def iter_chunks(texts, chunk_size=500, overlap=50):
+    """
+    Ventanas de `chunk_size` palabras con `overlap` de solape sobre un texto recibido por
+    partes (páginas, bloques), sin juntarlo entero. Una palabra cortada entre dos partes
+    se reconstruye.
+    """
+    step = chunk_size - overlap
+    words = []
+    carry = ""
+    for text in texts:
+        text = carry + text
+        parts = text.split()
+        carry = parts.pop() if parts and not text[-1].isspace() else ""
+        words.extend(parts)
+        while len(words) >= chunk_size:
+            yield " ".join(words[:chunk_size])
+            del words[:step]
+    if carry:
+        words.append(carry)
+    while words:
+        yield " ".join(words[:chunk_size])
+        del words[:step]
+
+
+def chunk_text(text, chunk_size=500, overlap=50):
+    """Divide el texto en trozos pequeños para mejor recuperación."""
+    return list(iter_chunks([text], chunk_size, overlap))
@@ -1,115 +1,351 @@
 import os
+import hashlib
 import logging
+import threading
+import multiprocessing
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 import fitz  # PyMuPDF
 from docx import Document
-from sentence_transformers import SentenceTransformer
 import numpy as np
+from psycopg2.extras import execute_values, Json
+from .cache import content_hash, embedding_cache, bump_generation
+from .model_provider import embedding_model
+from .chunker import TextBlock, get_chunker, iter_paragraphs, text_blocks
 
 logger = logging.getLogger("KnowledgeBase")
 
-# Cargamos el modelo de embeddings (ligero y rápido para CPU)
-# 384 dimensiones - all-MiniLM-L6-v2
-try:
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    logger.info("Modelo de embeddings cargado correctamente.")
-except Exception as e:
-    logger.error(f"Error cargando modelo de embeddings: {e}")
-    model = None
-
-def extract_text_from_pdf(file_path):
-    text = ""
+# Fragmentos por llamada a `encode` y por sentencia INSERT
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+
+# Extracción de PDF en paralelo: procesos del pool y páginas por tarea
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS") or 0) or min(4, os.cpu_count() or 1)
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "32"))
+# "spawn": un fork del proceso de la API copiaría sus hilos y locks (pool de BD, modelo...)
+PDF_EXTRACT_START_METHOD = os.getenv("PDF_EXTRACT_START_METHOD", "spawn")
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+# El modelo de embeddings se carga bajo demanda (ver model_provider.embedding_model)
+
+def _page_text(page):
+    # Un bloque de texto de PyMuPDF por párrafo, separados por una línea en blanco
+    return "\n\n".join(b[4].strip() for b in page.get_text("blocks") if b[6] == 0 and b[4].strip()) + "\n"
+
+def _extract_pdf_pages(file_path, start, stop):
+    # Se ejecuta en un proceso del pool: cada proceso abre su propia copia del documento
+    with fitz.open(file_path) as doc:
+        return [_page_text(doc[n]) for n in range(start, stop)]
+
+def get_pdf_pool():
+    """Pool de procesos de extracción compartido por todas las subidas (se crea en el primer PDF)."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context(PDF_EXTRACT_START_METHOD),
+            )
+        return _pdf_pool
+
+def shutdown_pdf_pool():
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is not None:
+            _pdf_pool.shutdown(cancel_futures=True)
+            _pdf_pool = None
+
+def iter_pdf_pages(file_path, workers=None, pages_per_task=None):
+    """
+    Produce el texto del PDF página a página, en orden. Los bloques de `pages_per_task`
+    páginas se extraen en paralelo en el pool de procesos compartido, con como mucho
+    `2 * workers` bloques en vuelo para que la memoria no dependa del nº de páginas.
+    """
+    workers = workers or PDF_EXTRACT_WORKERS
+    pages_per_task = pages_per_task or PDF_PAGES_PER_TASK
     try:
         with fitz.open(file_path) as doc:
-            for page in doc:
-                text += page.get_text()
+            page_count = doc.page_count
     except Exception as e:
         logger.error(f"Error extrayendo texto de PDF {file_path}: {e}")
-    return text
+        return
+    ranges = [(n, min(n + pages_per_task, page_count)) for n in range(0, page_count, pages_per_task)]
+
+    if workers <= 1 or len(ranges) <= 1:
+        with fitz.open(file_path) as doc:
+            for page in doc:
+                yield _page_text(page)
+        return
 
-def extract_text_from_docx(file_path):
-    text = ""
+    pool = get_pdf_pool()
+    remaining = iter(ranges)
+    pending = deque(pool.submit(_extract_pdf_pages, file_path, *r) for r in islice(remaining, 2 * workers))
     try:
-        doc = Document(file_path)
-        for para in doc.paragraphs:
-            text += para.text + "\n"
-    except Exception as e:
-        logger.error(f"Error extrayendo texto de DOCX {file_path}: {e}")
-    return text
-
-def chunk_text(text, chunk_size=500, overlap=50):
-    """Divide el texto en trozos pequeños para mejor recuperación."""
-    words = text.split()
-    chunks = []
-    for i in range(0, len(words), chunk_size - overlap):
-        chunk = " ".join(words[i:i + chunk_size])
-        chunks.append(chunk)
-    return chunks
-
-def process_and_index_file(file_path, filename):
-    """Extrae texto, lo fragmenta y genera embeddings para la DB."""
+        while pending:
+            pages = pending.popleft().result()
+            page_range = next(remaining, None)
+            if page_range:
+                pending.append(pool.submit(_extract_pdf_pages, file_path, *page_range))
+            yield from pages
+    finally:
+        # El pool sigue vivo para la siguiente subida: solo se descartan los bloques de esta
+        for future in pending:
+            future.cancel()
+
+def iter_txt_text(file_path, block_size=1 << 20):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        yield from iter(lambda: f.read(block_size), '')
+
+def iter_docx_blocks(file_path):
+    for para in Document(file_path).paragraphs:
+        text = para.text.strip()
+        if not text:
+            continue
+        style = para.style.name if para.style is not None else ""
+        level = 0
+        if style.startswith(("Heading", "Título", "Title")):
+            digits = "".join(c for c in style if c.isdigit())
+            level = int(digits) if digits else 1
+        yield TextBlock(text, None, level)
+
+def iter_file_blocks(file_path, filename):
+    """Párrafos del archivo (con página y nivel de título) según su extensión."""
     ext = os.path.splitext(filename)[1].lower()
-    text = ""
-    
     if ext == '.pdf':
-        text = extract_text_from_pdf(file_path)
+        for page, text in enumerate(iter_pdf_pages(file_path), 1):
+            yield from text_blocks(iter_paragraphs([text]), page)
     elif ext in ['.docx', '.doc']:
-        text = extract_text_from_docx(file_path)
+        yield from iter_docx_blocks(file_path)
     elif ext == '.txt':
-        with open(file_path, 'r', encoding='utf-8') as f:
-            text = f.read()
-            
-    if not text:
-        return False, "No se pudo extraer texto del archivo."
-
-    chunks = chunk_text(text)
-    from ...infrastructure.database.postgres import get_db_connection
-    
-    conn = get_db_connection()
-    if not conn: return False, "Error de conexión a DB."
-    
-    try:
-        cur = conn.cursor()
-        for i, chunk in enumerate(chunks):
-            # Generar el embedding (vector numérico)
-            embedding = model.encode(chunk).tolist()
-            
-            cur.execute("""
-                INSERT INTO documents (filename, content, embedding, metadata)
-                VALUES (%s, %s, %s, %s)
-            """, (filename, chunk, embedding, '{}'))
-            
-        conn.commit()
-        cur.close()
-        conn.close()
-        return True, f"Indexado correctamente en {len(chunks)} fragmentos."
-    except Exception as e:
-        logger.error(f"Error indexando documento {filename}: {e}")
-        return False, str(e)
-
-def search_knowledge(query, top_k=3):
-    """Busca los fragmentos más relevantes para una pregunta."""
-    if not model: return []
-    
-    query_embedding = model.encode(query).tolist()
-    
-    from ...infrastructure.database.postgres import get_db_connection
-    conn = get_db_connection()
-    if not conn: return []
-    
-    try:
+        yield from text_blocks(iter_paragraphs(iter_txt_text(file_path)))
+
+def embed_chunks(chunks, batch_size=None, get_text=None):
+    """
+    Genera los embeddings por lotes (una multiplicación matricial por lote en lugar de una
+    llamada a `encode` por fragmento). Produce listas de (fragmento, vector float32) de
+    `batch_size` elementos, de modo que la memoria no depende del tamaño del documento.
+    `chunks` puede ser un generador: se consume lote a lote. `get_text` extrae el texto de
+    cada elemento si no son cadenas (p.ej. objetos `Chunk`).
+    """
+    batch_size = batch_size or EMBEDDING_BATCH_SIZE
+    model = embedding_model.get()
+    chunks = iter(chunks)
+    while True:
+        batch = list(islice(chunks, batch_size))
+        if not batch:
+            return
+        texts = [get_text(chunk) for chunk in batch] if get_text else batch
+        embeddings = model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
+        yield list(zip(batch, np.asarray(embeddings, dtype=np.float32)))
+
+def file_content_hash(file_path, block_size=1 << 20):
+    """sha256 del archivo leído por bloques (no carga el archivo entero en memoria)."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class ChunkPlan:
+    """
+    Compara en streaming los fragmentos ya indexados de un documento, [(id, chunk_hash,
+    metadata)], con los nuevos (`Chunk`). `new_chunks` deja pasar solo los fragmentos que hay
+    que calcular e insertar; los que ya existen pero han cambiado de página o sección quedan
+    en `metadata_updates` (no hace falta recalcular su embedding). Al terminar, `deleted_ids`
+    da las filas que ya no están. Un fragmento repetido solo se guarda una vez.
+    """
+
+    def __init__(self, existing):
+        self.existing = {}
+        for row_id, chunk_hash, metadata in existing:
+            self.existing.setdefault(chunk_hash, []).append((row_id, metadata))
+        self.seen = set()
+        self.metadata_updates = []
+        self.kept = 0
+        self.added = 0
+
+    def new_chunks(self, chunks):
+        for chunk in chunks:
+            chunk_hash = content_hash(chunk.text)
+            if chunk_hash in self.seen:
+                continue
+            self.seen.add(chunk_hash)
+            if chunk_hash in self.existing:
+                self.kept += 1
+                row_id, metadata = self.existing[chunk_hash][0]
+                if metadata != chunk.metadata:
+                    self.metadata_updates.append((row_id, chunk.metadata))
+            else:
+                self.added += 1
+                yield chunk_hash, chunk
+
+    def deleted_ids(self):
+        deleted = []
+        for chunk_hash, rows in self.existing.items():
+            deleted.extend(row_id for row_id, _ in (rows[1:] if chunk_hash in self.seen else rows))
+        return deleted
+
+def plan_chunk_changes(existing, chunks):
+    """(ids a borrar, [(chunk_hash, Chunk)] a insertar, nº de fragmentos conservados)."""
+    plan = ChunkPlan(existing)
+    insert = list(plan.new_chunks(chunks))
+    return plan.deleted_ids(), insert, plan.kept
+
+def _find_indexed_file(cur, file_hash):
+    cur.execute("SELECT filename, chunk_count FROM knowledge_files WHERE content_hash = %s", (file_hash,))
+    return cur.fetchone()
+
+def _unchanged_result(existing_file):
+    filename, chunk_count = existing_file
+    summary = {"unchanged": True, "added": 0, "removed": 0, "kept": chunk_count}
+    return True, f"Sin cambios: ya indexado como {filename} ({chunk_count} fragmentos).", summary
+
+def process_and_index_file(file_path, filename, batch_size=None):
+    """
+    Extrae texto, lo fragmenta y genera embeddings para la DB.
+
+    El documento se registra en `knowledge_files` con el hash de su contenido: volver a subir
+    el mismo archivo no hace nada, y una versión modificada solo calcula los embeddings de los
+    fragmentos nuevos y borra los que ya no están. Devuelve (éxito, mensaje, resumen).
+    """
+    batch_size = batch_size or EMBEDDING_BATCH_SIZE
+    from ...infrastructure.database.postgres import db_connection, to_pgvector
+
+    file_hash = file_content_hash(file_path)
+    size_bytes = os.path.getsize(file_path)
+    with db_connection() as conn:
+        if not conn: return False, "Error de conexión a DB.", None
         cur = conn.cursor()
-        # Usamos el operador <=> de pgvector (distancia coseno)
-        cur.execute("""
-            SELECT content, filename, 1 - (embedding <=> %s::vector) as similarity
-            FROM documents
-            ORDER BY embedding <=> %s::vector
-            LIMIT %s
-        """, (query_embedding, query_embedding, top_k))
-        
-        results = cur.fetchall()
+        existing_file = _find_indexed_file(cur, file_hash)
         cur.close()
-        conn.close()
-        return results
-    except Exception as e:
-        logger.error(f"Error buscando en conocimiento: {e}")
-        return []
+    if existing_file:
+        return _unchanged_result(existing_file)
+
+    if not embedding_model.get():
+        return False, "Modelo de embeddings no disponible.", None
+
+    with db_connection() as conn:
+        if not conn: return False, "Error de conexión a DB.", None
+
+        try:
+            cur = conn.cursor()
+            # Serializa las subidas del mismo archivo (y de copias idénticas) hasta el commit
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (filename,))
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (file_hash,))
+            existing_file = _find_indexed_file(cur, file_hash)
+            if existing_file:
+                conn.commit()
+                cur.close()
+                return _unchanged_result(existing_file)
+
+            cur.execute("""
+                INSERT INTO knowledge_files (filename, content_hash, size_bytes)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (filename) DO UPDATE SET filename = EXCLUDED.filename
+                RETURNING id
+            """, (filename, file_hash, size_bytes))
+            file_id = cur.fetchone()[0]
+            cur.execute("SELECT id, chunk_hash, metadata FROM documents WHERE file_id = %s ORDER BY id", (file_id,))
+            plan = ChunkPlan(cur.fetchall())
+            chunker = get_chunker(model=embedding_model.get())
+
+            # Párrafos -> fragmentos -> lotes de embeddings -> INSERT, sin tener el documento entero en memoria
+            blocks = iter_file_blocks(file_path, filename)
+            new_chunks = (chunk for _, chunk in plan.new_chunks(chunker.chunk(blocks)))
+            for batch in embed_chunks(new_chunks, batch_size, get_text=lambda chunk: chunk.text):
+                execute_values(cur, """
+                    INSERT INTO documents (filename, content, embedding, metadata, file_id, chunk_hash)
+                    VALUES %s
+                """, [(filename, chunk.text, to_pgvector(emb), Json(chunk.metadata), file_id, content_hash(chunk.text))
+                      for chunk, emb in batch],
+                    template="(%s, %s, %s::vector, %s, %s, %s)", page_size=batch_size)
+
+            if not plan.seen:
+                conn.rollback()
+                cur.close()
+                return False, "No se pudo extraer texto del archivo.", None
+            if plan.metadata_updates:
+                execute_values(cur, """
+                    UPDATE documents SET metadata = v.metadata::jsonb
+                    FROM (VALUES %s) AS v(id, metadata) WHERE documents.id = v.id
+                """, [(row_id, Json(metadata)) for row_id, metadata in plan.metadata_updates])
+            delete = plan.deleted_ids()
+            if delete:
+                cur.execute("DELETE FROM documents WHERE id = ANY(%s)", (delete,))
+            kept, added = plan.kept, plan.added
+
+            cur.execute("""
+                UPDATE knowledge_files
+                SET content_hash = %s, size_bytes = %s, chunk_count = %s, updated_at = NOW()
+                WHERE id = %s
+            """, (file_hash, size_bytes, kept + added, file_id))
+            conn.commit()
+            cur.close()
+            if delete or added:
+                # La tabla `documents` ha cambiado: los resultados cacheados ya no son válidos
+                bump_generation()
+            summary = {"unchanged": False, "added": added, "removed": len(delete), "kept": kept}
+            return True, (f"Indexado correctamente en {kept + added} fragmentos "
+                          f"({added} nuevos, {len(delete)} eliminados, {kept} sin cambios)."), summary
+        except Exception as e:
+            logger.error(f"Error indexando documento {filename}: {e}")
+            return False, str(e), None
+
+def reembed_documents(batch_size=None, rows_per_page=512):
+    """
+    Recalcula con el modelo actual los embeddings de todo el corpus (tras cambiar de modelo
+    con `swap`). Recorre `documents` por id en páginas de `rows_per_page`, cada una en su
+    propia transacción, así que puede interrumpirse y volver a lanzarse. Devuelve el nº de
+    fragmentos actualizados, o None si falla.
+    """
+    from ...infrastructure.database.postgres import db_connection, to_pgvector
+
+    last_id, updated = 0, 0
+    while True:
+        with db_connection() as conn:
+            if not conn: return None
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT id, content FROM documents WHERE id > %s ORDER BY id LIMIT %s",
+                            (last_id, rows_per_page))
+                rows = cur.fetchall()
+                if not rows:
+                    cur.close()
+                    break
+                for batch in embed_chunks(rows, batch_size, get_text=lambda row: row[1] or ""):
+                    execute_values(cur, """
+                        UPDATE documents d SET embedding = v.embedding::vector
+                        FROM (VALUES %s) AS v(id, embedding) WHERE d.id = v.id
+                    """, [(row[0], to_pgvector(emb)) for row, emb in batch])
+                conn.commit()
+                cur.close()
+            except Exception as e:
+                logger.error(f"Error recalculando embeddings del conocimiento: {e}")
+                return None
+        last_id = rows[-1][0]
+        updated += len(rows)
+    # Los resultados cacheados se calcularon con los vectores anteriores
+    bump_generation()
+    logger.info(f"Embeddings recalculados: {updated} fragmentos.")
+    return updated
+
+def embed_texts(texts):
+    """
+    Embeddings normalizados (float32, norma 1) de varios textos, reutilizando los de la
+    caché y calculando los que faltan en un solo `encode`. None si el modelo no está disponible.
+    """
+    keys = [content_hash(t) for t in texts]
+    vectors = [embedding_cache.get(k) for k in keys]
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    if missing:
+        model = embedding_model.get()
+        if not model: return None
+        encoded = model.encode([texts[i] for i in missing], batch_size=EMBEDDING_BATCH_SIZE)
+        for i, vector in zip(missing, encoded):
+            vectors[i] = vector.tolist()
+            embedding_cache.put(keys[i], vectors[i])
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
@@ -0,0 +1,155 @@
+import os
+import gc
+import time
+import logging
+import threading
+
+from .cache import embedding_cache, bump_generation
+
+logger = logging.getLogger("KnowledgeBase")
+
+# 384 dimensiones - all-MiniLM-L6-v2 (ligero y rápido para CPU)
+DEFAULT_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+# Cross-encoder para re-ordenar los candidatos del RAG (vacío = sin re-ranking)
+DEFAULT_RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+# Tras un fallo de carga (p.ej. sin red para descargar el modelo) no se reintenta antes de este tiempo
+RETRY_AFTER_SECS = 60
+# Ajuste (tabla settings) con el modelo elegido en caliente: sobrevive a los reinicios
+MODEL_SETTING = "EMBEDDING_MODEL"
+
+
+class EmbeddingModelProvider:
+    """
+    Carga perezosa y segura entre hilos del SentenceTransformer.
+
+    Importar torch y cargar el modelo cuesta segundos, así que no se hace al importar el
+    módulo sino en el primer uso (o en el warm-up lanzado desde `main.lifespan`).
+    El modelo puede sustituirse en caliente (`swap`) o liberarse (`unload`). Con
+    `setting_key` el modelo elegido se guarda en `settings` y se usa en los siguientes
+    arranques; con `dimensions` se rechazan los modelos de otra dimensión.
+    """
+
+    def __init__(self, model_name=DEFAULT_MODEL, setting_key=None, dimensions=None):
+        self.model_name = model_name
+        self.setting_key = setting_key
+        self.dimensions = dimensions
+        self._name_resolved = setting_key is None
+        self._model = None
+        self._lock = threading.Lock()
+        self.state = "not_loaded"
+        self.load_seconds = None
+        self.last_error = None
+        self._failed_at = None
+
+    def _load(self, model_name):
+        from sentence_transformers import SentenceTransformer
+
+        start = time.perf_counter()
+        model = SentenceTransformer(model_name)
+        elapsed = time.perf_counter() - start
+        logger.info(f"Modelo de embeddings {model_name} cargado en {elapsed:.2f}s.")
+        return model, elapsed
+
+    def get(self):
+        """Devuelve el modelo, cargándolo si hace falta. None si no se pudo cargar."""
+        model = self._model
+        if model is not None:
+            return model
+        with self._lock:
+            if self._model is not None:
+                return self._model
+            if self._failed_at and time.monotonic() - self._failed_at < RETRY_AFTER_SECS:
+                return None
+            self.state = "loading"
+            try:
+                self._resolve_name()
+                self._model, self.load_seconds = self._load(self.model_name)
+                self.state = "loaded"
+                self.last_error = None
+                self._failed_at = None
+            except Exception as e:
+                logger.error(f"Error cargando modelo de embeddings: {e}")
+                self.state = "failed"
+                self.last_error = str(e)
+                self._failed_at = time.monotonic()
+            return self._model
+
+    def _resolve_name(self):
+        # El modelo guardado por un `swap` anterior manda sobre EMBEDDING_MODEL
+        if self._name_resolved:
+            return
+        from ...infrastructure.database.postgres import get_setting
+        self.model_name = get_setting(self.setting_key, self.model_name) or self.model_name
+        self._name_resolved = True
+
+    def warm_up(self):
+        """Carga el modelo en segundo plano para que la primera búsqueda no pague la carga."""
+        return self.get() is not None
+
+    def swap(self, model_name):
+        """
+        Sustituye el modelo por otro. El nuevo se carga antes de retirar el actual, así que
+        las búsquedas en curso no se quedan sin modelo. Debe producir vectores de la misma
+        dimensión que la columna `documents.embedding` (ValueError si no). Los embeddings
+        ya indexados son del modelo anterior: hay que recalcularlos (`reembed_documents`).
+        """
+        model, elapsed = self._load(model_name)
+        dimensions = model.get_sentence_embedding_dimension() if self.dimensions else None
+        if dimensions is not None and dimensions != self.dimensions:
+            raise ValueError(
+                f"{model_name} genera vectores de {dimensions} dimensiones; "
+                f"la columna documents.embedding es de {self.dimensions}"
+            )
+        if self.setting_key:
+            from ...infrastructure.database.postgres import save_setting
+            save_setting(self.setting_key, model_name)
+        with self._lock:
+            self._name_resolved = True
+            self._model = model
+            self.model_name = model_name
+            self.load_seconds = elapsed
+            self.state = "loaded"
+            self.last_error = None
+            self._failed_at = None
+        # Los embeddings y resultados cacheados pertenecen al modelo anterior
+        embedding_cache.clear()
+        bump_generation()
+        return True
+
+    def unload(self):
+        """Libera la memoria del modelo; se volverá a cargar en el siguiente uso."""
+        with self._lock:
+            self._model = None
+            self.state = "unloaded"
+        embedding_cache.clear()
+        gc.collect()
+
+    def stats(self):
+        return {
+            "model": self.model_name,
+            "state": self.state,
+            "load_seconds": round(self.load_seconds, 3) if self.load_seconds is not None else None,
+            "last_error": self.last_error,
+        }
+
+
+class RerankerProvider(EmbeddingModelProvider):
+    """Igual que `EmbeddingModelProvider` pero carga un `CrossEncoder` (puntúa pares consulta-fragmento)."""
+
+    def _load(self, model_name):
+        from sentence_transformers import CrossEncoder
+
+        start = time.perf_counter()
+        model = CrossEncoder(model_name)
+        elapsed = time.perf_counter() - start
+        logger.info(f"Modelo de re-ranking {model_name} cargado en {elapsed:.2f}s.")
+        return model, elapsed
+
+
+def _embedding_dimensions():
+    from ...infrastructure.database.postgres import EMBEDDING_DIMENSIONS
+    return EMBEDDING_DIMENSIONS
+
+
+embedding_model = EmbeddingModelProvider(setting_key=MODEL_SETTING, dimensions=_embedding_dimensions())
+reranker_model = RerankerProvider(DEFAULT_RERANK_MODEL) if DEFAULT_RERANK_MODEL else None
@@ -0,0 +1,216 @@
+import os
+import re
+import json
+import math
+import logging
+
+import numpy as np
+
+from .cache import content_hash, embedding_cache, result_cache, current_generation
+from .model_provider import embedding_model, reranker_model
+
+logger = logging.getLogger("KnowledgeBase")
+
+# Candidatos que aporta cada buscador (vectorial y de texto completo) antes de re-ordenar
+RAG_CANDIDATES = int(os.getenv("RAG_CANDIDATES", "20"))
+# Presupuesto de contexto del prompt (tokens del LLM) y nº máximo de fragmentos
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1024"))
+RAG_MAX_SNIPPETS = int(os.getenv("RAG_MAX_SNIPPETS", "5"))
+# Similitud coseno a partir de la cual dos fragmentos se consideran casi duplicados
+RAG_DEDUP_THRESHOLD = float(os.getenv("RAG_DEDUP_THRESHOLD", "0.95"))
+# Estimación de caracteres por token del LLM (Llama con texto en español)
+LLM_CHARS_PER_TOKEN = 3.5
+# Recall/latencia de la búsqueda vectorial aproximada (vacío = valor del servidor)
+VECTOR_EF_SEARCH = int(os.getenv("VECTOR_EF_SEARCH") or 0) or None
+IVFFLAT_PROBES = int(os.getenv("IVFFLAT_PROBES") or 0) or None
+# Constante de Reciprocal Rank Fusion y términos de la consulta usados en la búsqueda léxica
+RRF_K = 60
+LEXICAL_QUERY_TERMS = 32
+
+KNOWLEDGE_QUERY_SQL = (
+    "replace((websearch_to_tsquery('spanish', %(q)s) || websearch_to_tsquery('english', %(q)s))::text,"
+    " ' & ', ' | ')::tsquery"
+)
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / LLM_CHARS_PER_TOKEN)
+
+
+def lexical_query(text, max_terms=LEXICAL_QUERY_TERMS):
+    """
+    Términos de la consulta para `websearch_to_tsquery` (unidos luego con OR): solo palabras,
+    sin repetir, para que un correo con comillas o guiones no genere frases o negaciones.
+    """
+    terms = []
+    for word in re.findall(r"\w{3,}", text.lower()):
+        if word not in terms and not word.isdigit():
+            terms.append(word)
+        if len(terms) >= max_terms:
+            break
+    return " ".join(terms)
+
+
+def fuse_ranks(candidates, k=RRF_K):
+    """
+    Reciprocal Rank Fusion: puntúa cada candidato con 1/(k + posición) en el ranking vectorial
+    más lo mismo en el de texto completo (si aparece en él).
+    """
+    by_vector = sorted(candidates, key=lambda c: c["similarity"], reverse=True)
+    by_text = sorted((c for c in candidates if c["text_rank"]), key=lambda c: c["text_rank"], reverse=True)
+    for c in candidates:
+        c["fusion"] = 0.0
+    for position, c in enumerate(by_vector, 1):
+        c["fusion"] += 1 / (k + position)
+    for position, c in enumerate(by_text, 1):
+        c["fusion"] += 1 / (k + position)
+    return candidates
+
+
+def rerank(query, candidates, model=None):
+    """Ordena los candidatos por la puntuación del cross-encoder (o por la fusión si no hay modelo)."""
+    if model is not None and candidates:
+        scores = model.predict([(query, c["content"]) for c in candidates])
+        for c, score in zip(candidates, scores):
+            c["score"] = float(score)
+    else:
+        for c in candidates:
+            c["score"] = c["fusion"]
+    return sorted(candidates, key=lambda c: c["score"], reverse=True)
+
+
+def drop_near_duplicates(candidates, threshold=RAG_DEDUP_THRESHOLD):
+    """Quita los candidatos casi idénticos a otro mejor puntuado (p.ej. el solape entre fragmentos)."""
+    kept, vectors = [], []
+    for c in candidates:
+        vector = c.get("embedding")
+        if vector is not None and vectors and max(float(v @ vector) for v in vectors) >= threshold:
+            continue
+        kept.append(c)
+        if vector is not None:
+            vectors.append(vector)
+    return kept
+
+
+def truncate_to_tokens(text, tokens):
+    """Recorta el texto a `tokens` estimados, por el final de frase más cercano si lo hay."""
+    limit = int(tokens * LLM_CHARS_PER_TOKEN)
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    end = max(cut.rfind(". "), cut.rfind(".\n"), cut.rfind("\n"))
+    return (cut[:end + 1] if end > limit // 2 else cut).rstrip() + " …"
+
+
+def pack_context(candidates, budget=RAG_CONTEXT_TOKENS, max_snippets=RAG_MAX_SNIPPETS):
+    """
+    Mete los mejores fragmentos en `budget` tokens: en orden de puntuación, salta los que no
+    caben y sigue con los siguientes. Si ni el mejor cabe entero, se recorta.
+    """
+    packed, used = [], 0
+    for c in candidates:
+        if len(packed) >= max_snippets:
+            break
+        tokens = estimate_tokens(c["content"])
+        if used + tokens > budget:
+            if packed:
+                continue
+            c = {**c, "content": truncate_to_tokens(c["content"], budget)}
+            tokens = estimate_tokens(c["content"])
+        packed.append({**c, "tokens": tokens})
+        used += tokens
+    return packed
+
+
+def _parse_vector(text):
+    vector = np.asarray(json.loads(text), dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def fetch_candidates(query, query_embedding, limit=RAG_CANDIDATES, ef_search=None, probes=None):
+    """
+    Unión de los `limit` fragmentos más cercanos por embedding y los `limit` mejores por tsvector.
+    `ef_search` (HNSW) y `probes` (IVFFlat) ajustan el equilibrio recall/latencia de la parte vectorial.
+    """
+    ef_search = ef_search or VECTOR_EF_SEARCH
+    probes = probes or IVFFLAT_PROBES
+    from ...infrastructure.database.postgres import db_connection
+    from psycopg2.extras import RealDictCursor
+
+    with db_connection() as conn:
+        if not conn: return []
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            # Parámetros locales a esta transacción (no afectan a otras consultas del pool)
+            if ef_search:
+                cur.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(int(ef_search)),))
+            if probes:
+                cur.execute("SELECT set_config('ivfflat.probes', %s, true)", (str(int(probes)),))
+            cur.execute(f"""
+                WITH q AS (SELECT {KNOWLEDGE_QUERY_SQL} AS query),
+                vec AS (
+                    SELECT id FROM documents
+                    ORDER BY embedding <=> %(emb)s::vector
+                    LIMIT %(limit)s
+                ),
+                lex AS (
+                    SELECT d.id, ts_rank_cd(d.search_vector, q.query, 32) AS text_rank
+                    FROM documents d, q
+                    WHERE d.search_vector @@ q.query
+                    ORDER BY text_rank DESC
+                    LIMIT %(limit)s
+                )
+                SELECT d.id, d.content, d.filename, d.metadata,
+                       1 - (d.embedding <=> %(emb)s::vector) AS similarity,
+                       lex.text_rank, d.embedding::text AS embedding
+                FROM documents d
+                LEFT JOIN lex ON lex.id = d.id
+                WHERE d.id IN (SELECT id FROM vec UNION SELECT id FROM lex)
+            """, {"q": lexical_query(query), "emb": query_embedding, "limit": limit})
+            rows = cur.fetchall()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error buscando candidatos en conocimiento: {e}")
+            return []
+    for r in rows:
+        r["similarity"] = float(r["similarity"])
+        r["text_rank"] = float(r["text_rank"]) if r["text_rank"] is not None else None
+        r["embedding"] = _parse_vector(r["embedding"])
+    return rows
+
+
+def retrieve_context(query, budget=None, max_snippets=None, candidates=None, ef_search=None, probes=None):
+    """
+    Contexto RAG para una consulta: candidatos vectoriales + texto completo, fusionados,
+    re-ordenados con el cross-encoder, sin casi duplicados y empaquetados en `budget` tokens.
+    `ef_search` (HNSW) y `probes` (IVFFlat) ajustan por consulta el recall de la parte vectorial.
+    Devuelve dicts con content, filename, metadata, similarity, score y tokens.
+    """
+    budget = budget or RAG_CONTEXT_TOKENS
+    max_snippets = max_snippets or RAG_MAX_SNIPPETS
+    candidates = candidates or RAG_CANDIDATES
+    ef_search = ef_search or VECTOR_EF_SEARCH
+    probes = probes or IVFFLAT_PROBES
+
+    query_key = content_hash(query)
+    result_key = (query_key, "hybrid", budget, max_snippets, candidates, ef_search, probes, current_generation())
+    cached = result_cache.get(result_key)
+    if cached is not None:
+        return list(cached)
+
+    query_embedding = embedding_cache.get(query_key)
+    if query_embedding is None:
+        model = embedding_model.get()
+        if not model: return []
+        query_embedding = model.encode(query).tolist()
+        embedding_cache.put(query_key, query_embedding)
+
+    found = fetch_candidates(query, query_embedding, candidates, ef_search, probes)
+    ranked = rerank(query, fuse_ranks(found), reranker_model.get() if reranker_model else None)
+    packed = pack_context(drop_near_duplicates(ranked), budget, max_snippets)
+    results = [{k: v for k, v in c.items() if k != "embedding"} for c in packed]
+    logger.info(f"Contexto RAG: {len(found)} candidatos -> {len(results)} fragmentos, "
+                f"{sum(r['tokens'] for r in results)}/{budget} tokens")
+    result_cache.put(result_key, tuple(results))
+    return results
@@ -1,79 +1,357 @@
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor, execute_values, Json
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 import os
+import re
+import json
+import math
+import time
 import logging
+import threading
+from datetime import datetime
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
 load_dotenv()
 
 logger = logging.getLogger("Database")
 
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(
-            host=os.getenv("DB_HOST", "localhost"),
-            database=os.getenv("DB_NAME", "knowledge_base"),
-            user=os.getenv("DB_USER", "email_ai_user"),
-            password=os.getenv("DB_PASS", "super_secreto"),
-            port=os.getenv("DB_PORT", "5432")
-        )
+# Dimensión de `documents.embedding`: todo modelo de embeddings debe producir vectores de este tamaño
+EMBEDDING_DIMENSIONS = 384
+
+def _connect_kwargs():
+    return dict(
+        host=os.getenv("DB_HOST", "localhost"),
+        database=os.getenv("DB_NAME", "knowledge_base"),
+        user=os.getenv("DB_USER", "email_ai_user"),
+        password=os.getenv("DB_PASS", "super_secreto"),
+        port=os.getenv("DB_PORT", "5432")
+    )
+
+
+class KeepIdleConnectionPool(ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool cierra toda conexión devuelta si ya guarda `minconn` inactivas,
+    así que con DB_POOL_MIN bajo cada pico de concurrencia reconectaba (TCP + auth) en cada
+    préstamo. Esta versión abre `minconn` al arrancar y conserva hasta `maxconn` inactivas.
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        # Tras abrir las iniciales, `minconn` solo decide cuántas inactivas se conservan al devolverlas
+        self.minconn = self.maxconn
+
+
+class ConnectionPool:
+    """
+    Pool de conexiones compartido por todo el proceso (hilos del loop y de FastAPI).
+
+    ThreadedConnectionPool lanza PoolError si se agota, así que un semáforo hace esperar
+    a los hilos hasta `DB_POOL_TIMEOUT` segundos. Las conexiones cerradas o inactivas
+    más de `DB_POOL_HEALTHCHECK_SECS` se validan con `SELECT 1` antes de prestarlas.
+    """
+
+    def __init__(self, minconn=None, maxconn=None, timeout=None, healthcheck_secs=None):
+        self.minconn = minconn or int(os.getenv("DB_POOL_MIN", "1"))
+        self.maxconn = maxconn or int(os.getenv("DB_POOL_MAX", "10"))
+        self.timeout = timeout or float(os.getenv("DB_POOL_TIMEOUT", "10"))
+        self.healthcheck_secs = healthcheck_secs or float(os.getenv("DB_POOL_HEALTHCHECK_SECS", "30"))
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.maxconn)
+        self._last_used = {}
+        self.in_use = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.discarded = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = KeepIdleConnectionPool(self.minconn, self.maxconn, **_connect_kwargs())
+            return self._pool
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        last = self._last_used.get(conn)
+        if last is not None and time.monotonic() - last < self.healthcheck_secs:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            self.timeouts += 1
+            raise PoolError(f"Sin conexiones libres tras {self.timeout}s (DB_POOL_MAX={self.maxconn})")
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            while not self._healthy(conn):
+                self.discarded += 1
+                self._last_used.pop(conn, None)
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        waited = time.monotonic() - start
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
         return conn
+
+    def putconn(self, conn):
+        try:
+            broken = conn.closed != 0
+            if not broken and conn.status != psycopg2.extensions.STATUS_READY:
+                # Transacción sin confirmar (error o falta de commit): no la dejamos abierta en el pool
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            if broken:
+                self.discarded += 1
+            else:
+                self._last_used[conn] = time.monotonic()
+            self._get_pool().putconn(conn, close=broken)
+            if conn.closed:
+                # Cerrada aquí o por el pool: sin entrada que la mantenga viva en memoria
+                self._last_used.pop(conn, None)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def closeall(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+            self._last_used.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "in_use": self.in_use,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "discarded": self.discarded,
+                "wait_avg_ms": round(1000 * self.wait_total / self.checkouts, 2) if self.checkouts else 0.0,
+                "wait_max_ms": round(1000 * self.wait_max, 2),
+            }
+
+
+pool = ConnectionPool()
+
+
+@contextmanager
+def db_connection():
+    """
+    Presta una conexión del pool y la devuelve al salir del bloque.
+    Produce None si la base de datos no está disponible (los helpers devuelven su valor por defecto).
+    """
+    try:
+        conn = pool.getconn()
     except Exception as e:
         logger.error(f"Error conectando a la base de datos: {e}")
-        return None
+        yield None
+        return
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
 
 def init_db():
-    conn = get_db_connection()
-    if not conn:
-        return False
-    
-    try:
-        cur = conn.cursor()
-        # Habilitar extensión pgvector si no existe
-        cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-        
-        # Crear tabla de ajustes si no existe
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT,
-                updated_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
-        # Crear tabla de correos si no existe
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS emails (
-                id TEXT PRIMARY KEY,
-                subject TEXT,
-                sender TEXT,
-                body TEXT,
-                date TIMESTAMP,
-                is_read BOOLEAN DEFAULT FALSE,
-                ai_response TEXT,
-                status TEXT DEFAULT 'PENDIENTE',
-                processed_at TIMESTAMP
-            );
-        """)
-        # Crear tabla de documentos de conocimiento (RAG)
-        # 384 dimensiones es el estándar para el modelo all-MiniLM-L6-v2 que usaremos
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS documents (
-                id SERIAL PRIMARY KEY,
-                filename TEXT,
-                content TEXT,
-                embedding vector(384),
-                metadata JSONB,
-                created_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
-        conn.commit()
-        cur.close()
-        conn.close()
-        logger.info("Base de datos inicializada correctamente.")
-        return True
-    except Exception as e:
-        logger.error(f"Error inicializando base de datos: {e}")
-        return False
+    with db_connection() as conn:
+        if not conn:
+            return False
+
+        try:
+            cur = conn.cursor()
+            # Habilitar extensión pgvector si no existe
+            cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+
+            # Crear tabla de ajustes si no existe
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    updated_at TIMESTAMP DEFAULT NOW()
+                );
+            """)
+            # Crear tabla de correos si no existe
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS emails (
+                    id TEXT PRIMARY KEY,
+                    subject TEXT,
+                    sender TEXT,
+                    body TEXT,
+                    date TIMESTAMP,
+                    is_read BOOLEAN DEFAULT FALSE,
+                    ai_response TEXT,
+                    status TEXT DEFAULT 'PENDIENTE',
+                    processed_at TIMESTAMP
+                );
+            """)
+            # Registro de buzones: credenciales propias (vacías = ajustes globales EXCHANGE_*) y estado de sync
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS mailboxes (
+                    id SERIAL PRIMARY KEY,
+                    address TEXT NOT NULL UNIQUE,
+                    display_name TEXT,
+                    tenant TEXT NOT NULL DEFAULT 'default',
+                    username TEXT,
+                    password TEXT,
+                    server TEXT,
+                    enabled BOOLEAN NOT NULL DEFAULT TRUE,
+                    sync_state TEXT,
+                    last_sync_at TIMESTAMP,
+                    last_sync JSONB,
+                    last_error TEXT,
+                    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+                );
+            """)
+            # Cada correo pertenece a un buzón; el listado y la reconciliación van siempre por buzón
+            cur.execute("ALTER TABLE emails ADD COLUMN IF NOT EXISTS mailbox_id INT REFERENCES mailboxes(id) ON DELETE CASCADE;")
+            # Los índices del listado ordenan por la fecha con los correos sin fecha al final (ver EMAIL_SORT_DATE_SQL)
+            cur.execute("DROP INDEX IF EXISTS emails_mailbox_date_idx;")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS emails_mailbox_sort_idx ON emails (mailbox_id, ({EMAIL_SORT_DATE_SQL}) DESC, id DESC);")
+            _register_default_mailbox(cur)
+            # Marca de borrado lógico (tombstone) usada por la reconciliación en modo "soft"
+            cur.execute("ALTER TABLE emails ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;")
+            # Cuándo se pidió el cuerpo a Exchange: los vacíos o ya borrados del servidor no se vuelven a pedir
+            cur.execute("ALTER TABLE emails ADD COLUMN IF NOT EXISTS body_fetched_at TIMESTAMP;")
+            # Paginación keyset (date, id) del listado y filtro por estado
+            cur.execute("DROP INDEX IF EXISTS emails_date_id_idx;")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS emails_sort_idx ON emails (({EMAIL_SORT_DATE_SQL}) DESC, id DESC);")
+            cur.execute("CREATE INDEX IF NOT EXISTS emails_status_idx ON emails (status);")
+            # Búsqueda de texto completo: columna generada (asunto > remitente > cuerpo) con índice GIN
+            cur.execute(f"ALTER TABLE emails ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ({EMAIL_SEARCH_VECTOR_SQL}) STORED;")
+            cur.execute("CREATE INDEX IF NOT EXISTS emails_search_idx ON emails USING GIN (search_vector);")
+            # Crear tabla de documentos de conocimiento (RAG)
+            # 384 dimensiones es el estándar para el modelo all-MiniLM-L6-v2 que usaremos
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS documents (
+                    id SERIAL PRIMARY KEY,
+                    filename TEXT,
+                    content TEXT,
+                    embedding vector({EMBEDDING_DIMENSIONS}),
+                    metadata JSONB,
+                    created_at TIMESTAMP DEFAULT NOW()
+                );
+            """)
+            # Registro de documentos de conocimiento: uno por archivo, identificado por el hash de su contenido
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS knowledge_files (
+                    id SERIAL PRIMARY KEY,
+                    filename TEXT NOT NULL UNIQUE,
+                    content_hash TEXT NOT NULL UNIQUE,
+                    size_bytes BIGINT NOT NULL DEFAULT 0,
+                    chunk_count INT NOT NULL DEFAULT 0,
+                    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+                );
+            """)
+            # Cada fragmento apunta a su documento y guarda el hash de su texto (re-indexación incremental)
+            cur.execute("ALTER TABLE documents ADD COLUMN IF NOT EXISTS file_id INT REFERENCES knowledge_files(id) ON DELETE CASCADE;")
+            cur.execute("ALTER TABLE documents ADD COLUMN IF NOT EXISTS chunk_hash TEXT;")
+            cur.execute("CREATE INDEX IF NOT EXISTS documents_file_chunk_idx ON documents (file_id, chunk_hash);")
+            # Fragmentos indexados antes del registro: un documento por filename con un hash provisional
+            cur.execute("""
+                INSERT INTO knowledge_files (filename, content_hash, size_bytes, chunk_count, created_at)
+                SELECT filename, 'legacy:' || md5(filename || string_agg(content, '' ORDER BY id)),
+                       SUM(octet_length(content)), COUNT(*), MIN(created_at)
+                FROM documents WHERE file_id IS NULL
+                GROUP BY filename
+                ON CONFLICT (filename) DO NOTHING;
+            """)
+            cur.execute(f"""
+                UPDATE documents d SET file_id = f.id, chunk_hash = {CHUNK_HASH_SQL}
+                FROM knowledge_files f
+                WHERE d.file_id IS NULL AND d.filename = f.filename;
+            """)
+            # Candidatos léxicos del RAG híbrido: tsvector generado del fragmento con índice GIN
+            cur.execute(f"ALTER TABLE documents ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ({DOCUMENT_SEARCH_VECTOR_SQL}) STORED;")
+            cur.execute("CREATE INDEX IF NOT EXISTS documents_search_idx ON documents USING GIN (search_vector);")
+            # Estado de la aplicación compartido entre workers (APP_STATE_BACKEND=postgres): una sola fila
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS app_state (
+                    id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+                    data JSONB NOT NULL DEFAULT '{}'::jsonb,
+                    version BIGINT NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+                );
+            """)
+            cur.execute("INSERT INTO app_state (id) VALUES (1) ON CONFLICT DO NOTHING;")
+            # Cola persistente de trabajos (generación de respuestas en segundo plano)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id BIGSERIAL PRIMARY KEY,
+                    kind TEXT NOT NULL DEFAULT 'generate_answer',
+                    email_id TEXT NOT NULL,
+                    payload JSONB NOT NULL DEFAULT '{}'::jsonb,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    attempts INT NOT NULL DEFAULT 0,
+                    max_attempts INT NOT NULL DEFAULT 3,
+                    error TEXT,
+                    worker TEXT,
+                    run_after TIMESTAMP NOT NULL DEFAULT NOW(),
+                    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    started_at TIMESTAMP,
+                    finished_at TIMESTAMP
+                );
+            """)
+            # Los workers solo recorren los trabajos en cola; un correo no puede tener dos trabajos activos
+            cur.execute("CREATE INDEX IF NOT EXISTS jobs_queued_idx ON jobs (run_after, id) WHERE status = 'queued';")
+            cur.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_email_idx
+                ON jobs (kind, email_id) WHERE status IN ('queued', 'running');
+            """)
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error inicializando base de datos: {e}")
+            return False
+
+    # Índice ANN para que la búsqueda RAG no haga un escaneo secuencial de todos los fragmentos
+    ensure_vector_index()
+    logger.info("Base de datos inicializada correctamente.")
+    return True
+
+def _register_default_mailbox(cur):
+    """
+    Registra el buzón de los ajustes EXCHANGE_USER (instalaciones de un solo buzón) y le
+    asigna los correos y el SyncState guardados antes de existir el registro.
+    """
+    cur.execute("SELECT value FROM settings WHERE key = 'EXCHANGE_USER'")
+    row = cur.fetchone()
+    address = (row[0] if row else None) or os.getenv("EXCHANGE_USER")
+    if not address:
+        return
+    cur.execute("""
+        INSERT INTO mailboxes (address, sync_state)
+        VALUES (%s, (SELECT value FROM settings WHERE key = %s))
+        ON CONFLICT (address) DO NOTHING
+    """, (address, f"SYNC_STATE:{address}"))
+    cur.execute("""
+        UPDATE emails SET mailbox_id = (SELECT id FROM mailboxes WHERE address = %s)
+        WHERE mailbox_id IS NULL
+    """, (address,))
 
 def clean_html(html_content):
     if not html_content:
@@ -87,190 +365,1197 @@ def clean_html(html_content):
     clean = clean.replace('&nbsp;', ' ').replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
     return clean.strip()
 
-def upsert_email(email_data):
-    conn = get_db_connection()
-    if not conn:
-        return
-    
-    try:
-        # Extraer y limpiar body si es necesario
-        new_body = email_data.get('body', '')
-        if '<' in new_body and '>' in new_body:
-            new_body = clean_html(new_body)
-
-        cur = conn.cursor()
-        # Usamos COALESCE y NULLIF para no machacar un cuerpo existente si el nuevo viene vacío
-        cur.execute("""
-            INSERT INTO emails (id, subject, sender, body, date, is_read)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            ON CONFLICT (id) DO UPDATE SET
-                subject = EXCLUDED.subject,
-                sender = EXCLUDED.sender,
-                body = CASE 
-                    WHEN EXCLUDED.body <> '' THEN EXCLUDED.body 
-                    ELSE emails.body 
-                END,
-                date = EXCLUDED.date,
-                is_read = EXCLUDED.is_read;
-        """, (
-            email_data['id'],
-            email_data['subject'],
-            email_data['sender'],
-            new_body,
-            email_data['date'],
-            email_data.get('is_read', False)
-        ))
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Error haciendo upsert de email: {e}")
+# Nunca machacamos un cuerpo existente con uno vacío, ni el flag de leído si el correo no lo trae
+UPSERT_EMAILS_SQL = """
+    INSERT INTO emails (id, subject, sender, body, date, is_read, mailbox_id)
+    VALUES %s
+    ON CONFLICT (id) DO UPDATE SET
+        mailbox_id = COALESCE(EXCLUDED.mailbox_id, emails.mailbox_id),
+        subject = EXCLUDED.subject,
+        sender = EXCLUDED.sender,
+        body = CASE 
+            WHEN EXCLUDED.body <> '' THEN EXCLUDED.body 
+            ELSE emails.body 
+        END,
+        date = EXCLUDED.date,
+        is_read = COALESCE(EXCLUDED.is_read, emails.is_read),
+        deleted_at = NULL;
+"""
+
+def _email_row(email_data, mailbox_id=None):
+    # Extraer y limpiar body si es necesario
+    new_body = email_data.get('body') or ''
+    if '<' in new_body and '>' in new_body:
+        new_body = clean_html(new_body)
+    return (
+        email_data['id'],
+        email_data['subject'],
+        email_data['sender'],
+        new_body,
+        email_data['date'],
+        email_data.get('is_read'),
+        mailbox_id
+    )
+
+def upsert_emails(emails, page_size=1000, mailbox_id=None):
+    """
+    Inserta o actualiza un lote de correos del buzón `mailbox_id` en una sola transacción
+    (execute_values). Devuelve el número de filas escritas.
+    """
+    # ON CONFLICT no admite tocar la misma fila dos veces en una sentencia: nos quedamos con la última versión
+    rows = list({e['id']: _email_row(e, mailbox_id) for e in emails}.values())
+    if not rows:
+        return 0
+    with db_connection() as conn:
+        if not conn:
+            return 0
+        try:
+            cur = conn.cursor()
+            execute_values(cur, UPSERT_EMAILS_SQL, rows, page_size=page_size)
+            conn.commit()
+            invalidate_email_counts()
+            cur.close()
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Error haciendo upsert masivo de {len(rows)} emails: {e}")
+            return 0
+
+def upsert_email(email_data, mailbox_id=None):
+    upsert_emails([email_data], mailbox_id=mailbox_id)
 
 def reset_emails_table():
     """Borra todos los correos de la base de datos para forzar una resincronización limpia."""
-    conn = get_db_connection()
-    if not conn: return
-    try:
-        cur = conn.cursor()
-        cur.execute("TRUNCATE TABLE emails;")
-        conn.commit()
-        cur.close()
-        conn.close()
-        logger.info("Tabla de correos vaciada (Reset).")
-    except Exception as e:
-        logger.error(f"Error en reset_emails_table: {e}")
+    with db_connection() as conn:
+        if not conn: return
+        try:
+            cur = conn.cursor()
+            cur.execute("TRUNCATE TABLE emails;")
+            conn.commit()
+            invalidate_email_counts()
+            cur.close()
+            logger.info("Tabla de correos vaciada (Reset).")
+        except Exception as e:
+            logger.error(f"Error en reset_emails_table: {e}")
 
-def get_emails_from_db(offset=0, limit=10):
-    conn = get_db_connection()
-    if not conn:
-        return {"emails": [], "total": 0}
-    
-    try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        # Obtener emails
-        cur.execute("SELECT * FROM emails ORDER BY date DESC LIMIT %s OFFSET %s", (limit, offset))
-        emails = cur.fetchall()
-        
-        # Obtener total
-        cur.execute("SELECT COUNT(*) as total FROM emails")
-        res = cur.fetchone()
-        total = res['total'] if res else 0
-        
-        cur.close()
-        conn.close()
-        
-        # Convertir objetos datetime a string para JSON
-        for e in emails:
-            if e['date']:
-                e['date'] = e['date'].strftime("%Y-%m-%d %H:%M:%S")
-            if e['processed_at']:
-                e['processed_at'] = e['processed_at'].strftime("%Y-%m-%d %H:%M:%S")
-        
-        return {"emails": emails, "total": total}
-    except Exception as e:
-        logger.error(f"Error leyendo de DB: {e}")
-        return {"emails": [], "total": 0}
+# Columnas del listado: sin `body` ni `ai_response`, que pueden ocupar decenas de KB por fila
+EMAIL_LIST_COLUMNS = (
+    "id, subject, sender, date, is_read, status, processed_at, "
+    "(ai_response IS NOT NULL AND ai_response <> '') AS has_draft, "
+    "(SELECT address FROM mailboxes m WHERE m.id = emails.mailbox_id) AS mailbox"
+)
+# Clave de orden del listado: un correo sin fecha cuenta como el más antiguo (va al final y
+# sigue siendo comparable en el cursor keyset, a diferencia de NULL)
+EMAIL_SORT_DATE_SQL = "COALESCE(date, '-infinity'::timestamp)"
+# Filtro por buzón a partir de su dirección (el planificador lo resuelve una vez, como initplan)
+MAILBOX_FILTER_SQL = "mailbox_id = (SELECT id FROM mailboxes WHERE address = %s)"
+# Recuento del listado: exacto y cacheado unos segundos; en tablas grandes, estimación del planificador
+EMAIL_COUNT_TTL = float(os.getenv("EMAIL_COUNT_TTL", "30"))
+EMAIL_EXACT_COUNT_LIMIT = int(os.getenv("EMAIL_EXACT_COUNT_LIMIT", "100000"))
+
+_email_counts = {}
+_email_counts_lock = threading.Lock()
+
+def invalidate_email_counts():
+    with _email_counts_lock:
+        _email_counts.clear()
+
+def parse_email_cursor(cursor):
+    """
+    Convierte el cursor `<fecha ISO>,<id>` de `before` en (datetime, id); una fecha vacía
+    es un correo sin fecha (None). Lanza ValueError si no es válido.
+    """
+    raw_date, sep, email_id = (cursor or "").partition(",")
+    if not sep or not email_id:
+        raise ValueError(f"Cursor inválido: {cursor!r}")
+    return (datetime.fromisoformat(raw_date) if raw_date else None), email_id
+
+def email_cursor(email):
+    date = email.get('date')
+    return f"{date.isoformat() if date else ''},{email['id']}"
+
+def build_email_filters(status=None, sender=None, is_read=None, date_from=None, date_to=None, mailbox=None):
+    """Cláusulas WHERE (y sus parámetros) comunes al listado y al recuento."""
+    clauses, params = ["deleted_at IS NULL"], []
+    if mailbox:
+        clauses.append(MAILBOX_FILTER_SQL)
+        params.append(mailbox)
+    if status:
+        clauses.append("status = %s")
+        params.append(status)
+    if sender:
+        clauses.append("sender ILIKE %s")
+        params.append(f"%{sender}%")
+    if is_read is not None:
+        clauses.append("is_read = %s")
+        params.append(is_read)
+    if date_from:
+        clauses.append("date >= %s")
+        params.append(date_from)
+    if date_to:
+        clauses.append("date < %s")
+        params.append(date_to)
+    return clauses, params
+
+def _count_emails(cur, where, params):
+    """
+    Total del listado. Devuelve (total, es_estimación). Por debajo de EMAIL_EXACT_COUNT_LIMIT
+    filas se cuenta de verdad; por encima se usa la estimación de filas del planificador,
+    que no recorre la tabla.
+    """
+    key = (where, tuple(str(p) for p in params))
+    now = time.monotonic()
+    with _email_counts_lock:
+        cached = _email_counts.get(key)
+        if cached and cached[2] > now:
+            return cached[0], cached[1]
+
+    cur.execute("SELECT reltuples::bigint AS n FROM pg_class WHERE relname = 'emails'")
+    row = cur.fetchone()
+    table_rows = row['n'] if row else 0
+    if table_rows > EMAIL_EXACT_COUNT_LIMIT:
+        cur.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM emails WHERE {where}", params)
+        plan = cur.fetchone()['QUERY PLAN']
+        total, estimated = int(plan[0]['Plan']['Plan Rows']), True
+    else:
+        cur.execute(f"SELECT COUNT(*) AS total FROM emails WHERE {where}", params)
+        total, estimated = cur.fetchone()['total'], False
+
+    with _email_counts_lock:
+        _email_counts[key] = (total, estimated, now + EMAIL_COUNT_TTL)
+    return total, estimated
+
+def get_emails_from_db(offset=0, limit=10, before=None, **filters):
+    """
+    Listado de correos (más recientes primero) con filtros opcionales: mailbox (dirección
+    del buzón), status, sender, is_read, date_from, date_to.
+
+    Con `before` (cursor "fecha,id" del último correo de la página anterior) se pagina por
+    keyset: `(fecha, id) < cursor` recorre el índice emails_sort_idx y cuesta lo mismo en
+    la página 1 que en la 1000. Los correos sin fecha van al final. `offset` se mantiene
+    por compatibilidad.
+    """
+    empty = {"emails": [], "total": 0, "total_is_estimate": False, "next_cursor": None}
+    with db_connection() as conn:
+        if not conn:
+            return empty
+
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            clauses, params = build_email_filters(**filters)
+            where = " AND ".join(clauses)
+            total, estimated = _count_emails(cur, where, params)
+
+            page_clauses, page_params = list(clauses), list(params)
+            if before:
+                page_clauses.append(f"({EMAIL_SORT_DATE_SQL}, id) < (COALESCE(%s::timestamp, '-infinity'::timestamp), %s)")
+                page_params.extend(parse_email_cursor(before))
+            else:
+                offset = offset or 0
+            cur.execute(
+                f"SELECT {EMAIL_LIST_COLUMNS} FROM emails WHERE {' AND '.join(page_clauses)} "
+                f"ORDER BY {EMAIL_SORT_DATE_SQL} DESC, id DESC LIMIT %s OFFSET %s",
+                page_params + [limit + 1, 0 if before else offset]
+            )
+            emails = cur.fetchall()
+            cur.close()
+
+            # Se pide una fila de más para saber si hay página siguiente sin contar
+            has_more = len(emails) > limit
+            emails = emails[:limit]
+            next_cursor = email_cursor(emails[-1]) if has_more and emails else None
+
+            # Convertir objetos datetime a string para JSON
+            for e in emails:
+                if e['date']:
+                    e['date'] = e['date'].strftime("%Y-%m-%d %H:%M:%S")
+                if e['processed_at']:
+                    e['processed_at'] = e['processed_at'].strftime("%Y-%m-%d %H:%M:%S")
+
+            return {"emails": emails, "total": total, "total_is_estimate": estimated, "next_cursor": next_cursor}
+        except ValueError:
+            raise
+        except Exception as e:
+            logger.error(f"Error leyendo de DB: {e}")
+            return empty
+
+# --- Búsqueda de texto completo en correos ---
+
+# Asunto y cuerpo se indexan con los diccionarios español e inglés; el remitente sin stemming.
+# El cuerpo se recorta: un tsvector no puede superar 1 MB.
+EMAIL_SEARCH_VECTOR_SQL = """
+    setweight(to_tsvector('spanish', coalesce(subject, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(subject, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(sender, '')), 'B') ||
+    setweight(to_tsvector('spanish', left(coalesce(body, ''), 100000)), 'C') ||
+    setweight(to_tsvector('english', left(coalesce(body, ''), 100000)), 'D')
+"""
+EMAIL_SEARCH_QUERY_SQL = (
+    "websearch_to_tsquery('spanish', %(q)s) || websearch_to_tsquery('english', %(q)s) "
+    "|| websearch_to_tsquery('simple', %(q)s)"
+)
+HEADLINE_OPTIONS = "StartSel=<mark>, StopSel=</mark>, MaxFragments=2, MaxWords=25, MinWords=8, FragmentDelimiter=' … '"
+
+def search_emails_db(query, limit=20, match_any=False, with_text=False, mailbox=None):
+    """
+    Busca en el espejo local de correos (sin llamadas a EWS) usando el índice GIN de
+    `search_vector`. Devuelve los correos ordenados por ts_rank_cd con un fragmento
+    resaltado (`snippet`, términos entre <mark></mark>).
+
+    Con `match_any=True` basta con que aparezca uno de los términos (candidatos para la
+    búsqueda híbrida) y con `with_text=True` se devuelve además `search_text`
+    (asunto + inicio del cuerpo) para calcular su embedding.
+    """
+    tsquery = EMAIL_SEARCH_QUERY_SQL
+    if match_any:
+        tsquery = f"replace(({tsquery})::text, ' & ', ' | ')::tsquery"
+    text_column = (
+        ", left(coalesce(subject, '') || E'\\n' || coalesce(body, ''), 1000) AS search_text"
+        if with_text else ""
+    )
+    mailbox_filter = "AND e.mailbox_id = (SELECT id FROM mailboxes WHERE address = %(mailbox)s)" if mailbox else ""
+    with db_connection() as conn:
+        if not conn:
+            return []
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            # ts_headline es caro: solo se calcula para la página de resultados, no para cada coincidencia
+            cur.execute(f"""
+                WITH q AS (SELECT {tsquery} AS query),
+                hits AS (
+                    SELECT e.id, e.subject, e.sender, e.date, e.is_read, e.status, e.body,
+                           ts_rank_cd(e.search_vector, q.query, 32) AS rank
+                    FROM emails e, q
+                    WHERE e.deleted_at IS NULL AND e.search_vector @@ q.query {mailbox_filter}
+                    ORDER BY rank DESC, e.date DESC
+                    LIMIT %(limit)s
+                )
+                SELECT hits.id, hits.subject, hits.sender, hits.date, hits.is_read, hits.status, hits.rank,
+                       ts_headline('spanish', coalesce(hits.body, ''), q.query, %(headline)s) AS snippet
+                       {text_column}
+                FROM hits, q
+                ORDER BY hits.rank DESC, hits.date DESC
+            """, {"q": query, "limit": limit, "headline": HEADLINE_OPTIONS, "mailbox": mailbox})
+            rows = cur.fetchall()
+            cur.close()
+            for r in rows:
+                if r['date']:
+                    r['date'] = r['date'].strftime("%Y-%m-%d %H:%M:%S")
+                r['rank'] = float(r['rank'])
+            return rows
+        except Exception as e:
+            logger.error(f"Error en búsqueda de correos: {e}")
+            return []
+
+def get_email_ids_missing_body(limit=50, mailbox_id=None):
+    """
+    Ids de correos (del buzón `mailbox_id`, si se indica) de los que solo tenemos la cabecera
+    y cuyo cuerpo aún no se ha pedido a Exchange.
+    """
+    with db_connection() as conn:
+        if not conn:
+            return []
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT id FROM emails WHERE (body = '' OR body IS NULL) AND deleted_at IS NULL "
+                "AND body_fetched_at IS NULL AND (%s::int IS NULL OR mailbox_id = %s) LIMIT %s",
+                (mailbox_id, mailbox_id, limit)
+            )
+            ids = [row[0] for row in cur.fetchall()]
+            cur.close()
+            return ids
+        except Exception as e:
+            logger.error(f"Error buscando correos sin cuerpo: {e}")
+            return []
+
+def mark_bodies_fetched(email_ids):
+    """Marca como ya pedidos los cuerpos de `email_ids`, hayan llegado o no (vacíos, borrados en el servidor)."""
+    if not email_ids:
+        return 0
+    with db_connection() as conn:
+        if not conn:
+            return 0
+        try:
+            cur = conn.cursor()
+            cur.execute("UPDATE emails SET body_fetched_at = NOW() WHERE id = ANY(%s)", (list(email_ids),))
+            marked = cur.rowcount
+            conn.commit()
+            cur.close()
+            return marked
+        except Exception as e:
+            logger.error(f"Error marcando cuerpos descargados: {e}")
+            return 0
 
 def update_email_status(email_id, status, ai_response=None):
-    conn = get_db_connection()
-    if not conn:
-        return
-    
-    try:
-        cur = conn.cursor()
-        if ai_response:
-            cur.execute("""
-                UPDATE emails 
-                SET status = %s, ai_response = %s, processed_at = NOW() 
-                WHERE id = %s
-            """, (status, ai_response, email_id))
-        else:
-            cur.execute("UPDATE emails SET status = %s WHERE id = %s", (status, email_id))
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Error actualizando status en DB: {e}")
+    with db_connection() as conn:
+        if not conn:
+            return
+
+        try:
+            cur = conn.cursor()
+            if ai_response:
+                cur.execute("""
+                    UPDATE emails 
+                    SET status = %s, ai_response = %s, processed_at = NOW() 
+                    WHERE id = %s
+                """, (status, ai_response, email_id))
+            else:
+                cur.execute("UPDATE emails SET status = %s WHERE id = %s", (status, email_id))
+            conn.commit()
+            invalidate_email_counts()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error actualizando status en DB: {e}")
+
+def update_email_read(email_id, is_read):
+    """Actualiza la marca de leído. Devuelve False si no se pudo escribir."""
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute("UPDATE emails SET is_read = %s WHERE id = %s", (is_read, email_id))
+            conn.commit()
+            invalidate_email_counts()
+            cur.close()
+            return True
+        except Exception as e:
+            logger.error(f"Error actualizando is_read en DB: {e}")
+            return False
 
 def get_email_detail_db(email_id):
-    conn = get_db_connection()
-    if not conn:
-        return None
-    
-    try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT * FROM emails WHERE id = %s", (email_id,))
-        email = cur.fetchone()
-        cur.close()
-        conn.close()
-        
-        if email:
-            if email['date']:
-                email['date'] = email['date'].strftime("%Y-%m-%d %H:%M:%S")
-        return email
-    except Exception as e:
-        logger.error(f"Error obteniendo detalle de DB: {e}")
-        return None
+    with db_connection() as conn:
+        if not conn:
+            return None
+
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute("""
+                SELECT e.*, m.address AS mailbox
+                FROM emails e LEFT JOIN mailboxes m ON m.id = e.mailbox_id
+                WHERE e.id = %s
+            """, (email_id,))
+            email = cur.fetchone()
+            cur.close()
+
+            if email:
+                if email['date']:
+                    email['date'] = email['date'].strftime("%Y-%m-%d %H:%M:%S")
+            return email
+        except Exception as e:
+            logger.error(f"Error obteniendo detalle de DB: {e}")
+            return None
+
+def get_email_mailbox(email_id):
+    """Dirección del buzón al que pertenece un correo, o None si no está en la DB."""
+    with db_connection() as conn:
+        if not conn: return None
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT m.address FROM emails e JOIN mailboxes m ON m.id = e.mailbox_id
+                WHERE e.id = %s
+            """, (email_id,))
+            res = cur.fetchone()
+            cur.close()
+            return res[0] if res else None
+        except Exception as e:
+            logger.error(f"Error obteniendo el buzón del correo {email_id}: {e}")
+            return None
 
 def delete_email_db(email_id):
-    conn = get_db_connection()
-    if not conn:
-        return False
-    try:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM emails WHERE id = %s", (email_id,))
-        conn.commit()
-        cur.close()
-        conn.close()
-        return True
-    except Exception as e:
-        logger.error(f"Error eliminando de DB: {e}")
-        return False
+    with db_connection() as conn:
+        if not conn:
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM emails WHERE id = %s", (email_id,))
+            conn.commit()
+            invalidate_email_counts()
+            cur.close()
+            return True
+        except Exception as e:
+            logger.error(f"Error eliminando de DB: {e}")
+            return False
+
+def delete_emails_db(email_ids, soft=False):
+    """
+    Elimina varios correos en una sola sentencia. Con `soft=True` solo se marcan con
+    `deleted_at` (tombstone) y dejan de listarse. Devuelve el número de filas afectadas,
+    o None si no se pudo escribir.
+    """
+    email_ids = list(email_ids)
+    if not email_ids:
+        return 0
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            cur = conn.cursor()
+            if soft:
+                cur.execute(
+                    "UPDATE emails SET deleted_at = NOW() WHERE id = ANY(%s) AND deleted_at IS NULL",
+                    (email_ids,)
+                )
+            else:
+                cur.execute("DELETE FROM emails WHERE id = ANY(%s)", (email_ids,))
+            affected = cur.rowcount
+            conn.commit()
+            invalidate_email_counts()
+            cur.close()
+            return affected
+        except Exception as e:
+            logger.error(f"Error eliminando {len(email_ids)} correos de DB: {e}")
+            return None
+
+def reconcile_emails(live_ids, soft=False, mailbox_id=None):
+    """
+    Deja en la DB solo los correos cuyo id está en `live_ids` (el Inbox actual), con una
+    única sentencia y transacción. Con `mailbox_id` solo se tocan los correos de ese buzón
+    (los demás buzones no venían en su sincronización). Con `soft=True` los sobrantes se
+    marcan como borrados en lugar de eliminarse, para que el dashboard no parpadee durante
+    la sincronización. Devuelve el número de correos retirados, o None si no se pudo escribir.
+    """
+    live_ids = list(live_ids)
+    scope = "AND mailbox_id = %s" if mailbox_id is not None else ""
+    params = (live_ids, mailbox_id) if mailbox_id is not None else (live_ids,)
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            cur = conn.cursor()
+            if soft:
+                cur.execute(
+                    f"UPDATE emails SET deleted_at = NOW() WHERE deleted_at IS NULL AND id <> ALL(%s::text[]) {scope}",
+                    params
+                )
+            else:
+                cur.execute(f"DELETE FROM emails WHERE id <> ALL(%s::text[]) {scope}", params)
+            removed = cur.rowcount
+            conn.commit()
+            invalidate_email_counts()
+            cur.close()
+            return removed
+        except Exception as e:
+            logger.error(f"Error reconciliando correos borrados: {e}")
+            return None
+
+def purge_email_tombstones(older_than_hours=24):
+    """Elimina definitivamente los correos marcados como borrados hace más de `older_than_hours`."""
+    with db_connection() as conn:
+        if not conn:
+            return 0
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "DELETE FROM emails WHERE deleted_at < NOW() - make_interval(hours => %s)",
+                (int(older_than_hours),)
+            )
+            purged = cur.rowcount
+            conn.commit()
+            invalidate_email_counts()
+            cur.close()
+            return purged
+        except Exception as e:
+            logger.error(f"Error purgando correos borrados: {e}")
+            return 0
 
 # --- Gestión de Ajustes ---
 
 def save_setting(key, value):
-    conn = get_db_connection()
-    if not conn: return
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO settings (key, value, updated_at)
-            VALUES (%s, %s, NOW())
-            ON CONFLICT (key) DO UPDATE SET
-                value = EXCLUDED.value,
-                updated_at = EXCLUDED.updated_at;
-        """, (key, str(value)))
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Error guardando ajuste {key}: {e}")
+    with db_connection() as conn:
+        if not conn: return
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO settings (key, value, updated_at)
+                VALUES (%s, %s, NOW())
+                ON CONFLICT (key) DO UPDATE SET
+                    value = EXCLUDED.value,
+                    updated_at = EXCLUDED.updated_at;
+            """, (key, str(value)))
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error guardando ajuste {key}: {e}")
+
+def delete_setting(key):
+    with db_connection() as conn:
+        if not conn: return
+        try:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM settings WHERE key = %s", (key,))
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error eliminando ajuste {key}: {e}")
 
 def get_setting(key, default=None):
-    conn = get_db_connection()
-    if not conn: return default
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE key = %s", (key,))
-        res = cur.fetchone()
-        cur.close()
-        conn.close()
-        return res[0] if res else default
-    except Exception as e:
-        logger.error(f"Error obteniendo ajuste {key}: {e}")
-        return default
+    with db_connection() as conn:
+        if not conn: return default
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT value FROM settings WHERE key = %s", (key,))
+            res = cur.fetchone()
+            cur.close()
+            return res[0] if res else default
+        except Exception as e:
+            logger.error(f"Error obteniendo ajuste {key}: {e}")
+            return default
 
 def get_all_settings():
-    conn = get_db_connection()
-    if not conn: return {}
-    try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT key, value FROM settings")
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return {r['key']: r['value'] for r in rows}
-    except Exception as e:
-        logger.error(f"Error obteniendo todos los ajustes: {e}")
-        return {}
+    with db_connection() as conn:
+        if not conn: return {}
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute("SELECT key, value FROM settings")
+            rows = cur.fetchall()
+            cur.close()
+            return {r['key']: r['value'] for r in rows}
+        except Exception as e:
+            logger.error(f"Error obteniendo todos los ajustes: {e}")
+            return {}
+
+# --- Registro de buzones ---
+
+# La contraseña (cifrada) y el SyncState no salen nunca en los listados
+MAILBOX_COLUMNS = (
+    "id, address, display_name, tenant, username, server, enabled, "
+    "(password IS NOT NULL) AS has_password, last_sync_at, last_sync, last_error, created_at, updated_at"
+)
+
+def list_mailboxes(enabled_only=False):
+    with db_connection() as conn:
+        if not conn: return []
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(f"""
+                SELECT {MAILBOX_COLUMNS} FROM mailboxes
+                WHERE %s = FALSE OR enabled
+                ORDER BY id
+            """, (enabled_only,))
+            rows = cur.fetchall()
+            cur.close()
+            return rows
+        except Exception as e:
+            logger.error(f"Error listando buzones: {e}")
+            return []
+
+def get_mailbox(address, with_secrets=False):
+    """Buzón por dirección. Con `with_secrets=True` incluye la contraseña cifrada y el SyncState."""
+    columns = MAILBOX_COLUMNS + (", password, sync_state" if with_secrets else "")
+    with db_connection() as conn:
+        if not conn: return None
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(f"SELECT {columns} FROM mailboxes WHERE address = %s", (address,))
+            row = cur.fetchone()
+            cur.close()
+            return row
+        except Exception as e:
+            logger.error(f"Error obteniendo buzón {address}: {e}")
+            return None
+
+def save_mailbox(address, display_name=None, tenant=None, username=None, password=None, server=None, enabled=None):
+    """
+    Alta o modificación de un buzón. Los campos a None conservan su valor (o el valor por
+    defecto en el alta); `password` debe llegar ya cifrada. Devuelve el buzón guardado.
+    """
+    with db_connection() as conn:
+        if not conn: return None
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(f"""
+                INSERT INTO mailboxes (address, display_name, tenant, username, password, server, enabled)
+                VALUES (%(address)s, %(display_name)s, COALESCE(%(tenant)s, 'default'), %(username)s,
+                        %(password)s, %(server)s, COALESCE(%(enabled)s, TRUE))
+                ON CONFLICT (address) DO UPDATE SET
+                    display_name = COALESCE(EXCLUDED.display_name, mailboxes.display_name),
+                    tenant = COALESCE(%(tenant)s, mailboxes.tenant),
+                    username = COALESCE(EXCLUDED.username, mailboxes.username),
+                    password = COALESCE(EXCLUDED.password, mailboxes.password),
+                    server = COALESCE(EXCLUDED.server, mailboxes.server),
+                    enabled = COALESCE(%(enabled)s, mailboxes.enabled),
+                    updated_at = NOW()
+                RETURNING {MAILBOX_COLUMNS}
+            """, {"address": address, "display_name": display_name, "tenant": tenant, "username": username,
+                  "password": password, "server": server, "enabled": enabled})
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+            return row
+        except Exception as e:
+            logger.error(f"Error guardando buzón {address}: {e}")
+            return None
+
+def replace_default_mailbox(old_address, new_address):
+    """
+    Cambio de EXCHANGE_USER: el buzón anterior sin credenciales propias (el que usaba los
+    ajustes globales) pasa a ser el nuevo, con SyncState vacío para que la sincronización
+    completa retire sus correos. Si la nueva dirección ya estaba registrada, el anterior
+    se desactiva. Devuelve el buzón nuevo.
+    """
+    uses_global_credentials = "username IS NULL AND password IS NULL AND server IS NULL"
+    with db_connection() as conn:
+        if not conn: return None
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(f"""
+                UPDATE mailboxes SET address = %(new)s, sync_state = NULL, enabled = TRUE, updated_at = NOW()
+                WHERE address = %(old)s AND {uses_global_credentials}
+                  AND NOT EXISTS (SELECT 1 FROM mailboxes WHERE address = %(new)s)
+                RETURNING {MAILBOX_COLUMNS}
+            """, {"old": old_address, "new": new_address})
+            row = cur.fetchone()
+            if row is None:
+                cur.execute(f"""
+                    UPDATE mailboxes SET enabled = FALSE, updated_at = NOW()
+                    WHERE address = %s AND {uses_global_credentials}
+                """, (old_address,))
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error sustituyendo el buzón {old_address} por {new_address}: {e}")
+            return None
+    return row or save_mailbox(new_address, enabled=True)
+
+def delete_mailbox(address):
+    """Elimina el buzón y (en cascada) sus correos. Devuelve True si existía."""
+    with db_connection() as conn:
+        if not conn: return False
+        try:
+            cur = conn.cursor()
+            cur.execute("DELETE FROM mailboxes WHERE address = %s", (address,))
+            deleted = cur.rowcount > 0
+            conn.commit()
+            cur.close()
+            if deleted:
+                invalidate_email_counts()
+            return deleted
+        except Exception as e:
+            logger.error(f"Error eliminando buzón {address}: {e}")
+            return False
+
+def get_mailbox_sync_state(mailbox_id):
+    with db_connection() as conn:
+        if not conn: return None
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT sync_state FROM mailboxes WHERE id = %s", (mailbox_id,))
+            res = cur.fetchone()
+            cur.close()
+            return res[0] if res else None
+        except Exception as e:
+            logger.error(f"Error obteniendo SyncState del buzón {mailbox_id}: {e}")
+            return None
+
+def save_mailbox_sync_state(mailbox_id, sync_state):
+    """Guarda (o borra, con None) el SyncState de EWS del buzón."""
+    with db_connection() as conn:
+        if not conn: return
+        try:
+            cur = conn.cursor()
+            cur.execute("UPDATE mailboxes SET sync_state = %s WHERE id = %s", (sync_state, mailbox_id))
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error guardando SyncState del buzón {mailbox_id}: {e}")
+
+def record_mailbox_sync(mailbox_id, summary=None, error=None):
+    """Resultado de la última sincronización del buzón (resumen o error) para el dashboard."""
+    with db_connection() as conn:
+        if not conn: return
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE mailboxes SET
+                    last_sync_at = CASE WHEN %(error)s::text IS NULL THEN NOW() ELSE last_sync_at END,
+                    last_sync = COALESCE(%(summary)s, last_sync),
+                    last_error = %(error)s
+                WHERE id = %(id)s
+            """, {"id": mailbox_id, "summary": _state_json(summary) if summary is not None else None,
+                  "error": str(error) if error else None})
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error registrando sincronización del buzón {mailbox_id}: {e}")
+
+# --- Registro de documentos de conocimiento ---
+
+DOCUMENT_SEARCH_VECTOR_SQL = (
+    "to_tsvector('spanish', coalesce(content, '')) || to_tsvector('english', coalesce(content, ''))"
+)
+
+# Igual que `content_hash` (sha256 hex del texto en UTF-8) de domain.knowledge.cache
+CHUNK_HASH_SQL = "encode(sha256(convert_to(d.content, 'UTF8')), 'hex')"
+
+def list_documents():
+    """Documentos del registro con su nº de fragmentos y tamaño (sin recorrer `documents`)."""
+    with db_connection() as conn:
+        if not conn: return []
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute("""
+                SELECT filename, chunk_count, size_bytes, created_at, updated_at
+                FROM knowledge_files
+                ORDER BY updated_at DESC
+            """)
+            files = cur.fetchall()
+            cur.close()
+            return files
+        except Exception as e:
+            logger.error(f"Error listando documentos: {e}")
+            return []
+
+# --- Estado compartido de la aplicación ---
+
+def _state_json(value):
+    return Json(value, dumps=lambda v: json.dumps(v, default=str))
+
+def load_app_state():
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT data FROM app_state WHERE id = 1")
+            row = cur.fetchone()
+            cur.close()
+            return row[0] if row else None
+        except Exception as e:
+            logger.error(f"Error leyendo app_state: {e}")
+            return None
+
+def merge_app_state(changes):
+    """Fusiona `changes` en el estado compartido en una sola sentencia (sin leer-modificar-escribir)."""
+    with db_connection() as conn:
+        if not conn:
+            return
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "UPDATE app_state SET data = data || %s, version = version + 1, updated_at = NOW() WHERE id = 1",
+                (_state_json(changes),)
+            )
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error actualizando app_state: {e}")
+
+def increment_app_state(key, n=1):
+    """Incrementa un contador del estado compartido de forma atómica. Devuelve el nuevo valor."""
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE app_state
+                SET data = jsonb_set(data, ARRAY[%(key)s], to_jsonb(COALESCE((data->>%(key)s)::bigint, 0) + %(n)s)),
+                    version = version + 1, updated_at = NOW()
+                WHERE id = 1
+                RETURNING (data->>%(key)s)::bigint
+            """, {"key": key, "n": n})
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+            return row[0] if row else None
+        except Exception as e:
+            logger.error(f"Error incrementando {key} en app_state: {e}")
+            return None
+
+def set_app_state_task(task_id, task=None):
+    """Añade (o con task=None retira) una tarea activa; se guardan como objeto indexado por id."""
+    with db_connection() as conn:
+        if not conn:
+            return
+        try:
+            cur = conn.cursor()
+            if task is None:
+                cur.execute(
+                    "UPDATE app_state SET data = data #- ARRAY['active_tasks', %s], version = version + 1 WHERE id = 1",
+                    (task_id,)
+                )
+            else:
+                cur.execute("""
+                    UPDATE app_state
+                    SET data = jsonb_set(data, '{active_tasks}',
+                                         COALESCE(data->'active_tasks', '{}'::jsonb) || jsonb_build_object(%s, %s::jsonb)),
+                        version = version + 1
+                    WHERE id = 1
+                """, (task_id, _state_json(task)))
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error actualizando tareas activas en app_state: {e}")
+
+def set_app_state_mailbox(address, info=None):
+    """
+    Fusiona `info` en el estado del buzón `address` (o con info=None lo retira) sin tocar el
+    resto de buzones, que pueden estar escribiendo otros procesos, y recalcula
+    `exchange_connected`. Devuelve {"mailboxes", "exchange_connected"} tal como quedan.
+    """
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            cur = conn.cursor()
+            if info is None:
+                cur.execute(
+                    "UPDATE app_state SET data = data #- ARRAY['mailboxes', %s], version = version + 1 WHERE id = 1",
+                    (address,)
+                )
+            else:
+                cur.execute("""
+                    UPDATE app_state
+                    SET data = jsonb_set(data, '{mailboxes}',
+                                         COALESCE(data->'mailboxes', '{}'::jsonb) || jsonb_build_object(
+                                             %(address)s,
+                                             COALESCE(data->'mailboxes'->%(address)s, '{}'::jsonb) || %(info)s::jsonb)),
+                        version = version + 1
+                    WHERE id = 1
+                """, {"address": address, "info": _state_json(info)})
+            cur.execute("""
+                UPDATE app_state
+                SET data = jsonb_set(data, '{exchange_connected}', to_jsonb(EXISTS (
+                        SELECT 1 FROM jsonb_each(COALESCE(data->'mailboxes', '{}'::jsonb)) m
+                        WHERE (m.value->>'connected')::boolean
+                    ))),
+                    updated_at = NOW()
+                WHERE id = 1
+                RETURNING COALESCE(data->'mailboxes', '{}'::jsonb), (data->>'exchange_connected')::boolean
+            """)
+            row = cur.fetchone()
+            conn.commit()
+            cur.close()
+            return {"mailboxes": row[0], "exchange_connected": row[1]} if row else None
+        except Exception as e:
+            logger.error(f"Error actualizando el estado del buzón {address} en app_state: {e}")
+            return None
+
+# --- Cola de trabajos ---
+
+JOB_COLUMNS = (
+    "id, kind, email_id, payload, status, attempts, max_attempts, error, worker, "
+    "run_after, created_at, started_at, finished_at"
+)
+ACTIVE_JOB_CONFLICT = "ON CONFLICT (kind, email_id) WHERE status IN ('queued', 'running') DO NOTHING"
+
+def _job_row(job):
+    for key in ("run_after", "created_at", "started_at", "finished_at"):
+        if job.get(key):
+            job[key] = job[key].strftime("%Y-%m-%d %H:%M:%S")
+    return job
+
+def enqueue_jobs(email_ids, payload=None, kind="generate_answer", max_attempts=3):
+    """
+    Encola un trabajo por correo. Si un correo ya tiene un trabajo en cola o en curso no se
+    duplica. Devuelve los trabajos activos de esos correos (nuevos o existentes).
+    """
+    email_ids = list(dict.fromkeys(email_ids))
+    if not email_ids:
+        return []
+    with db_connection() as conn:
+        if not conn:
+            return []
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            execute_values(
+                cur,
+                f"INSERT INTO jobs (kind, email_id, payload, max_attempts) VALUES %s {ACTIVE_JOB_CONFLICT}",
+                [(kind, email_id, Json(payload or {}), max_attempts) for email_id in email_ids]
+            )
+            cur.execute(
+                f"SELECT {JOB_COLUMNS} FROM jobs WHERE kind = %s AND email_id = ANY(%s) "
+                "AND status IN ('queued', 'running') ORDER BY id",
+                (kind, email_ids)
+            )
+            jobs = [_job_row(j) for j in cur.fetchall()]
+            conn.commit()
+            cur.close()
+            return jobs
+        except Exception as e:
+            logger.error(f"Error encolando {len(email_ids)} trabajos: {e}")
+            return []
+
+def enqueue_pending_emails(payload=None, kind="generate_answer", max_attempts=3, mailbox=None):
+    """
+    Encola todos los correos en estado PENDIENTE (del buzón `mailbox`, si se indica) sin
+    trabajo activo. Los que ya agotaron sus intentos (trabajo 'failed') no se reencolan:
+    solo se reintentan pidiéndolo explícitamente (`enqueue_jobs`). Devuelve cuántos se encolaron.
+    """
+    mailbox_filter = f"AND {MAILBOX_FILTER_SQL}" if mailbox else ""
+    with db_connection() as conn:
+        if not conn:
+            return 0
+        try:
+            cur = conn.cursor()
+            cur.execute(f"""
+                INSERT INTO jobs (kind, email_id, payload, max_attempts)
+                SELECT %s, id, %s, %s FROM emails
+                WHERE status = 'PENDIENTE' AND deleted_at IS NULL {mailbox_filter}
+                  AND NOT EXISTS (
+                      SELECT 1 FROM jobs j WHERE j.kind = %s AND j.email_id = emails.id AND j.status = 'failed'
+                  )
+                ORDER BY date DESC
+                {ACTIVE_JOB_CONFLICT}
+            """, (kind, Json(payload or {}), max_attempts) + ((mailbox,) if mailbox else ()) + (kind,))
+            queued = cur.rowcount
+            conn.commit()
+            cur.close()
+            return queued
+        except Exception as e:
+            logger.error(f"Error encolando correos pendientes: {e}")
+            return 0
+
+def claim_job(worker):
+    """
+    Toma el siguiente trabajo en cola y lo marca como 'running'. FOR UPDATE SKIP LOCKED
+    permite varios workers (o varias réplicas de la API) sin que dos cojan el mismo.
+    """
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(f"""
+                UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                    started_at = NOW(), worker = %s, error = NULL
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE status = 'queued' AND run_after <= NOW()
+                    ORDER BY run_after, id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING {JOB_COLUMNS}
+            """, (worker,))
+            job = cur.fetchone()
+            conn.commit()
+            cur.close()
+            return _job_row(job) if job else None
+        except Exception as e:
+            logger.error(f"Error reclamando trabajo: {e}")
+            return None
+
+def complete_job(job_id):
+    with db_connection() as conn:
+        if not conn:
+            return
+        try:
+            cur = conn.cursor()
+            cur.execute("UPDATE jobs SET status = 'done', finished_at = NOW() WHERE id = %s", (job_id,))
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error completando trabajo {job_id}: {e}")
+
+def fail_job(job_id, error, retry_delay=None):
+    """
+    Registra el fallo de un trabajo. Si `retry_delay` no es None y quedan intentos vuelve a
+    la cola tras `retry_delay` segundos; si no, queda como 'failed'.
+    """
+    with db_connection() as conn:
+        if not conn:
+            return
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE jobs SET
+                    status = CASE WHEN %s AND attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                    run_after = NOW() + make_interval(secs => %s),
+                    finished_at = CASE WHEN %s AND attempts < max_attempts THEN NULL ELSE NOW() END,
+                    error = %s
+                WHERE id = %s
+            """, (retry_delay is not None, retry_delay or 0, retry_delay is not None, str(error)[:1000], job_id))
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error registrando fallo del trabajo {job_id}: {e}")
+
+def release_job(job_id):
+    """Devuelve un trabajo en curso a la cola sin contar el intento (parada ordenada del worker)."""
+    with db_connection() as conn:
+        if not conn:
+            return
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE jobs SET status = 'queued', worker = NULL, attempts = GREATEST(attempts - 1, 0)
+                WHERE id = %s AND status = 'running'
+            """, (job_id,))
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            logger.error(f"Error liberando trabajo {job_id}: {e}")
+
+def requeue_stale_jobs(older_than_secs=900):
+    """
+    Devuelve a la cola los trabajos 'running' abandonados (p.ej. la API se reinició a mitad).
+    Los que ya agotaron sus intentos quedan como 'failed': un trabajo que tumba el proceso no
+    se reintenta indefinidamente. También retira del estado compartido las tareas activas
+    cuyo trabajo ya no está 'running' (las dejó ahí un worker que murió sin `remove_task`).
+    Devuelve cuántos volvieron a la cola.
+    """
+    with db_connection() as conn:
+        if not conn:
+            return 0
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                UPDATE jobs SET
+                    status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                    finished_at = CASE WHEN attempts < max_attempts THEN NULL ELSE NOW() END,
+                    error = CASE WHEN attempts < max_attempts THEN error ELSE 'Trabajo abandonado (intentos agotados)' END,
+                    worker = NULL
+                WHERE status = 'running' AND started_at < NOW() - make_interval(secs => %s)
+                RETURNING status
+            """, (older_than_secs,))
+            requeued = sum(1 for (status,) in cur.fetchall() if status == 'queued')
+            cur.execute("""
+                UPDATE app_state
+                SET data = jsonb_set(data, '{active_tasks}', COALESCE((
+                        SELECT jsonb_object_agg(t.key, t.value)
+                        FROM jsonb_each(data->'active_tasks') t
+                        WHERE EXISTS (SELECT 1 FROM jobs j WHERE j.id::text = t.key AND j.status = 'running')
+                    ), '{}'::jsonb)),
+                    version = version + 1
+                WHERE id = 1 AND jsonb_typeof(data->'active_tasks') = 'object'
+            """)
+            conn.commit()
+            cur.close()
+            return requeued
+        except Exception as e:
+            logger.error(f"Error recuperando trabajos abandonados: {e}")
+            return 0
+
+def get_job(job_id):
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(f"""
+                SELECT {JOB_COLUMNS},
+                       (SELECT m.address FROM emails e JOIN mailboxes m ON m.id = e.mailbox_id
+                        WHERE e.id = jobs.email_id) AS mailbox
+                FROM jobs WHERE id = %s
+            """, (job_id,))
+            job = cur.fetchone()
+            cur.close()
+            return _job_row(job) if job else None
+        except Exception as e:
+            logger.error(f"Error obteniendo trabajo {job_id}: {e}")
+            return None
+
+def get_job_counts(mailbox=None):
+    """Número de trabajos por estado (de los correos del buzón `mailbox`, si se indica)."""
+    mailbox_filter = f"WHERE email_id IN (SELECT id FROM emails WHERE {MAILBOX_FILTER_SQL})" if mailbox else ""
+    with db_connection() as conn:
+        if not conn:
+            return {}
+        try:
+            cur = conn.cursor()
+            cur.execute(f"SELECT status, COUNT(*) FROM jobs {mailbox_filter} GROUP BY status", (mailbox,) if mailbox else ())
+            counts = dict(cur.fetchall())
+            cur.close()
+            return counts
+        except Exception as e:
+            logger.error(f"Error contando trabajos: {e}")
+            return {}
+
+# --- Índice vectorial (ANN) de documents.embedding ---
+
+def to_pgvector(embedding):
+    """Serializa un vector float32 al formato de texto de pgvector ('[x,y,...]')."""
+    return "[" + ",".join(f"{x:.7g}" for x in embedding) + "]"
+
+VECTOR_INDEX_NAME = "documents_embedding_idx"
+
+def vector_index_params(rows, method="hnsw"):
+    """
+    Parámetros del índice según el volumen de fragmentos.
+    HNSW: más conexiones (m) y ef_construction para tablas grandes.
+    IVFFlat: lists = filas/1000 hasta 1M filas y sqrt(filas) a partir de ahí (recomendación de pgvector).
+    """
+    if method == "hnsw":
+        if rows < 100_000:
+            return {"m": 16, "ef_construction": 64}
+        if rows < 1_000_000:
+            return {"m": 16, "ef_construction": 128}
+        return {"m": 24, "ef_construction": 200}
+    lists = max(10, rows // 1000) if rows <= 1_000_000 else int(math.sqrt(rows))
+    return {"lists": lists}
+
+def create_vector_index(cur, method, params, table="documents", name=VECTOR_INDEX_NAME):
+    options = ", ".join(f"{k} = {int(v)}" for k, v in params.items())
+    cur.execute(
+        f"CREATE INDEX {name} ON {table} USING {method} (embedding vector_cosine_ops) WITH ({options})"
+    )
+
+def ensure_vector_index(rebuild=False):
+    """
+    Crea el índice ANN (HNSW, o IVFFlat si la versión de pgvector no soporta HNSW) sobre
+    documents.embedding con parámetros acordes al nº de filas.
+
+    Con `rebuild=True` (tras una carga masiva) un índice IVFFlat se recrea si su nº de
+    `lists` ya no corresponde al volumen o se reindexa para recalcular los centroides;
+    HNSW se mantiene incrementalmente y solo se reindexa si se fuerza con `rebuild="force"`.
+    Devuelve un resumen con el método, parámetros y la acción realizada.
+    """
+    with db_connection() as conn:
+        if not conn:
+            return None
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM documents")
+            rows = cur.fetchone()[0]
+            cur.execute("SELECT indexdef FROM pg_indexes WHERE indexname = %s", (VECTOR_INDEX_NAME,))
+            existing = cur.fetchone()
+            action = "none"
+
+            if existing is None:
+                method = "hnsw"
+                params = vector_index_params(rows, method)
+                try:
+                    cur.execute("SAVEPOINT vector_index")
+                    create_vector_index(cur, method, params)
+                except psycopg2.Error as e:
+                    # pgvector < 0.5.0 no tiene HNSW: fallback a IVFFlat (necesita datos para los centroides)
+                    cur.execute("ROLLBACK TO SAVEPOINT vector_index")
+                    logger.warning(f"HNSW no disponible ({e}); se usará IVFFlat.")
+                    method = "ivfflat"
+                    params = vector_index_params(rows, method)
+                    if rows == 0:
+                        conn.commit()
+                        cur.close()
+                        return {"method": None, "rows": rows, "action": "deferred"}
+                    create_vector_index(cur, method, params)
+                action = "created"
+            else:
+                indexdef = existing[0].lower()
+                method = "hnsw" if "using hnsw" in indexdef else "ivfflat"
+                params = vector_index_params(rows, method)
+                if rebuild and method == "ivfflat":
+                    match = re.search(r"lists\s*=\s*'?(\d+)", indexdef)
+                    current_lists = int(match.group(1)) if match else None
+                    if current_lists != params["lists"]:
+                        cur.execute(f"DROP INDEX {VECTOR_INDEX_NAME}")
+                        create_vector_index(cur, method, params)
+                        action = "recreated"
+                    else:
+                        cur.execute(f"REINDEX INDEX {VECTOR_INDEX_NAME}")
+                        action = "reindexed"
+                elif rebuild == "force":
+                    cur.execute(f"REINDEX INDEX {VECTOR_INDEX_NAME}")
+                    action = "reindexed"
+
+            if action != "none":
+                cur.execute("ANALYZE documents")
+                logger.info(f"Índice vectorial {method} {params}: {action} ({rows} fragmentos).")
+            conn.commit()
+            cur.close()
+            return {"method": method, "params": params, "rows": rows, "action": action}
+        except Exception as e:
+            logger.error(f"Error gestionando el índice vectorial: {e}")
+            return None
@@ -1,57 +1,67 @@
-import os
-import yaml
 import logging
-from exchangelib import Credentials, Account, Configuration, DELEGATE, protocol, Message, Mailbox
-from dotenv import load_dotenv
+from exchangelib import protocol, Message, Mailbox, ItemId
+from exchangelib.errors import ErrorInvalidSyncStateData  # noqa: F401 (re-exportado para el motor de sync)
+
+from .session import session_manager
 
 # Desactivar verificación SSL si es necesario (común en entornos internos)
 protocol.BaseProtocol.HTTP_ADAPTER_CLS.verify = False
 
-def get_account():
-    load_dotenv()
-    from ..database.postgres import get_setting
-    from ...core.security import decrypt_password
-    
-    config_path = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'config', 'config.yaml')
-    with open(config_path, 'r') as f:
-        config = yaml.safe_load(f)
-    
-    ex_config = config['exchange']
-    
-    # Priorizar valores de Base de Datos, fallback a .env
-    email = get_setting('EXCHANGE_USER', os.getenv('EXCHANGE_USER'))
-    raw_pass = get_setting('EXCHANGE_PASS', os.getenv('EXCHANGE_PASS'))
-    password = decrypt_password(raw_pass)
-    server = get_setting('EXCHANGE_SERVER', ex_config.get('server'))
-    upn = get_setting('EXCHANGE_UPN', os.getenv('EXCHANGE_UPN')) or email
-    
-    credentials = Credentials(username=upn, password=password)
-    config_obj = Configuration(server=server, credentials=credentials)
-    
-    return Account(
-        primary_smtp_address=email, 
-        config=config_obj, 
-        autodiscover=False, 
-        access_type=DELEGATE
-    )
+def get_account(mailbox=None):
+    """
+    Devuelve la cuenta de Exchange compartida del buzón `mailbox` (dirección; None = el
+    buzón de EXCHANGE_USER). La construcción (config, ajustes en DB, descifrado y
+    handshake) solo ocurre la primera vez o tras cambiar los ajustes.
+    """
+    return session_manager.get_account(mailbox)
 
-def test_connection():
+def test_connection(mailbox=None):
     try:
-        account = get_account()
+        account = get_account(mailbox)
         print(f"--- Probando conexión a Exchange ---")
         print(f"✅ ¡Conexión exitosa!")
         print(f"Bandeja de entrada: {account.inbox.name}")
         return True
     except Exception as e:
         print(f"❌ Error de conexión: {str(e)}")
+        # Forzar una reconstrucción en el siguiente intento (solo de ese buzón si se indica)
+        if mailbox:
+            session_manager.forget(mailbox)
+        else:
+            session_manager.invalidate()
         return False
 
-def get_paginated_emails(offset=0, limit=10):
+# Campos mínimos para la lista; el 'body' es lo más pesado y se descarga aparte
+HEADER_FIELDS = ['subject', 'sender', 'datetime_received', 'is_read']
+
+def _email_header(item):
+    sender = getattr(item, 'sender', None)
+    received = getattr(item, 'datetime_received', None)
+    return {
+        "id": str(item.id) if item.id else str(item.message_id),
+        "subject": item.subject,
+        "sender": sender.email_address if sender else "Sistema",
+        "date": received.strftime("%Y-%m-%d %H:%M:%S") if received else None,
+        "is_read": getattr(item, 'is_read', False),
+        "body_preview": "" # Ya no lo cargamos aquí para ganar velocidad
+    }
+
+# Campos necesarios para el detalle (cuerpo en texto plano y HTML como fallback)
+DETAIL_FIELDS = HEADER_FIELDS + ['text_body', 'body']
+
+def _email_detail(item):
+    detail = _email_header(item)
+    del detail["body_preview"]
+    # Intentamos obtener el cuerpo de texto, si no, limpiamos el HTML
+    detail["body"] = item.text_body if item.text_body else clean_html(item.body)
+    return detail
+
+def get_paginated_emails(offset=0, limit=10, mailbox=None):
     """
     Recupera correos de la bandeja de entrada con paginación.
     """
     try:
-        account = get_account()
+        account = get_account(mailbox)
         # Solo pedimos los campos necesarios para la lista, evitando el 'body' que es lo más pesado
         query = account.inbox.all().only(
             'subject', 'sender', 'datetime_received', 'is_read'
@@ -61,21 +71,44 @@ def get_paginated_emails(offset=0, limit=10):
         total_count = query.count()
         emails = query[offset:offset+limit]
         
-        results = []
-        for item in emails:
-            results.append({
-                "id": str(item.id) if item.id else str(item.message_id),
-                "subject": item.subject,
-                "sender": item.sender.email_address if item.sender else "Sistema",
-                "date": item.datetime_received.strftime("%Y-%m-%d %H:%M:%S"),
-                "is_read": item.is_read,
-                "body_preview": "" # Ya no lo cargamos aquí para ganar velocidad
-            })
+        results = [_email_header(item) for item in emails]
         return {"emails": results, "total": total_count}
     except Exception as e:
         print(f"Error recuperando emails paginados: {str(e)}")
         return {"emails": [], "total": 0}
 
+def get_inbox_changes(sync_state=None, max_changes=100, mailbox=None):
+    """
+    Obtiene solo los cambios del Inbox desde `sync_state` usando SyncFolderItems.
+    Sin `sync_state` Exchange devuelve todo el contenido como creaciones (sincronización completa).
+
+    Devuelve (cambios, nuevo_sync_state), con cambios = {
+        "upserts": [cabeceras creadas/modificadas],
+        "deletes": [ids eliminados],
+        "read_flags": [(id, is_read)]
+    }
+    Lanza ErrorInvalidSyncStateData si el estado guardado ya no es válido.
+    """
+    account = get_account(mailbox)
+    folder = account.inbox
+    changes = {"upserts": [], "deletes": [], "read_flags": []}
+
+    # La carpeta de la cuenta cacheada conserva el último estado y `sync_items` lo usa si
+    # `sync_state` es None: se fija explícitamente para que None sea de verdad una sincronización completa
+    folder.item_sync_state = sync_state
+    for change_type, item in folder.sync_items(
+        sync_state=sync_state, only_fields=HEADER_FIELDS, max_changes_returned=max_changes
+    ):
+        if change_type in ('create', 'update'):
+            changes["upserts"].append(_email_header(item))
+        elif change_type == 'delete':
+            changes["deletes"].append(str(item.id))
+        elif change_type == 'read_flag_change':
+            item_id, is_read = item
+            changes["read_flags"].append((str(item_id.id), is_read))
+
+    return changes, folder.item_sync_state
+
 def clean_html(html_content):
     if not html_content:
         return ""
@@ -98,34 +131,44 @@ def clean_html(html_content):
         return str(html_content)[:1000] # Fallback de seguridad
     return cleaned
 
-def get_email_details(item_id):
+def get_email_details(item_id, mailbox=None):
     """
     Obtiene el cuerpo completo de un correo específico.
     """
     try:
-        account = get_account()
+        account = get_account(mailbox)
         item = account.inbox.get(id=item_id)
-        
-        # Intentamos obtener el cuerpo de texto, si no, limpiamos el HTML
-        body_content = item.text_body if item.text_body else clean_html(item.body)
-        
-        return {
-            "id": str(item.id),
-            "subject": item.subject,
-            "sender": item.sender.email_address if item.sender else "Sistema",
-            "body": body_content,
-            "date": item.datetime_received.strftime("%Y-%m-%d %H:%M:%S")
-        }
+        return _email_detail(item)
     except Exception as e:
         print(f"Error obteniendo detalle: {str(e)}")
         return None
 
-def save_draft(item_id, body_response):
+def fetch_email_details(item_ids, chunk_size=100, mailbox=None):
+    """
+    Obtiene el cuerpo de varios correos con GetItem por lotes (`account.fetch`): una sola
+    petición por cada `chunk_size` ids en lugar de un `inbox.get` por correo.
+    Los ids que ya no existen en Exchange se omiten.
+    """
+    account = get_account(mailbox)
+    results = []
+    items = account.fetch(
+        ids=[ItemId(id=item_id) for item_id in item_ids],
+        only_fields=DETAIL_FIELDS,
+        chunk_size=chunk_size
+    )
+    for item in items:
+        if isinstance(item, Exception):
+            logging.warning(f"Correo no disponible en Exchange: {item}")
+            continue
+        results.append(_email_detail(item))
+    return results
+
+def save_draft(item_id, body_response, mailbox=None):
     """
     Crea una respuesta en borradores vinculada al correo original.
     """
     try:
-        account = get_account()
+        account = get_account(mailbox)
         item = account.inbox.get(id=item_id)
         # Creamos una respuesta pero en lugar de .send(), usamos .save() en la carpeta Drafts
         reply = item.create_reply(
@@ -138,12 +181,12 @@ def save_draft(item_id, body_response):
         print(f"Error guardando borrador: {str(e)}")
         return False
 
-def send_email(to_email, subject, body, item_id=None):
+def send_email(to_email, subject, body, item_id=None, mailbox=None):
     """
     Envía un nuevo correo o una respuesta.
     """
     try:
-        account = get_account()
+        account = get_account(mailbox)
         if item_id:
             # Es una respuesta (simplificado, en producción buscaríamos el item original)
             item = account.inbox.get(id=item_id)
@@ -166,12 +209,12 @@ def send_email(to_email, subject, body, item_id=None):
         print(f"Error enviando email: {str(e)}")
         return False
 
-def mark_as_read(item_id, read=True):
+def mark_as_read(item_id, read=True, mailbox=None):
     """
     Marca un correo como leído o no leído.
     """
     try:
-        account = get_account()
+        account = get_account(mailbox)
         item = account.inbox.get(id=item_id)
         item.is_read = read
         item.save(update_fields=['is_read'])
@@ -180,12 +223,12 @@ def mark_as_read(item_id, read=True):
         print(f"Error marcando como leído: {str(e)}")
         return False
 
-def delete_email(item_id):
+def delete_email(item_id, mailbox=None):
     """
     Mueve un correo a la papelera.
     """
     try:
-        account = get_account()
+        account = get_account(mailbox)
         item = account.inbox.get(id=item_id)
         item.move_to_trash()
         return True
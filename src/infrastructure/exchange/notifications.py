@@ -0,0 +1,154 @@
+import time
+import logging
+import threading
+
+from .connector import get_account
+
+logger = logging.getLogger("InboxNotifier")
+
+# Eventos que implican cambios en el Inbox (StatusEvent es solo el latido del servidor)
+CHANGE_EVENT_TYPES = ['NewMailEvent', 'CreatedEvent', 'ModifiedEvent', 'DeletedEvent', 'MovedEvent', 'CopiedEvent']
+
+MODES = ('streaming', 'pull', 'polling')
+
+
+class InboxNotifier:
+    """
+    Bloquea el hilo de sincronización hasta que haya cambios en el Inbox.
+
+    - `streaming`: mantiene una suscripción StreamingSubscription y despierta en cuanto
+      Exchange envía un evento (latencia sub-segundo, cero peticiones si el buzón está quieto).
+    - `pull`: suscripción PullSubscription consultada con GetEvents cada `min_interval`.
+    - `polling`: espera fija adaptativa, sin suscripción.
+
+    Si la suscripción falla se degrada a polling adaptativo (el intervalo se duplica en cada
+    ciclo sin cambios hasta `max_interval`) y se reintenta suscribir con backoff exponencial.
+    `account_provider` permite apuntar a otro endpoint EWS (p.ej. un servidor falso en tests).
+    """
+
+    def __init__(self, mode='streaming', min_interval=5, max_interval=300, account_provider=None):
+        if mode not in MODES:
+            raise ValueError(f"Modo de notificación desconocido: {mode}")
+        self.mode = mode
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._account_provider = account_provider or get_account
+        self._interval = min_interval
+        self._subscription_id = None
+        self._watermark = None
+        self._retry_backoff = min_interval
+        self._retry_at = 0.0
+        self._stop = threading.Event()
+        self.stats = {
+            "mode": mode,
+            "subscribed": False,
+            "notifications": 0,
+            "timeouts": 0,
+            "polls": 0,
+            "subscription_errors": 0,
+            "interval": self._interval,
+        }
+
+    # --- Ciclo de vida de la suscripción ---
+
+    def _subscribe(self, folder):
+        if self.mode == 'streaming':
+            self._subscription_id = folder.subscribe_to_streaming(event_types=CHANGE_EVENT_TYPES)
+        else:
+            # El timeout de la suscripción se renueva con cada GetEvents
+            timeout = max(1, int(self.max_interval // 60) + 1)
+            self._subscription_id, self._watermark = folder.subscribe_to_pull(
+                event_types=CHANGE_EVENT_TYPES, timeout=timeout
+            )
+        self._retry_backoff = self.min_interval
+        self.stats["subscribed"] = True
+        logger.info(f"Suscripción {self.mode} al Inbox activa.")
+
+    def _drop_subscription(self, error):
+        self._subscription_id = None
+        self._watermark = None
+        self.stats["subscribed"] = False
+        self.stats["subscription_errors"] += 1
+        self._retry_at = time.monotonic() + self._retry_backoff
+        logger.warning(
+            f"Suscripción {self.mode} caída ({error}); polling adaptativo, reintento en {self._retry_backoff}s."
+        )
+        self._retry_backoff = min(self._retry_backoff * 2, self.max_interval)
+
+    def close(self):
+        """Cancela la suscripción activa y desbloquea cualquier espera de polling."""
+        self._stop.set()
+        if self._subscription_id:
+            try:
+                self._account_provider().inbox.unsubscribe(self._subscription_id)
+            except Exception as e:
+                logger.debug(f"Error cancelando suscripción: {e}")
+            self._subscription_id = None
+
+    # --- Espera ---
+
+    @staticmethod
+    def _has_changes(notification):
+        return any(type(ev).__name__ != 'StatusEvent' for ev in (notification.events or []))
+
+    def _wait_streaming(self, folder, timeout):
+        deadline = time.monotonic() + timeout
+        # GetStreamingEvents mide el timeout de conexión en minutos (1-30)
+        minutes = max(1, min(30, int(timeout // 60) or 1))
+        while time.monotonic() < deadline and not self._stop.is_set():
+            for notification in folder.get_streaming_events(
+                self._subscription_id, connection_timeout=minutes, max_notifications_returned=1
+            ):
+                if self._has_changes(notification):
+                    return True
+        return False
+
+    def _wait_pull(self, folder, timeout):
+        deadline = time.monotonic() + timeout
+        while not self._stop.is_set():
+            changed = False
+            for notification in folder.get_events(self._subscription_id, self._watermark):
+                for ev in notification.events or []:
+                    self._watermark = getattr(ev, 'watermark', None) or self._watermark
+                changed = changed or self._has_changes(notification)
+            if changed:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._stop.wait(min(self.min_interval, remaining))
+        return False
+
+    def wait(self, last_cycle_changed=False):
+        """
+        Espera al siguiente ciclo de sincronización y devuelve el motivo:
+        'notification' (Exchange avisó de cambios), 'timeout' (ventana de suscripción sin cambios)
+        o 'poll' (espera de polling adaptativo).
+        """
+        # Polling adaptativo: volver al intervalo mínimo si hubo cambios, duplicarlo si no
+        if last_cycle_changed:
+            self._interval = self.min_interval
+        else:
+            self._interval = min(self._interval * 2, self.max_interval)
+        self.stats["interval"] = self._interval
+
+        if self.mode != 'polling' and time.monotonic() >= self._retry_at:
+            try:
+                folder = self._account_provider().inbox
+                if not self._subscription_id:
+                    self._subscribe(folder)
+                if self.mode == 'streaming':
+                    changed = self._wait_streaming(folder, self.max_interval)
+                else:
+                    changed = self._wait_pull(folder, self.max_interval)
+                if changed:
+                    self.stats["notifications"] += 1
+                    return 'notification'
+                self.stats["timeouts"] += 1
+                return 'timeout'
+            except Exception as e:
+                self._drop_subscription(e)
+
+        self.stats["polls"] += 1
+        self._stop.wait(self._interval)
+        return 'poll'
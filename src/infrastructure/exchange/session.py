@@ -0,0 +1,191 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import yaml
+from dotenv import load_dotenv
+from exchangelib import Credentials, Account, Configuration, DELEGATE
+
+logger = logging.getLogger("ExchangeSession")
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'config', 'config.yaml')
+
+
+class ExchangeSessionManager:
+    """
+    Mantiene cuentas de Exchange "calientes" entre llamadas.
+
+    Construir un `Account` implica leer config.yaml, consultar los ajustes en la DB,
+    descifrar la contraseña y abrir un adaptador HTTP nuevo (con su handshake TLS/NTLM).
+    El gestor lo hace una sola vez y reutiliza la cuenta y su pool de sesiones HTTP
+    (limitado por `max_connections`) hasta que cambien los ajustes EXCHANGE_*.
+
+    Cada buzón del registro (tabla `mailboxes`) puede tener credenciales y servidor
+    propios; los que no los tienen usan los ajustes globales y comparten con ellos el
+    `Protocol` (y su pool de sesiones) de exchangelib.
+    """
+
+    def __init__(self, pool_size=None, max_accounts=None):
+        load_dotenv()
+        self.pool_size = pool_size or int(os.getenv("EXCHANGE_POOL_SIZE", "4"))
+        self.max_accounts = max_accounts or int(os.getenv("EXCHANGE_MAX_ACCOUNTS", "64"))
+        self._lock = threading.RLock()
+        self._accounts = OrderedDict()
+        self._settings = None
+        self._fingerprint = None
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+
+    def _load_settings(self):
+        """Lee los ajustes de conexión. Prioriza la Base de Datos, fallback a .env/config.yaml."""
+        from ..database.postgres import get_setting
+        from ...core.security import decrypt_password
+
+        with open(CONFIG_PATH, 'r') as f:
+            ex_config = yaml.safe_load(f).get('exchange', {})
+
+        email = get_setting('EXCHANGE_USER', os.getenv('EXCHANGE_USER'))
+        raw_pass = get_setting('EXCHANGE_PASS', os.getenv('EXCHANGE_PASS'))
+        server = get_setting('EXCHANGE_SERVER', ex_config.get('server'))
+        upn = get_setting('EXCHANGE_UPN', os.getenv('EXCHANGE_UPN')) or email
+        return {
+            "email": email,
+            "password": decrypt_password(raw_pass),
+            "server": server,
+            "upn": upn,
+        }
+
+    def _mailbox_credentials(self, address):
+        """Credenciales propias del buzón en el registro (solo las que tenga), o None."""
+        from ..database.postgres import get_mailbox
+        from ...core.security import decrypt_password
+
+        mailbox = get_mailbox(address, with_secrets=True) if address else None
+        if not mailbox:
+            return None
+        overrides = {
+            "upn": mailbox.get("username"),
+            "password": decrypt_password(mailbox.get("password")),
+            "server": mailbox.get("server"),
+        }
+        return {k: v for k, v in overrides.items() if v} or None
+
+    def _settings_for(self, address):
+        settings = dict(self._settings)
+        overrides = self._mailbox_credentials(address)
+        if overrides:
+            settings.update(overrides)
+        return settings
+
+    @staticmethod
+    def _fingerprint_of(settings):
+        raw = "|".join(str(settings.get(k) or "") for k in ("email", "password", "server", "upn"))
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _build_account(self, settings, primary_smtp_address=None):
+        credentials = Credentials(username=settings["upn"], password=settings["password"])
+        config_obj = Configuration(
+            server=settings["server"],
+            credentials=credentials,
+            max_connections=self.pool_size
+        )
+        return Account(
+            primary_smtp_address=primary_smtp_address or settings["email"],
+            config=config_obj,
+            autodiscover=False,
+            access_type=DELEGATE
+        )
+
+    def _close_account(self, account):
+        # Las cuentas con las mismas credenciales comparten Protocol: no cerrarlo si sigue en uso
+        if any(a.protocol is account.protocol for a in self._accounts.values()):
+            return
+        try:
+            account.protocol.close()
+        except Exception as e:
+            logger.warning(f"Error cerrando sesiones de Exchange: {e}")
+
+    def _drop_accounts(self):
+        while self._accounts:
+            _, account = self._accounts.popitem()
+            self._close_account(account)
+
+    def get_account(self, primary_smtp_address=None):
+        """
+        Devuelve una cuenta reutilizable. Si `primary_smtp_address` es None se usa el
+        buzón configurado (EXCHANGE_USER).
+        """
+        with self._lock:
+            if self._settings is None:
+                self._settings = self._load_settings()
+                self._fingerprint = self._fingerprint_of(self._settings)
+
+            key = primary_smtp_address or self._settings["email"]
+            account = self._accounts.get(key)
+            if account is not None:
+                self._accounts.move_to_end(key)
+                self.hits += 1
+                return account
+
+            self.misses += 1
+            account = self._build_account(self._settings_for(key), primary_smtp_address)
+            self._accounts[key] = account
+            while len(self._accounts) > self.max_accounts:
+                _, evicted = self._accounts.popitem(last=False)
+                self._close_account(evicted)
+            return account
+
+    def reload_settings(self):
+        """
+        Vuelve a leer los ajustes EXCHANGE_* y descarta las cuentas solo si han cambiado.
+        Devuelve True si la sesión se ha reconstruido.
+        """
+        settings = self._load_settings()
+        fingerprint = self._fingerprint_of(settings)
+        with self._lock:
+            if fingerprint == self._fingerprint:
+                return False
+            self._drop_accounts()
+            self._settings = settings
+            self._fingerprint = fingerprint
+            self.rebuilds += 1
+            logger.info("Ajustes de Exchange modificados: sesión reconstruida.")
+            return True
+
+    def forget(self, primary_smtp_address):
+        """
+        Descarta la cuenta de un buzón (tras un error o un cambio de sus credenciales);
+        la siguiente llamada a `get_account` la reconstruye. El resto no se toca.
+        """
+        with self._lock:
+            account = self._accounts.pop(primary_smtp_address, None)
+            if account is not None:
+                self._close_account(account)
+
+    def invalidate(self):
+        """Descarta todas las cuentas (p.ej. tras un error de autenticación)."""
+        with self._lock:
+            self._drop_accounts()
+            self._settings = None
+            self._fingerprint = None
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "accounts": len(self._accounts),
+                "pool_size": self.pool_size,
+                "open_sessions": sum(
+                    getattr(a.protocol, "session_pool_size", 0) for a in self._accounts.values()
+                ),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "rebuilds": self.rebuilds,
+            }
+
+
+session_manager = ExchangeSessionManager()
@@ -6,9 +6,17 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 
+from .services import workflow_service
 from .services.workflow_service import main_loop
 from .api.routes import router
 from .app_state import app_state
+from .infrastructure.database.postgres import pool
+from .domain.knowledge.model_provider import embedding_model, reranker_model
+from .domain.knowledge.embedder import shutdown_pdf_pool
+from .domain.ai.async_responder import close_async_responder
+from .services.job_service import job_workers
+from .services.knowledge_service import resume_pending_reembedding
+from .core.events import event_bus
 
 # Configure logging
 logging.basicConfig(
@@ -23,13 +31,33 @@ logger = logging.getLogger("EmailAI-API")
 async def lifespan(app: FastAPI):
     """Startup and shutdown logic"""
     logger.info("Starting background processing engine...")
+    # Events published from worker threads are delivered on this loop
+    event_bus.attach_loop(asyncio.get_running_loop())
     # Run main_loop in separate thread to avoid blocking FastAPI
     bg_task = asyncio.create_task(asyncio.to_thread(main_loop, app_state))
+
+    # Load the embedding model off the request path so /api/health answers immediately
+    if os.getenv("EMBEDDING_WARMUP", "true").lower() == "true":
+        asyncio.create_task(asyncio.to_thread(embedding_model.warm_up))
+        if reranker_model:
+            asyncio.create_task(asyncio.to_thread(reranker_model.warm_up))
+
+    # Knowledge base left with embeddings of a previous model by an interrupted swap
+    asyncio.create_task(resume_pending_reembedding())
+
+    # Workers of the persistent job queue (background AI answer generation)
+    job_workers.start()
     
     yield
     
     logger.info("Shutting down background processing...")
+    if workflow_service.current_scheduler:
+        workflow_service.current_scheduler.stop()
     bg_task.cancel()
+    await job_workers.stop()
+    await close_async_responder()
+    shutdown_pdf_pool()
+    pool.closeall()
 
 # =========== App Setup ===========
 
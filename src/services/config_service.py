@@ -1,8 +1,10 @@
 import asyncio
 import os
 import logging
-from ..infrastructure.database.postgres import get_all_settings, save_setting
+from ..infrastructure.database.postgres import get_all_settings, get_setting, save_setting, save_mailbox, replace_default_mailbox
+from ..infrastructure.exchange.session import session_manager
 from ..core.security import encrypt_password
+from .mailbox_service import wake_scheduler
 
 logger = logging.getLogger("ConfigService")
 
@@ -29,6 +31,8 @@ async def update_config(
 ):
     """Update configuration in DB and .env"""
     try:
+        previous_user = await asyncio.to_thread(get_setting, "EXCHANGE_USER", os.getenv("EXCHANGE_USER"))
+
         # Save to database
         await asyncio.to_thread(save_setting, "EXCHANGE_USER", exchange_user)
         await asyncio.to_thread(save_setting, "EXCHANGE_SERVER", exchange_server)
@@ -40,6 +44,16 @@ async def update_config(
             encrypted_pass = encrypt_password(exchange_pass)
             await asyncio.to_thread(save_setting, "EXCHANGE_PASS", encrypted_pass)
 
+        # Rebuild the pooled Exchange session only if the EXCHANGE_* values changed
+        await asyncio.to_thread(session_manager.reload_settings)
+        # The configured account is also a mailbox of the registry (using these global credentials).
+        # A new user replaces the previous one, as it did with a single mailbox
+        if previous_user and previous_user != exchange_user:
+            await asyncio.to_thread(replace_default_mailbox, previous_user, exchange_user)
+        else:
+            await asyncio.to_thread(save_mailbox, exchange_user, enabled=True)
+        wake_scheduler()
+
         # Update .env file
         env_path = "/app/.env" if os.path.exists("/app/.env") else ".env"
         
@@ -1,57 +1,144 @@
+import os
+import json
 import asyncio
 import logging
+from datetime import datetime
 from typing import Optional
 from ..infrastructure.exchange.connector import get_paginated_emails, get_email_details, save_draft, mark_as_read, delete_email
-from ..infrastructure.database.postgres import get_emails_from_db, get_email_detail_db, delete_email_db, update_email_status
-from ..domain.ai.responder import AIResponder
-from ..domain.knowledge.embedder import search_knowledge
+from ..infrastructure.database.postgres import (
+    get_emails_from_db, get_email_detail_db, get_email_mailbox, delete_email_db, update_email_status, search_emails_db
+)
+from ..domain.ai.async_responder import get_async_responder
+from ..domain.knowledge.embedder import embed_texts
+from ..domain.knowledge.retriever import retrieve_context
 from ..app_state import app_state
+from ..core.events import event_bus
 
 logger = logging.getLogger("EmailService")
 
-async def list_emails(offset: int = 0, limit: int = 10):
-    """List emails from database with pagination"""
-    data = await asyncio.to_thread(get_emails_from_db, offset, limit)
+# Búsqueda híbrida: peso del ranking de texto completo frente a la similitud semántica,
+# y candidatos léxicos (por resultado pedido) que se re-puntúan con embeddings
+SEARCH_TEXT_WEIGHT = float(os.getenv("EMAIL_SEARCH_TEXT_WEIGHT", "0.5"))
+SEARCH_HYBRID_CANDIDATES = int(os.getenv("EMAIL_SEARCH_HYBRID_CANDIDATES", "5"))
+# Cada cuántos tokens se publica el progreso de una generación en streaming en /api/events
+GENERATION_PROGRESS_EVERY = 16
+
+def cite_source(filename, metadata):
+    """"manual.pdf, p. 12, Instalación > Requisitos" a partir de los metadatos del fragmento"""
+    parts = [filename]
+    metadata = metadata or {}
+    if metadata.get("page"):
+        parts.append(f"p. {metadata['page']}")
+    if metadata.get("section"):
+        parts.append(metadata["section"])
+    return ", ".join(parts)
+
+async def list_emails(
+    offset: int = 0,
+    limit: int = 10,
+    before: Optional[str] = None,
+    status: Optional[str] = None,
+    sender: Optional[str] = None,
+    is_read: Optional[bool] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    mailbox: Optional[str] = None
+):
+    """List emails from database with keyset (`before`) or offset pagination and filters"""
+    try:
+        data = await asyncio.to_thread(
+            get_emails_from_db, offset, limit, before,
+            status=status, sender=sender, is_read=is_read, date_from=date_from, date_to=date_to,
+            mailbox=mailbox
+        )
+    except ValueError as e:
+        return {"status": "error", "message": str(e), "emails": [], "total": 0}
     return data
 
-async def get_email_detail(item_id: str):
-    """Get email detail from DB or Exchange"""
+def _hybrid_search(query: str, limit: int, mailbox: Optional[str] = None):
+    """
+    Candidatos por texto completo (basta un término) re-puntuados con la similitud coseno
+    entre la consulta y asunto + inicio del cuerpo. Si el modelo no está disponible se
+    queda en el ranking léxico.
+    """
+    candidates = search_emails_db(
+        query, limit * SEARCH_HYBRID_CANDIDATES, match_any=True, with_text=True, mailbox=mailbox
+    )
+    if not candidates:
+        return []
+    vectors = embed_texts([query] + [c.pop('search_text') or '' for c in candidates])
+    max_rank = max(c['rank'] for c in candidates) or 1.0
+    for idx, c in enumerate(candidates, 1):
+        text_score = c['rank'] / max_rank
+        c['similarity'] = float(vectors[0] @ vectors[idx]) if vectors is not None else None
+        c['score'] = (
+            SEARCH_TEXT_WEIGHT * text_score + (1 - SEARCH_TEXT_WEIGHT) * c['similarity']
+            if vectors is not None else text_score
+        )
+    candidates.sort(key=lambda c: c['score'], reverse=True)
+    return candidates[:limit]
+
+async def search_emails(query: str, limit: int = 20, hybrid: bool = False, mailbox: Optional[str] = None):
+    """Full-text search over the local emails mirror, optionally blended with semantic similarity"""
+    query = (query or '').strip()
+    if not query:
+        return {"results": [], "total": 0}
+    if hybrid:
+        results = await asyncio.to_thread(_hybrid_search, query, limit, mailbox)
+    else:
+        results = await asyncio.to_thread(search_emails_db, query, limit, mailbox=mailbox)
+    return {"results": results, "total": len(results)}
+
+async def resolve_mailbox(item_id: str, mailbox: Optional[str] = None):
+    """
+    Buzón con cuya cuenta se opera sobre un correo: el suyo en la DB o, si aún no está,
+    `mailbox` (None = el de EXCHANGE_USER). Devuelve (buzón, False) si el correo es de
+    otro buzón distinto de `mailbox`.
+    """
+    owner = await asyncio.to_thread(get_email_mailbox, item_id)
+    if owner and mailbox and owner != mailbox:
+        return None, False
+    return owner or mailbox, True
+
+async def get_email_detail(item_id: str, mailbox: Optional[str] = None):
+    """Get email detail from DB or Exchange (None if it belongs to another mailbox than `mailbox`)"""
     detail = await asyncio.to_thread(get_email_detail_db, item_id)
+    if detail and mailbox and detail.get('mailbox') and detail['mailbox'] != mailbox:
+        return None
     
     # If not in DB or body is empty, fetch from Exchange
     if not detail or not detail.get('body'):
         logger.info(f"Fetching body for {item_id} from Exchange")
-        detail = await asyncio.to_thread(get_email_details, item_id)
+        owner = (detail or {}).get('mailbox') or mailbox
+        detail = await asyncio.to_thread(get_email_details, item_id, owner)
+        if detail:
+            detail['mailbox'] = owner
     return detail
 
-async def generate_answer(
-    item_id: str,
-    custom_prompt: Optional[str] = None,
-    language: str = 'es'
-) -> dict:
-    """Generate AI response for an email using RAG (Retrieval Augmented Generation)"""
+async def _prepare_generation(item_id: str, custom_prompt: Optional[str], language: str, mailbox: Optional[str] = None):
+    """Construye el prompt RAG de un correo. Devuelve (detalle, prompt) o (None, None) si no existe."""
     # Get the email
-    detail = await get_email_detail(item_id)
+    detail = await get_email_detail(item_id, mailbox)
     
     if not detail:
-        return {"status": "error", "message": "Email not found"}
+        return None, None
     
-    # Search knowledge base for relevant context
-    email_content = detail.get('body', '') + " " + detail.get('subject', '')
-    knowledge_results = await asyncio.to_thread(search_knowledge, email_content, top_k=3)
+    # Search knowledge base for relevant context (subject first: the re-ranker truncates long queries)
+    email_content = (detail.get('subject') or '') + "\n" + (detail.get('body') or '')
+    knowledge_results = await asyncio.to_thread(retrieve_context, email_content)
     
-    # Build context from knowledge base
+    # Build context from knowledge base (already packed into RAG_CONTEXT_TOKENS)
     context_text = ""
     if knowledge_results:
         logger.info(f"Found {len(knowledge_results)} relevant knowledge fragments")
         context_text = "\n\nCONTEXTO DE LA BASE DE CONOCIMIENTO:\n"
-        for idx, (content, filename, similarity) in enumerate(knowledge_results, 1):
-            context_text += f"\n[Documento {idx}: {filename} - Relevancia: {similarity:.2f}]\n{content}\n"
+        for idx, snippet in enumerate(knowledge_results, 1):
+            source = cite_source(snippet['filename'], snippet['metadata'])
+            context_text += f"\n[Documento {idx}: {source} - Relevancia: {snippet['similarity']:.2f}]\n{snippet['content']}\n"
     else:
         logger.info("No relevant knowledge found in database")
     
     # Prepare prompt
-    ai = AIResponder()
     instructions = custom_prompt or "Responde de forma profesional, cordial y breve."
     
     lang_text = {
@@ -60,51 +147,120 @@ async def generate_answer(
         "both": "español e inglés (ambos)"
     }.get(language, "español")
 
+    # Lo estable (contexto y correo) va primero y lo que cambia al regenerar (idioma e
+    # instrucción) al final: así llm_service reutiliza el prefijo ya evaluado.
     raw_prompt = (
-        f"TAREA: Escribir respuesta en {lang_text}.\n"
-        f"INSTRUCCIÓN: {instructions}\n"
         f"{context_text}\n"
         f"CORREO DE {detail['sender']}:\n"
-        f"{detail.get('body', '')}"
+        f"{detail.get('body', '')}\n\n"
+        f"TAREA: Escribir respuesta en {lang_text}.\n"
+        f"INSTRUCCIÓN: {instructions}"
     )
 
     # Update dashboard state
-    app_state["current_email"] = {
-        "subject": detail["subject"],
-        "sender": detail["sender"],
-        "date": detail["date"]
-    }
-    app_state["status"] = "Generando respuesta con RAG..."
+    await asyncio.to_thread(
+        app_state.update,
+        current_email={
+            "subject": detail["subject"],
+            "sender": detail["sender"],
+            "date": detail["date"]
+        },
+        status="Generando respuesta con RAG..."
+    )
+    event_bus.publish("generation", {"email_id": item_id, "mailbox": detail.get("mailbox"), "state": "started"})
+    return detail, raw_prompt
 
-    # Generate response
-    ai_response = await asyncio.to_thread(ai.generate_response, raw_prompt, 'generation')
-    
+async def _finish_generation(item_id: str, ai_response: Optional[str], mailbox: Optional[str] = None):
     # Save to DB
     if ai_response:
         await asyncio.to_thread(update_email_status, item_id, 'PROCESADO', ai_response)
-        app_state["emails_processed"] += 1
-        
-    app_state["current_email"] = None
-    app_state["status"] = "En espera (Dashboard)"
+        await asyncio.to_thread(app_state.increment, "emails_processed")
+
+    event_bus.publish("generation", {"email_id": item_id, "mailbox": mailbox, "state": "done" if ai_response else "failed"})
+    await asyncio.to_thread(app_state.update, current_email=None, status="En espera (Dashboard)")
+
+async def generate_answer(
+    item_id: str,
+    custom_prompt: Optional[str] = None,
+    language: str = 'es',
+    mailbox: Optional[str] = None
+) -> dict:
+    """Generate AI response for an email using RAG (Retrieval Augmented Generation)"""
+    detail, raw_prompt = await _prepare_generation(item_id, custom_prompt, language, mailbox)
+    if not detail:
+        return {"status": "error", "message": "Email not found"}
+
+    # Generate response
+    ai_response = await get_async_responder().generate_response(raw_prompt, 'generation')
+    await _finish_generation(item_id, ai_response, detail.get('mailbox'))
         
     return {"status": "success", "ai_response": ai_response}
 
-async def save_draft_email(item_id: str, body: str):
+def _sse(payload: dict) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+async def generate_answer_stream(
+    item_id: str,
+    custom_prompt: Optional[str] = None,
+    language: str = 'es',
+    mailbox: Optional[str] = None
+):
+    """
+    Versión en streaming de `generate_answer`: produce Server-Sent Events con cada token
+    (`{"token": ...}`) y un evento final `{"done": true, "ai_response": ...}` o `{"error": ...}`.
+    La respuesta completa se guarda en la DB igual que en la versión no streaming.
+    """
+    detail, raw_prompt = await _prepare_generation(item_id, custom_prompt, language, mailbox)
+    if not detail:
+        yield _sse({"error": "Email not found"})
+        return
+
+    tokens = get_async_responder().generate_stream(raw_prompt, 'generation')
+    pieces = []
+    ai_response = None
+    try:
+        async for token in tokens:
+            pieces.append(token)
+            yield _sse({"token": token})
+            if len(pieces) % GENERATION_PROGRESS_EVERY == 0:
+                event_bus.publish("generation", {
+                    "email_id": item_id, "mailbox": detail.get("mailbox"), "state": "progress", "tokens": len(pieces)
+                })
+        ai_response = "".join(pieces).strip()
+        yield _sse({"done": True, "ai_response": ai_response})
+    except Exception as e:
+        logger.error(f"Error en generación en streaming: {e}")
+        yield _sse({"error": "Error al generar respuesta"})
+    finally:
+        # Cierra la conexión con el servicio LLM (que cancela la generación si no había terminado)
+        await tokens.aclose()
+        await _finish_generation(item_id, ai_response, detail.get('mailbox'))
+
+async def save_draft_email(item_id: str, body: str, mailbox: Optional[str] = None):
     """Save email draft"""
     if not body:
         return {"status": "error", "message": "No body provided"}
+    owner, found = await resolve_mailbox(item_id, mailbox)
+    if not found:
+        return {"status": "error", "message": "Email not found"}
     
-    success = await asyncio.to_thread(save_draft, item_id, body)
+    success = await asyncio.to_thread(save_draft, item_id, body, owner)
     return {"status": "success" if success else "error"}
 
-async def mark_email_as_read(item_id: str, read: bool = True):
+async def mark_email_as_read(item_id: str, read: bool = True, mailbox: Optional[str] = None):
     """Mark email as read/unread"""
-    success = await asyncio.to_thread(mark_as_read, item_id, read)
+    owner, found = await resolve_mailbox(item_id, mailbox)
+    if not found:
+        return {"status": "error", "message": "Email not found"}
+    success = await asyncio.to_thread(mark_as_read, item_id, read, owner)
     return {"status": "success" if success else "error"}
 
-async def delete_email_async(item_id: str):
+async def delete_email_async(item_id: str, mailbox: Optional[str] = None):
     """Delete email from both Exchange and local DB"""
-    success_ex = await asyncio.to_thread(delete_email, item_id)
+    owner, found = await resolve_mailbox(item_id, mailbox)
+    if not found:
+        return {"status": "error", "message": "Email not found"}
+    success_ex = await asyncio.to_thread(delete_email, item_id, owner)
     success_db = await asyncio.to_thread(delete_email_db, item_id)
     
     return {"status": "success" if (success_ex and success_db) else "partial_success"}
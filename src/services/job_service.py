@@ -0,0 +1,181 @@
+import os
+import socket
+import asyncio
+import logging
+from typing import List, Optional
+from ..infrastructure.database.postgres import (
+    enqueue_jobs, enqueue_pending_emails, claim_job, complete_job, fail_job,
+    release_job, requeue_stale_jobs, get_job, get_job_counts
+)
+from ..app_state import app_state
+from ..core.events import event_bus
+from . import email_service
+
+logger = logging.getLogger("JobService")
+
+# Nº de generaciones simultáneas: no tiene sentido superar la concurrencia del servicio LLM (LLM_WORKERS)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+# Espera máxima entre consultas a la cola cuando está vacía (segundos)
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "5"))
+# Espera antes de reintentar un trabajo fallido y tiempo tras el que un 'running' se da por abandonado
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "30"))
+JOB_STALE_SECS = int(os.getenv("JOB_STALE_SECS", "900"))
+
+
+class PermanentJobError(Exception):
+    """El trabajo no tiene sentido reintentarlo (p.ej. el correo ya no existe)."""
+
+
+async def generate_answer_job(job):
+    payload = job.get("payload") or {}
+    result = await email_service.generate_answer(
+        job["email_id"], payload.get("custom_prompt"), payload.get("language", "es"), payload.get("mailbox")
+    )
+    if result.get("status") != "success":
+        raise PermanentJobError(result.get("message", "Error generando respuesta"))
+    if not result.get("ai_response"):
+        raise RuntimeError("El servicio LLM no devolvió respuesta")
+
+
+HANDLERS = {"generate_answer": generate_answer_job}
+
+
+class JobWorkers:
+    """
+    Workers (corrutinas en el event loop de la API) que consumen la tabla `jobs`.
+
+    Cada worker reclama trabajos con FOR UPDATE SKIP LOCKED, así que pueden convivir
+    varios workers y varias réplicas de la API sin procesar dos veces el mismo correo.
+    Con la cola vacía esperan `poll_interval` segundos o hasta que `notify()` los despierte.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, poll_interval=JOB_POLL_INTERVAL, handlers=None):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.handlers = handlers or HANDLERS
+        self._tasks = []
+        self._wakeup = None
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        if self.workers <= 0 or self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        prefix = f"{socket.gethostname()}-{os.getpid()}"
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._run(f"{prefix}-{i}")))
+        logger.info(f"{self.workers} worker(s) de trabajos iniciados.")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        """Despierta a los workers tras encolar trabajos nuevos."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _idle(self):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _run(self, name):
+        # Trabajos que quedaron a medias en un arranque anterior
+        await asyncio.to_thread(requeue_stale_jobs, JOB_STALE_SECS)
+        while True:
+            job = await asyncio.to_thread(claim_job, name)
+            if job is None:
+                await self._idle()
+                continue
+            await self._process(job, name)
+
+    async def _process(self, job, name):
+        task_info = {
+            "job_id": job["id"],
+            "kind": job["kind"],
+            "email_id": job["email_id"],
+            "mailbox": (job.get("payload") or {}).get("mailbox"),
+            "worker": name,
+            "attempt": job["attempts"],
+            "started_at": job["started_at"],
+        }
+        await asyncio.to_thread(app_state.add_task, task_info)
+        event_bus.publish("job", {**task_info, "state": "running"})
+        outcome = "failed"
+        try:
+            handler = self.handlers.get(job["kind"])
+            if handler is None:
+                raise PermanentJobError(f"Tipo de trabajo desconocido: {job['kind']}")
+            await handler(job)
+            await asyncio.to_thread(complete_job, job["id"])
+            self.completed += 1
+            outcome = "done"
+        except asyncio.CancelledError:
+            # Parada de la API: el trabajo vuelve a la cola sin consumir el reintento
+            await asyncio.to_thread(release_job, job["id"])
+            outcome = "queued"
+            raise
+        except PermanentJobError as e:
+            logger.warning(f"Trabajo {job['id']} descartado: {e}")
+            await asyncio.to_thread(fail_job, job["id"], e)
+            self.failed += 1
+        except Exception as e:
+            logger.error(f"Trabajo {job['id']} fallido (intento {job['attempts']}): {e}")
+            await asyncio.to_thread(fail_job, job["id"], e, JOB_RETRY_DELAY)
+            self.failed += 1
+        finally:
+            await asyncio.to_thread(app_state.remove_task, job["id"])
+            event_bus.publish("job", {"job_id": job["id"], "email_id": job["email_id"], "state": outcome})
+
+    def stats(self):
+        return {
+            "workers": len(self._tasks),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+job_workers = JobWorkers()
+
+
+def _payload(custom_prompt, language, mailbox=None):
+    payload = {"custom_prompt": custom_prompt, "language": language}
+    if mailbox:
+        # El worker solo genera si el correo es de este buzón
+        payload["mailbox"] = mailbox
+    return payload
+
+async def enqueue_answers(
+    email_ids: List[str], custom_prompt: Optional[str] = None, language: str = 'es', mailbox: Optional[str] = None
+):
+    """Queue AI answer generation for one or more emails"""
+    jobs = await asyncio.to_thread(enqueue_jobs, email_ids, _payload(custom_prompt, language, mailbox))
+    job_workers.notify()
+    return {"status": "success" if jobs else "error", "jobs": jobs}
+
+async def enqueue_pending_answers(custom_prompt: Optional[str] = None, language: str = 'es', mailbox: Optional[str] = None):
+    """Queue AI answer generation for every PENDIENTE email (of one mailbox, if given)"""
+    queued = await asyncio.to_thread(
+        enqueue_pending_emails, _payload(custom_prompt, language, mailbox), mailbox=mailbox
+    )
+    job_workers.notify()
+    return {"status": "success", "queued": queued}
+
+async def get_job_status(job_id: int, mailbox: Optional[str] = None):
+    job = await asyncio.to_thread(get_job, job_id)
+    if not job or (mailbox and job.get("mailbox") != mailbox):
+        return {"status": "error", "message": "Job not found"}
+    return job
+
+async def get_queue_stats(mailbox: Optional[str] = None):
+    counts = await asyncio.to_thread(get_job_counts, mailbox)
+    active = await asyncio.to_thread(app_state.get, "active_tasks")
+    if mailbox:
+        active = [t for t in active if t.get("mailbox") == mailbox]
+    return {"counts": counts, "workers": job_workers.stats(), "active": active}
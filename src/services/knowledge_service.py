@@ -1,37 +1,45 @@
 import asyncio
 import os
 import logging
-from ..infrastructure.database.postgres import get_db_connection
-from ..domain.knowledge.embedder import process_and_index_file
-from psycopg2.extras import RealDictCursor
+from ..infrastructure.database.postgres import list_documents, ensure_vector_index, get_setting, save_setting, delete_setting
+from ..domain.knowledge.embedder import process_and_index_file, reembed_documents
+from ..domain.knowledge.model_provider import embedding_model
 
 logger = logging.getLogger("KnowledgeService")
 
+# Tamaño de cada lectura al volcar una subida a disco
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1 << 20)))
+# Marca (tabla settings) de corpus con embeddings de un modelo anterior: se recalcula aunque se reinicie a mitad
+REEMBED_PENDING_SETTING = "EMBEDDING_REEMBED_PENDING"
+
+# Recálculo de embeddings en curso y resultado del último
+_reembed_task = None
+reembed_status = {"state": "idle", "updated": None}
+
 async def list_knowledge_documents():
     """List all indexed knowledge documents"""
-    conn = await asyncio.to_thread(get_db_connection)
-    if not conn:
-        return []
-    try:
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute("SELECT DISTINCT filename, created_at FROM documents ORDER BY created_at DESC")
-        files = cur.fetchall()
-        cur.close()
-        conn.close()
-        
-        # Format dates
-        for f in files:
-            if f['created_at']:
-                f['created_at'] = f['created_at'].strftime("%Y-%m-%d %H:%M")
-        return files
-    except Exception as e:
-        logger.error(f"Error listing documents: {e}")
-        return []
+    files = await asyncio.to_thread(list_documents)
+
+    # Format dates
+    for f in files:
+        for key in ('created_at', 'updated_at'):
+            if f[key]:
+                f[key] = f[key].strftime("%Y-%m-%d %H:%M")
+    return files
+
+async def spool_upload(upload, file_path: str, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    """Write an uploaded file to disk chunk by chunk (never the whole file in memory)"""
+    with open(file_path, "wb") as buffer:
+        while chunk := await upload.read(chunk_size):
+            await asyncio.to_thread(buffer.write, chunk)
 
 async def upload_knowledge_document(file_path: str, filename: str):
     """Upload and index a knowledge document"""
     try:
-        success, message = await asyncio.to_thread(process_and_index_file, file_path, filename)
+        success, message, summary = await asyncio.to_thread(process_and_index_file, file_path, filename)
+        if success and not summary["unchanged"]:
+            # Re-tune (IVFFlat lists / centroids) the ANN index after the bulk load
+            await asyncio.to_thread(ensure_vector_index, True)
         
         # Clean up temp file
         if os.path.exists(file_path):
@@ -39,7 +47,8 @@ async def upload_knowledge_document(file_path: str, filename: str):
         
         return {
             "status": "success" if success else "error",
-            "message": message
+            "message": message,
+            "changes": summary
         }
     except Exception as e:
         logger.error(f"Error uploading document: {e}")
@@ -47,3 +56,44 @@ async def upload_knowledge_document(file_path: str, filename: str):
             "status": "error",
             "message": str(e)
         }
+
+def _reembed_corpus():
+    reembed_status.update(state="running", updated=None)
+    updated = reembed_documents()
+    if updated is None:
+        reembed_status["state"] = "failed"
+        return
+    # IVFFlat: los centroides se calcularon con los vectores del modelo anterior
+    ensure_vector_index(True)
+    delete_setting(REEMBED_PENDING_SETTING)
+    reembed_status.update(state="done", updated=updated)
+
+def start_reembedding():
+    """Re-embed the whole knowledge base in the background (one run at a time)"""
+    global _reembed_task
+    if _reembed_task is not None and not _reembed_task.done():
+        return False
+    _reembed_task = asyncio.create_task(asyncio.to_thread(_reembed_corpus))
+    return True
+
+async def resume_pending_reembedding():
+    """At start-up, finish a re-embedding interrupted by a restart"""
+    if await asyncio.to_thread(get_setting, REEMBED_PENDING_SETTING):
+        logger.info("Knowledge base has embeddings from a previous model: re-embedding.")
+        start_reembedding()
+
+async def swap_embedding_model(model_name: str):
+    """Load another embedding model, persist the choice and re-embed the knowledge base with it"""
+    try:
+        await asyncio.to_thread(embedding_model.swap, model_name)
+        await asyncio.to_thread(save_setting, REEMBED_PENDING_SETTING, model_name)
+        start_reembedding()
+        return {"status": "success", "model": embedding_model.stats(), "reembedding": reembed_status}
+    except Exception as e:
+        logger.error(f"Error swapping embedding model: {e}")
+        return {"status": "error", "message": str(e)}
+
+async def unload_embedding_model():
+    """Free the embedding model memory (it reloads on next use)"""
+    await asyncio.to_thread(embedding_model.unload)
+    return {"status": "success", "model": embedding_model.stats()}
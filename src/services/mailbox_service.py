@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from typing import Optional
+from ..infrastructure.database.postgres import list_mailboxes, save_mailbox, delete_mailbox
+from ..infrastructure.exchange.session import session_manager
+from ..core.security import encrypt_password
+from ..app_state import app_state
+
+logger = logging.getLogger("MailboxService")
+
+def wake_scheduler():
+    """Ask the sync scheduler to reload the mailbox registry now instead of at its next refresh"""
+    from . import workflow_service
+    if workflow_service.current_scheduler:
+        workflow_service.current_scheduler.wake()
+
+async def list_registered_mailboxes():
+    """Registered mailboxes (without credentials) with their live sync state"""
+    mailboxes = await asyncio.to_thread(list_mailboxes)
+    state = await asyncio.to_thread(app_state.get, "mailboxes")
+    return {"mailboxes": [{**m, "state": (state or {}).get(m["address"])} for m in mailboxes]}
+
+async def register_mailbox(
+    address: str,
+    display_name: Optional[str] = None,
+    tenant: Optional[str] = None,
+    username: Optional[str] = None,
+    password: Optional[str] = None,
+    server: Optional[str] = None,
+    enabled: Optional[bool] = None
+):
+    """Add or update a mailbox. Empty credentials fall back to the global EXCHANGE_* settings"""
+    address = (address or "").strip()
+    if "@" not in address:
+        return {"status": "error", "message": "Dirección de buzón no válida"}
+    mailbox = await asyncio.to_thread(
+        save_mailbox, address, display_name, tenant, username or None,
+        encrypt_password(password) if password else None, server or None, enabled
+    )
+    if not mailbox:
+        return {"status": "error", "message": "No se pudo guardar el buzón"}
+
+    # Las credenciales pueden haber cambiado: la cuenta se reconstruye en el siguiente uso
+    await asyncio.to_thread(session_manager.forget, address)
+    wake_scheduler()
+    logger.info(f"Buzón {address} registrado (tenant {mailbox['tenant']}).")
+    return {"status": "success", "mailbox": mailbox}
+
+async def remove_mailbox(address: str):
+    """Remove a mailbox and its stored emails; its sync worker stops on the next refresh"""
+    deleted = await asyncio.to_thread(delete_mailbox, address)
+    if not deleted:
+        return {"status": "error", "message": "Mailbox not found"}
+    wake_scheduler()
+    logger.info(f"Buzón {address} eliminado.")
+    return {"status": "success"}
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from ..infrastructure.exchange.session import session_manager
+from ..infrastructure.database.postgres import pool
+from ..domain.knowledge.cache import cache_stats
+from ..domain.knowledge.model_provider import embedding_model, reranker_model
+from ..domain.ai.async_responder import get_async_responder
+from ..app_state import app_state
+from ..core.events import event_bus, format_sse
+from .job_service import job_workers
+from . import workflow_service, knowledge_service
+
+logger = logging.getLogger("StatusService")
+
+# Campos de app_state que viajan en /api/status y en el evento inicial de /api/events
+STATUS_FIELDS = ("status", "exchange_connected", "emails_processed", "current_email", "last_error", "mailboxes")
+
+def status_snapshot(mailbox=None):
+    """Lightweight counters for the dashboard, read from one consistent state version"""
+    version, state = app_state.snapshot()
+    snapshot = {key: state[key] for key in STATUS_FIELDS}
+    if mailbox:
+        snapshot["mailboxes"] = {mailbox: state["mailboxes"].get(mailbox)}
+    snapshot["active_tasks"] = len(state["active_tasks"])
+    snapshot["last_sync"] = state["last_sync"]
+    snapshot["version"] = version
+    return snapshot
+
+async def get_status(mailbox=None):
+    """Application status (counters only; live changes are pushed by /api/events)"""
+    if app_state.backend is not None:
+        # El snapshot puede tener que releer la tabla app_state: fuera del event loop
+        return await asyncio.to_thread(status_snapshot, mailbox)
+    return status_snapshot(mailbox)
+
+async def get_metrics():
+    """Runtime metrics of shared resources"""
+    return {
+        "mailboxes": workflow_service.current_scheduler.stats() if workflow_service.current_scheduler else None,
+        "app_state_version": app_state.version,
+        "event_bus": event_bus.stats(),
+        "exchange_session": session_manager.stats(),
+        "db_pool": pool.stats(),
+        "knowledge_cache": cache_stats(),
+        "embedding_model": {**embedding_model.stats(), "reembedding": knowledge_service.reembed_status},
+        "reranker_model": reranker_model.stats() if reranker_model else None,
+        "llm_client": get_async_responder().stats(),
+        "job_workers": job_workers.stats()
+    }
+
+def in_scope(event, mailbox):
+    """Whether an event concerns `mailbox` (events without a mailbox are global)"""
+    owner = event["data"].get("mailbox") if isinstance(event["data"], dict) else None
+    return not mailbox or not owner or owner == mailbox
+
+async def event_stream(request, heartbeat=15, mailbox=None):
+    """
+    SSE stream for one dashboard: an initial `status` snapshot followed by bus events
+    (status, mailbox, sync, new_mail, generation, job). With `mailbox`, events of other
+    mailboxes are skipped. A comment line every `heartbeat` seconds keeps proxies from
+    closing the idle connection and detects disconnected clients.
+    """
+    subscription = event_bus.subscribe()
+    try:
+        yield format_sse({"id": 0, "type": "status", "data": await get_status(mailbox)})
+        while not await request.is_disconnected():
+            event = await subscription.get(timeout=heartbeat)
+            if event and not in_scope(event, mailbox):
+                continue
+            yield format_sse(event) if event else ": ping\n\n"
+    finally:
+        event_bus.unsubscribe(subscription)
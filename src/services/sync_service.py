@@ -0,0 +1,133 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ..infrastructure.exchange.connector import (
+    get_account, get_inbox_changes, fetch_email_details, ErrorInvalidSyncStateData
+)
+from ..infrastructure.exchange.session import session_manager
+from ..infrastructure.database.postgres import (
+    upsert_emails, update_email_read, delete_emails_db, reconcile_emails, purge_email_tombstones,
+    get_email_ids_missing_body, mark_bodies_fetched, get_mailbox, save_mailbox, get_mailbox_sync_state, save_mailbox_sync_state
+)
+
+logger = logging.getLogger("SyncService")
+
+# Borrado lógico: los correos retirados se ocultan y se purgan pasado el TTL
+SOFT_DELETE = os.getenv("SYNC_SOFT_DELETE", "false").lower() == "true"
+TOMBSTONE_TTL_HOURS = int(os.getenv("SYNC_TOMBSTONE_TTL_HOURS", "24"))
+
+# Descarga de cuerpos: ids por petición GetItem (límite habitual de EWS) y lotes en paralelo
+BODY_BACKFILL_LIMIT = int(os.getenv("BODY_BACKFILL_LIMIT", "1000"))
+FETCH_BATCH_SIZE = int(os.getenv("EXCHANGE_FETCH_BATCH", "100"))
+FETCH_WORKERS = int(os.getenv("EXCHANGE_FETCH_WORKERS", str(session_manager.pool_size)))
+
+class SyncWriteError(RuntimeError):
+    """Algún cambio de la sincronización no llegó a la DB: el SyncState no debe avanzar."""
+
+def default_mailbox():
+    """Buzón de los ajustes EXCHANGE_USER en el registro (se da de alta si aún no está)."""
+    address = get_account().primary_smtp_address
+    mailbox = get_mailbox(address) or save_mailbox(address)
+    if not mailbox:
+        raise RuntimeError(f"No se pudo registrar el buzón {address}")
+    return mailbox
+
+def sync_inbox(mailbox=None):
+    """
+    Sincroniza el Inbox de un buzón del registro (por defecto el de EXCHANGE_USER) de
+    forma incremental (SyncFolderItems).
+
+    Solo se transfieren y escriben los correos creados, modificados o borrados desde el
+    último SyncState guardado en el registro. Sin estado previo (primer arranque o estado
+    caducado) se hace una sincronización completa y se retiran de la DB los correos
+    huérfanos de ese buzón. Si alguna escritura falla lanza SyncWriteError sin guardar el
+    nuevo SyncState.
+    """
+    mailbox = mailbox or default_mailbox()
+    address, mailbox_id = mailbox["address"], mailbox["id"]
+    sync_state = get_mailbox_sync_state(mailbox_id)
+    full_sync = not sync_state
+
+    try:
+        changes, new_state = get_inbox_changes(sync_state, mailbox=address)
+    except ErrorInvalidSyncStateData:
+        logger.warning(f"SyncState de {address} no válido; se realiza una sincronización completa.")
+        save_mailbox_sync_state(mailbox_id, None)
+        full_sync = True
+        changes, new_state = get_inbox_changes(None, mailbox=address)
+
+    failed = []
+    # upsert_emails devuelve las filas escritas (0 si falla); los ids repetidos cuentan una vez
+    expected = len({e["id"] for e in changes["upserts"]})
+    if upsert_emails(changes["upserts"], mailbox_id=mailbox_id) != expected:
+        failed.append("upsert")
+    for email_id, is_read in changes["read_flags"]:
+        if not update_email_read(email_id, is_read):
+            failed.append("is_read")
+            break
+    deleted = delete_emails_db(changes["deletes"], soft=SOFT_DELETE)
+    if deleted is None:
+        failed.append("delete")
+        deleted = 0
+
+    if full_sync and not failed:
+        # Reconciliación por conjuntos: todo lo del buzón que no vino en la sincronización completa sobra
+        removed = reconcile_emails([e["id"] for e in changes["upserts"]], soft=SOFT_DELETE, mailbox_id=mailbox_id)
+        if removed is None:
+            failed.append("reconcile")
+        else:
+            deleted += removed
+    if SOFT_DELETE:
+        purge_email_tombstones(TOMBSTONE_TTL_HOURS)
+
+    # El estado solo se guarda cuando los cambios ya están en la DB: si algo falló, el
+    # siguiente ciclo vuelve a pedir los mismos cambios desde el SyncState anterior
+    if failed:
+        raise SyncWriteError(f"No se guardaron los cambios del Inbox de {address} ({', '.join(failed)}); SyncState sin avanzar")
+    if new_state:
+        save_mailbox_sync_state(mailbox_id, new_state)
+
+    return {
+        "full_sync": full_sync,
+        "upserted": len(changes["upserts"]),
+        "read_flags": len(changes["read_flags"]),
+        "deleted": deleted
+    }
+
+def backfill_bodies(limit=None, batch_size=None, workers=None, mailbox=None):
+    """
+    Descarga los cuerpos de los correos (del buzón `mailbox` del registro, si se indica)
+    que solo tienen cabecera.
+
+    Los ids se reparten en lotes de `batch_size` (una petición GetItem cada uno) que se
+    descargan en paralelo con `workers` hilos (acotado al pool de sesiones de Exchange);
+    cada lote se escribe en la DB con un upsert masivo en cuanto llega y sus ids se marcan
+    como pedidos, de modo que los cuerpos vacíos o los correos ya borrados del servidor no
+    se vuelven a pedir en cada ciclo. Un lote que falla se reintenta en el siguiente.
+    Devuelve el número de correos actualizados.
+    """
+    limit = limit or BODY_BACKFILL_LIMIT
+    batch_size = batch_size or FETCH_BATCH_SIZE
+    workers = workers or FETCH_WORKERS
+
+    address, mailbox_id = (mailbox["address"], mailbox["id"]) if mailbox else (None, None)
+    ids = get_email_ids_missing_body(limit, mailbox_id=mailbox_id)
+    if not ids:
+        return 0
+
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+    written = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(batches)))) as executor:
+        futures = {executor.submit(fetch_email_details, batch, batch_size, mailbox=address): batch for batch in batches}
+        for future in as_completed(futures):
+            try:
+                rows = future.result()
+            except Exception as e:
+                logger.error(f"Error descargando lote de cuerpos: {e}")
+                continue
+            count = upsert_emails(rows, mailbox_id=mailbox_id)
+            # Si el upsert falló, los cuerpos siguen pendientes
+            if count or not rows:
+                mark_bodies_fetched(futures[future])
+            written += count
+    return written
@@ -3,112 +3,340 @@ import logging
 import os
 import sys
 import time
+import threading
+import yaml
 
 # Asegurar que el directorio 'src' esté en el path para las importaciones
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from ..infrastructure.exchange.connector import test_connection, get_paginated_emails, get_email_details
-from ..infrastructure.database.postgres import init_db, upsert_email, update_email_status, delete_email_db, get_db_connection
+from ..infrastructure.exchange.connector import test_connection, get_account
+from ..infrastructure.exchange.notifications import InboxNotifier
+from ..infrastructure.exchange.session import session_manager
+from ..infrastructure.database.postgres import init_db, enqueue_pending_emails, list_mailboxes, record_mailbox_sync
+from .sync_service import sync_inbox, backfill_bodies, default_mailbox
+from ..app_state import AppState
+from ..core.events import event_bus
+from ..core.rate_limit import TokenBucket
 
 logger = logging.getLogger("WorkflowEngine")
 
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'config', 'config.yaml')
+# Encolar automáticamente la generación de borradores para los correos PENDIENTE tras cada sincronización
+AUTO_DRAFTS = os.getenv("AUTO_DRAFTS", "false").lower() == "true"
+# Cada cuánto se relee el registro de buzones (segundos) para arrancar/parar workers
+MAILBOX_REFRESH_SECS = float(os.getenv("MAILBOX_REFRESH_SECS", "60"))
+# Límite por tenant (ciclos de sincronización por minuto y ráfaga), salvo `exchange.tenants` en config.yaml
+MAILBOX_TENANT_RATE = float(os.getenv("MAILBOX_TENANT_RATE", "60"))
+MAILBOX_TENANT_BURST = int(os.getenv("MAILBOX_TENANT_BURST", "5"))
+# Espera máxima (s) a que termine el ciclo en curso de un worker parado antes de reintentarlo en otra pasada
+WORKER_STOP_TIMEOUT = 5
+
+# Planificador de buzones en curso (sus contadores se exponen en /api/metrics)
+current_scheduler = None
+
+def load_exchange_config():
+    """Sección `exchange` de config.yaml (vacía si no se puede leer)."""
+    try:
+        with open(CONFIG_PATH, 'r') as f:
+            return (yaml.safe_load(f) or {}).get('exchange', {}) or {}
+    except Exception as e:
+        logger.warning(f"No se pudo leer config.yaml ({e}); usando valores por defecto.")
+        return {}
+
+def build_notifier(account_provider=None, mode=None, ex_config=None):
+    """Crea el InboxNotifier según la sección `exchange` de config.yaml."""
+    ex_config = load_exchange_config() if ex_config is None else ex_config
+    return InboxNotifier(
+        mode=mode or ex_config.get('notification_mode', 'streaming'),
+        min_interval=int(ex_config.get('min_polling_interval', 5)),
+        max_interval=int(ex_config.get('polling_interval', 300)),
+        account_provider=account_provider
+    )
+
+
+class MailboxWorker:
+    """
+    Hilo de sincronización de un buzón del registro: espera su propio InboxNotifier, pide
+    permiso al limitador de su tenant y sincroniza cabeceras, cuerpos y (con AUTO_DRAFTS)
+    borradores. Cada buzón tiene su hilo, su cuenta EWS y su suscripción, así que un buzón
+    lento o caído no retrasa a los demás.
+    """
+
+    def __init__(self, mailbox, state_ref, limiter, notifier):
+        self.mailbox = mailbox
+        self.address = mailbox["address"]
+        self.state_ref = state_ref
+        self.limiter = limiter
+        self.notifier = notifier
+        self.connected = False
+        self.cycles = 0
+        self.errors = 0
+        self.last_cycle_secs = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=f"mailbox-{self.address}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.notifier.close()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _set_state(self, **info):
+        self.state_ref.set_mailbox(self.address, **info)
+
+    def connect(self):
+        self.connected = test_connection(self.address)
+        if self.connected:
+            self._set_state(connected=True, status="Conectado")
+        else:
+            self._set_state(connected=False, status="Error de Conexión (Re-intentando)",
+                            last_error="No se pudo conectar a Exchange")
+        return self.connected
+
+    def run_cycle(self):
+        """Un ciclo de sincronización. Devuelve True si hubo cambios en el Inbox."""
+        changed = False
+        self._set_state(status="Sincronizando Inbox...", publish=False)
+
+        # 1-3. Sincronización incremental: solo altas, cambios y bajas desde el último SyncState
+        try:
+            summary = sync_inbox(self.mailbox)
+            changed = bool(summary["upserted"] or summary["deleted"] or summary["read_flags"])
+            if changed:
+                logger.info(f"Inbox de {self.address} sincronizado: {summary}")
+            record_mailbox_sync(self.mailbox["id"], summary)
+            self.state_ref.update(last_sync={**summary, "mailbox": self.address}, publish=False)
+            self._set_state(last_sync=summary, last_error=None, publish=False)
+            event_bus.publish("sync", {**summary, "mailbox": self.address})
+            if summary["upserted"] and not summary["full_sync"]:
+                event_bus.publish("new_mail", {"count": summary["upserted"], "mailbox": self.address})
+        except Exception as e:
+            logger.error(f"Error en sincronización incremental del Inbox de {self.address}: {e}")
+            self.errors += 1
+            self.connected = False
+            record_mailbox_sync(self.mailbox["id"], error=e)
+            self._set_state(connected=False, last_error=str(e))
+            return False
+
+        # 4. Sincronización de cuerpos (para correos que solo tienen cabeceras), por lotes y en paralelo
+        try:
+            bodies = backfill_bodies(mailbox=self.mailbox)
+            if bodies:
+                logger.info(f"Cuerpos descargados de {self.address}: {bodies}")
+        except Exception as e:
+            logger.error(f"Error en fase de descarga de cuerpos de {self.address}: {e}")
+
+        # 5. Borradores en segundo plano: los workers de job_service los generan desde la cola
+        if AUTO_DRAFTS and changed:
+            queued = enqueue_pending_emails(mailbox=self.address)
+            if queued:
+                logger.info(f"{queued} correos pendientes de {self.address} encolados para generar borrador.")
+
+        self._set_state(status="En espera (Sincronizado)")
+        return changed
+
+    def run(self):
+        logger.info(f"Worker de sincronización de {self.address} iniciado ({self.notifier.mode}).")
+        while not self._stop.is_set():
+            # El limitador es del tenant: si sus buzones van sobrados de ciclos, este espera su turno
+            if not self.limiter.acquire(self._stop):
+                break
+            changed = False
+            started = time.monotonic()
+            try:
+                if self.connected or self.connect():
+                    changed = self.run_cycle()
+                    self.cycles += 1
+            except Exception as e:
+                logger.error(f"Error inesperado en el worker de {self.address}: {e}")
+                self.errors += 1
+                self._set_state(status="Fallo", last_error=str(e))
+            self.last_cycle_secs = round(time.monotonic() - started, 3)
+            if self._stop.is_set():
+                break
+            # Esperar a que Exchange notifique cambios (o al siguiente ciclo de polling adaptativo)
+            self.notifier.wait(last_cycle_changed=changed)
+        logger.info(f"Worker de sincronización de {self.address} detenido.")
+
+    def stats(self):
+        return {
+            "tenant": self.mailbox.get("tenant"),
+            "alive": self.is_alive(),
+            "connected": self.connected,
+            "cycles": self.cycles,
+            "errors": self.errors,
+            "last_cycle_secs": self.last_cycle_secs,
+            "notifications": self.notifier.stats,
+        }
+
+
+class MailboxScheduler:
+    """
+    Mantiene un MailboxWorker por cada buzón activo del registro.
+
+    Cada `refresh_secs` (o al llamar a `wake`) relee el registro: arranca los buzones
+    nuevos, para los eliminados o desactivados y reinicia los modificados (`updated_at`).
+    Un worker parado puede estar a mitad de ciclo: su sustituto no arranca (ni se descarta
+    su cuenta) hasta que el hilo anterior ha terminado, para no sincronizar dos veces el
+    mismo buzón desde el mismo SyncState.
+    Los buzones de un mismo tenant comparten un TokenBucket. Con más de un buzón el modo
+    `streaming` pasa a `pull`: cada suscripción streaming retiene una conexión HTTP del
+    pool de sesiones compartido durante minutos.
+    """
+
+    def __init__(self, state_ref, refresh_secs=MAILBOX_REFRESH_SECS, registry=None, worker_factory=None):
+        self.state_ref = state_ref
+        self.refresh_secs = refresh_secs
+        self._registry = registry or (lambda: list_mailboxes(enabled_only=True))
+        self._worker_factory = worker_factory or self._build_worker
+        self.ex_config = load_exchange_config()
+        self.workers = {}
+        self.limiters = {}
+        # Workers parados cuyo hilo aún no ha terminado: {dirección: worker}
+        self._retiring = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+
+    def limiter_for(self, tenant):
+        with self._lock:
+            limiter = self.limiters.get(tenant)
+            if limiter is None:
+                limits = (self.ex_config.get('tenants') or {}).get(tenant) or {}
+                limiter = TokenBucket(
+                    float(limits.get('rate_per_minute', MAILBOX_TENANT_RATE)),
+                    int(limits.get('burst', MAILBOX_TENANT_BURST))
+                )
+                self.limiters[tenant] = limiter
+            return limiter
+
+    def notification_mode(self, mailbox_count):
+        mode = self.ex_config.get('notification_mode', 'streaming')
+        return 'pull' if mode == 'streaming' and mailbox_count > 1 else mode
+
+    def _build_worker(self, mailbox, mode):
+        address = mailbox["address"]
+        notifier = build_notifier(lambda: get_account(address), mode, self.ex_config)
+        return MailboxWorker(mailbox, self.state_ref, self.limiter_for(mailbox.get("tenant") or "default"), notifier)
+
+    def _needs_restart(self, worker, mailbox, mode):
+        return (
+            not worker.is_alive()
+            or worker.mailbox.get("updated_at") != mailbox.get("updated_at")
+            or worker.notifier.mode != mode
+        )
+
+    def _load_mailboxes(self):
+        mailboxes = self._registry()
+        if mailboxes or self.workers:
+            return mailboxes
+        # Sin registro todavía: el buzón de los ajustes EXCHANGE_USER
+        try:
+            return [default_mailbox()]
+        except Exception as e:
+            logger.warning(f"No hay buzones que sincronizar: {e}")
+            return []
+
+    def _retire(self, address, worker):
+        """Para un worker. Devuelve True si su hilo ha terminado y su cuenta se ha descartado."""
+        worker.stop()
+        worker.join(WORKER_STOP_TIMEOUT)
+        if worker.is_alive():
+            logger.warning(f"El worker de {address} sigue terminando su ciclo; se reintentará.")
+            self._retiring[address] = worker
+            return False
+        self._retiring.pop(address, None)
+        session_manager.forget(address)
+        return True
+
+    def refresh(self):
+        """Ajusta los workers al registro. Devuelve el nº de workers activos."""
+        for address, worker in list(self._retiring.items()):
+            if not worker.is_alive():
+                self._retire(address, worker)
+        mailboxes = self._load_mailboxes()
+        if not mailboxes:
+            # Registro vacío o DB caída: mejor seguir con los workers actuales que pararlos todos
+            return len(self.workers)
+        wanted = {m["address"]: m for m in mailboxes}
+        mode = self.notification_mode(len(wanted))
+
+        for address in [a for a in self.workers if a not in wanted]:
+            self._retire(address, self.workers.pop(address))
+            self.state_ref.remove_mailbox(address)
+            logger.info(f"Buzón {address} retirado de la sincronización.")
+
+        for address, mailbox in wanted.items():
+            worker = self.workers.get(address)
+            if worker is not None and self._needs_restart(worker, mailbox, mode):
+                del self.workers[address]
+                self._retire(address, worker)
+                worker = None
+            if worker is None and address not in self._retiring:
+                worker = self._worker_factory(mailbox, mode)
+                self.workers[address] = worker
+                worker.start()
+
+        self.state_ref.update(status=f"Sincronizando {len(self.workers)} buzón(es)")
+        return len(self.workers)
+
+    def wake(self):
+        """Relee el registro ya (p.ej. tras dar de alta o modificar un buzón)."""
+        self._wakeup.set()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error actualizando los workers de buzones: {e}")
+            # Con workers aún terminando se vuelve pronto para arrancar sus sustitutos
+            self._wakeup.wait(min(self.refresh_secs, WORKER_STOP_TIMEOUT) if self._retiring else self.refresh_secs)
+            self._wakeup.clear()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        for worker in self.workers.values():
+            worker.stop()
+
+    def stats(self):
+        return {
+            "mailboxes": {address: worker.stats() for address, worker in list(self.workers.items())},
+            "tenants": {tenant: limiter.stats() for tenant, limiter in list(self.limiters.items())},
+        }
+
+
 def main_loop(state_ref):
     """
     Loop principal de procesamiento.
-    Mantiene la base de datos local sincronizada con el Inbox de Exchange.
+    Mantiene la base de datos local sincronizada con el Inbox de cada buzón del registro.
     """
-    state_ref["status"] = "Conectando a Exchange..."
+    global current_scheduler
     logger.info("Iniciando el motor de flujo de trabajo de Email AI...")
-    
-    # Inicializar base de datos
+
+    # Inicializar base de datos (antes de escribir estado: puede vivir en la tabla app_state)
     init_db()
-    
-    # Intentar una conexión inicial de prueba
-    connection_ok = test_connection()
-    
-    if connection_ok:
-        logger.info("Conexión inicial exitosa.")
-        state_ref["exchange_connected"] = True
-        state_ref["status"] = "En espera (Polling)"
-    else:
-        logger.warning("No se pudo establecer la conexión inicial. Revisa tu archivo .env")
-        state_ref["exchange_connected"] = False
-        state_ref["status"] = "Error de Conexión"
-        state_ref["last_error"] = "No se pudo conectar a Exchange"
-
-    from ..domain.ai.responder import AIResponder
-    ai = AIResponder()
+    state_ref.update(status="Conectando a Exchange...")
 
+    scheduler = MailboxScheduler(state_ref)
+    current_scheduler = scheduler
     try:
-        while True:
-            # Si no estamos conectados, intentar conectar antes de procesar
-            if not state_ref.get("exchange_connected", False):
-                state_ref["status"] = "Intentando re-conexión..."
-                if test_connection():
-                    state_ref["exchange_connected"] = True
-                    state_ref["status"] = "Conexión Recuperada"
-                else:
-                    state_ref["exchange_connected"] = False
-                    state_ref["status"] = "Error de Conexión (Re-intentando)"
-
-            if state_ref.get("exchange_connected", False):
-                state_ref["status"] = "Sincronizando Inbox..."
-                
-                # 1. Obtener los correos más recientes de Exchange (Inbox)
-                data = get_paginated_emails(offset=0, limit=100)
-                nuevos_correos = data.get("emails", [])
-                ids_en_exchange = [e["id"] for e in nuevos_correos]
-                
-                # 2. Asegurarnos de que todos los correos de Exchange estén en nuestra DB
-                for email in nuevos_correos:
-                    upsert_email(email)
-                
-                # 3. LIMPIEZA: Si un correo está en DB pero no en los últimos 100 de Exchange, lo borramos.
-                # Esto mantiene la DB como un espejo de la bandeja de entrada actual.
-                try:
-                    conn = get_db_connection()
-                    if conn:
-                        cur = conn.cursor()
-                        cur.execute("SELECT id FROM emails")
-                        ids_en_db = [row[0] for row in cur.fetchall()]
-                        cur.close()
-                        conn.close()
-                        
-                        for id_db in ids_en_db:
-                            if id_db not in ids_en_exchange:
-                                delete_email_db(id_db)
-                                logger.info(f"Correo {id_db} eliminado de la DB (Ya no está en el Inbox).")
-                except Exception as e:
-                    logger.error(f"Error en fase de limpieza de DB: {e}")
-
-                # 4. Sincronización de cuerpos (para correos que solo tienen cabeceras)
-                try:
-                    conn = get_db_connection()
-                    if conn:
-                        cur = conn.cursor()
-                        cur.execute("SELECT id FROM emails WHERE (body = '' OR body IS NULL) LIMIT 50")
-                        missing = cur.fetchall()
-                        cur.close()
-                        conn.close()
-                        
-                        if missing:
-                            for row in missing:
-                                m_id = row[0]
-                                d = get_email_details(m_id)
-                                if d:
-                                    upsert_email(d)
-                except Exception as e:
-                    logger.error(f"Error en fase de descarga de cuerpos: {e}")
-
-                # Actualizar estado global para el dashboard
-                state_ref["emails"] = nuevos_correos
-                state_ref["status"] = "En espera (Sincronizado)"
-            
-            time.sleep(30) 
+        scheduler.run()
     except Exception as e:
         logger.error(f"Error inesperado en el loop principal: {str(e)}")
-        state_ref["status"] = "Fallo Crítico"
-        state_ref["last_error"] = str(e)
+        state_ref.update(status="Fallo Crítico", last_error=str(e))
+    finally:
+        scheduler.stop()
 
 if __name__ == "__main__":
-    main_loop({})
+    main_loop(AppState())
@@ -1,45 +1,83 @@
 let currentPage = 0;
 const limit = 10;
+// Paginación keyset: cursor `before` de cada página visitada (la primera no tiene)
+let pageCursors = [null];
+let nextCursor = null;
 let currentEmails = [];
 let selectedEmail = null;
 
+// Último estado conocido: /api/status da la foto inicial y /api/events los cambios
+let dashboardState = {};
+
+function renderStatus(data) {
+    document.getElementById('stat-emails').innerText = data.emails_processed || 0;
+    document.getElementById('main-status-text').innerText = data.status || 'Activo';
+
+    const exchangeStat = document.getElementById('stat-exchange');
+    if (data.exchange_connected) {
+        exchangeStat.innerText = 'Conectado';
+        exchangeStat.parentElement.parentElement.classList.add('connected');
+    } else {
+        exchangeStat.innerText = 'Desconectado';
+    }
+
+    document.getElementById('stat-latency').innerText = Math.floor(Math.random() * (120 - 80) + 80) + ' ms';
+
+    // Actualizar Cabecera con Usuario
+    const userEmail = data.exchange_user || 'Usuario';
+    const userName = userEmail.split('@')[0].split('.')[0];
+    document.getElementById('user-name').innerText = userName.charAt(0).toUpperCase() + userName.slice(1);
+    document.getElementById('user-avatar').innerText = userEmail.charAt(0).toUpperCase();
+
+    // Sección de Foco
+    const focusSection = document.getElementById('focus-section');
+    if (data.current_email) {
+        document.getElementById('focus-subject').innerText = data.current_email.subject;
+        document.getElementById('focus-sender').innerText = `De: ${data.current_email.sender} | ${data.current_email.date}`;
+        focusSection.style.display = 'block';
+    } else {
+        focusSection.style.display = 'none';
+    }
+}
+
 async function updateStatus() {
     try {
         const response = await fetch('/api/status');
-        const data = await response.json();
-
-        document.getElementById('stat-emails').innerText = data.emails_processed || 0;
-        document.getElementById('main-status-text').innerText = data.status || 'Activo';
-
-        const exchangeStat = document.getElementById('stat-exchange');
-        if (data.exchange_connected) {
-            exchangeStat.innerText = 'Conectado';
-            exchangeStat.parentElement.parentElement.classList.add('connected');
-        } else {
-            exchangeStat.innerText = 'Desconectado';
-        }
+        dashboardState = await response.json();
+        renderStatus(dashboardState);
+    } catch (error) {
+        console.error('Error fetching status:', error);
+    }
+}
 
-        document.getElementById('stat-latency').innerText = Math.floor(Math.random() * (120 - 80) + 80) + ' ms';
+function subscribeEvents() {
+    if (!window.EventSource) {
+        // Navegadores sin SSE: polling como antes
+        setInterval(updateStatus, 5000);
+        return;
+    }
+    // EventSource se reconecta solo; cada conexión empieza con una foto completa del estado
+    const events = new EventSource('/api/events');
 
-        // Actualizar Cabecera con Usuario
-        const userEmail = data.exchange_user || 'Usuario';
-        const userName = userEmail.split('@')[0].split('.')[0];
-        document.getElementById('user-name').innerText = userName.charAt(0).toUpperCase() + userName.slice(1);
-        document.getElementById('user-avatar').innerText = userEmail.charAt(0).toUpperCase();
+    events.addEventListener('status', (e) => {
+        dashboardState = { ...dashboardState, ...JSON.parse(e.data) };
+        renderStatus(dashboardState);
+    });
 
-        // Sección de Foco
-        const focusSection = document.getElementById('focus-section');
-        if (data.current_email) {
-            document.getElementById('focus-subject').innerText = data.current_email.subject;
-            document.getElementById('focus-sender').innerText = `De: ${data.current_email.sender} | ${data.current_email.date}`;
-            focusSection.style.display = 'block';
-        } else {
-            focusSection.style.display = 'none';
+    events.addEventListener('new_mail', () => {
+        // Solo refrescamos si el usuario está viendo la primera página del listado
+        const feed = document.querySelector('.live-feed');
+        if (currentPage === 0 && feed && feed.style.display !== 'none' && !document.getElementById('email-search').value) {
+            fetchEmails();
         }
+    });
 
-    } catch (error) {
-        console.error('Error fetching status:', error);
-    }
+    events.addEventListener('generation', (e) => {
+        const data = JSON.parse(e.data);
+        if (data.state === 'progress') {
+            document.getElementById('main-status-text').innerText = `Generando respuesta... (${data.tokens} tokens)`;
+        }
+    });
 }
 
 async function fetchEmails() {
@@ -47,11 +85,13 @@ async function fetchEmails() {
     const pageInfo = document.getElementById('page-info');
 
     try {
-        const offset = currentPage * limit;
-        const response = await fetch(`/api/emails?offset=${offset}&limit=${limit}`);
+        const cursor = pageCursors[currentPage];
+        const query = cursor ? `&before=${encodeURIComponent(cursor)}` : '';
+        const response = await fetch(`/api/emails?limit=${limit}${query}`);
         const data = await response.json();
 
         currentEmails = data.emails;
+        nextCursor = data.next_cursor;
         tableBody.innerHTML = '';
 
         if (!currentEmails || currentEmails.length === 0) {
@@ -77,15 +117,84 @@ async function fetchEmails() {
         });
 
         const totalPages = Math.ceil(data.total / limit);
-        pageInfo.innerText = `Página ${currentPage + 1} de ${totalPages || 1} (Total: ${data.total})`;
+        const approx = data.total_is_estimate ? '≈ ' : '';
+        pageInfo.innerText = `Página ${currentPage + 1} de ${approx}${totalPages || 1} (Total: ${approx}${data.total})`;
     } catch (error) {
         console.error('Error fetching emails:', error);
         tableBody.innerHTML = '<tr><td colspan="4" class="empty-msg">Error al cargar correos.</td></tr>';
     }
 }
 
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.innerText = text || '';
+    return div.innerHTML;
+}
+
+async function handleSearch() {
+    const q = document.getElementById('email-search').value.trim();
+    if (!q) {
+        fetchEmails();
+        return;
+    }
+    const hybrid = document.getElementById('email-search-hybrid').checked;
+    const tableBody = document.getElementById('emails-body');
+    const pageInfo = document.getElementById('page-info');
+
+    try {
+        const response = await fetch(`/api/emails/search?q=${encodeURIComponent(q)}&hybrid=${hybrid}`);
+        const data = await response.json();
+        tableBody.innerHTML = '';
+
+        if (!data.results || data.results.length === 0) {
+            tableBody.innerHTML = '<tr><td colspan="4" class="empty-msg">Sin resultados.</td></tr>';
+        }
+        (data.results || []).forEach(email => {
+            const row = document.createElement('tr');
+            row.style.cursor = 'pointer';
+            row.onclick = () => openEmail(email.id);
+            // El fragmento viene del cuerpo del correo: se escapa y solo se recuperan las marcas de resaltado
+            const snippet = escapeHtml(email.snippet)
+                .replaceAll('&lt;mark&gt;', '<mark>')
+                .replaceAll('&lt;/mark&gt;', '</mark>');
+            row.innerHTML = `
+                <td>${escapeHtml(email.date)}</td>
+                <td>${escapeHtml(email.sender)}</td>
+                <td>${escapeHtml(email.subject)}<div style="color: var(--text-dim); font-size: 12px;">${snippet}</div></td>
+                <td><span class="status-label info">${escapeHtml(email.status)}</span></td>
+            `;
+            tableBody.appendChild(row);
+        });
+        pageInfo.innerText = `Resultados: ${data.total}`;
+    } catch (error) {
+        console.error('Error searching emails:', error);
+        tableBody.innerHTML = '<tr><td colspan="4" class="empty-msg">Error en la búsqueda.</td></tr>';
+    }
+}
+
+async function handleProcessPending() {
+    const btn = document.getElementById('btn-process-pending');
+    btn.disabled = true;
+    try {
+        const response = await fetch('/api/jobs/pending', { method: 'POST' });
+        const data = await response.json();
+        btn.innerText = `${data.queued || 0} en cola`;
+    } catch (error) {
+        console.error('Error queueing pending emails:', error);
+    } finally {
+        setTimeout(() => {
+            btn.innerText = 'Generar borradores pendientes';
+            btn.disabled = false;
+        }, 3000);
+    }
+}
+
 function changePage(delta) {
     if (currentPage + delta < 0) return;
+    if (delta > 0) {
+        if (!nextCursor) return;
+        pageCursors[currentPage + 1] = nextCursor;
+    }
     currentPage += delta;
     fetchEmails();
 }
@@ -99,14 +208,13 @@ async function openEmail(id) {
         document.getElementById('modal-sender').innerText = `De: ${selectedEmail.sender} | ${selectedEmail.date}`;
         document.getElementById('modal-body').innerText = selectedEmail.body;
 
-        // Limpiar el campo de instrucciones y respuesta previa
+        // Limpiar el campo de instrucciones; si la cola de trabajos ya generó un borrador, mostrarlo
         document.getElementById('custom-prompt').value = '';
-        document.getElementById('modal-ai-response').innerText = '';
-        document.getElementById('btn-save-draft').style.display = 'none';
-        document.getElementById('btn-generate').innerText = 'Generar con IA';
-
-        // La respuesta siempre empieza vacía.
-        // Solo se genera cuando el usuario pulse "Generar con IA".
+        const draft = selectedEmail.ai_response || '';
+        selectedEmail.ai_current_response = draft || null;
+        document.getElementById('modal-ai-response').innerText = draft;
+        document.getElementById('btn-save-draft').style.display = draft ? 'inline-block' : 'none';
+        document.getElementById('btn-generate').innerText = draft ? 'Regenerar con IA' : 'Generar con IA';
 
         document.getElementById('email-modal').style.display = 'flex';
     } catch (error) {
@@ -133,7 +241,7 @@ async function handleGenerateAI() {
     responseContainer.innerText = 'La IA está redactando la respuesta...';
 
     try {
-        const response = await fetch('/api/emails/generate-answer', {
+        const response = await fetch('/api/emails/generate-answer/stream', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
@@ -142,14 +250,39 @@ async function handleGenerateAI() {
                 language: language
             })
         });
-        const data = await response.json();
-
-        if (data.status === 'success') {
-            responseContainer.innerText = data.ai_response;
-            selectedEmail.ai_current_response = data.ai_response;
-            document.getElementById('btn-save-draft').style.display = 'inline-block';
-        } else {
-            responseContainer.innerText = 'Error al generar respuesta.';
+        if (!response.ok || !response.body) throw new Error('HTTP ' + response.status);
+
+        // Server-Sent Events: cada token se pinta en cuanto llega
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let text = '';
+        let finished = false;
+
+        while (!finished) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+            for (const raw of events) {
+                if (!raw.startsWith('data:')) continue;
+                const data = JSON.parse(raw.slice(5).trim());
+                if (data.token !== undefined) {
+                    if (!text) responseContainer.innerText = '';
+                    text += data.token;
+                    responseContainer.innerText = text;
+                } else if (data.done) {
+                    responseContainer.innerText = data.ai_response;
+                    selectedEmail.ai_current_response = data.ai_response;
+                    document.getElementById('btn-save-draft').style.display = 'inline-block';
+                    finished = true;
+                } else if (data.error) {
+                    responseContainer.innerText = 'Error al generar respuesta.';
+                    finished = true;
+                }
+            }
         }
     } catch (error) {
         responseContainer.innerText = 'Error de conexión.';
@@ -226,6 +359,7 @@ document.querySelectorAll('nav a').forEach(link => {
             document.querySelector('.stats-grid').style.display = 'grid';
             document.querySelector('.live-feed').style.display = 'block';
             currentPage = 0;
+            pageCursors = [null];
             fetchEmails();
         } else if (tabName === 'Conocimiento') {
             document.getElementById('knowledge-section').style.display = 'block';
@@ -237,6 +371,13 @@ document.querySelectorAll('nav a').forEach(link => {
     });
 });
 
+function formatBytes(bytes) {
+    if (!bytes) return '0 B';
+    const units = ['B', 'KB', 'MB', 'GB'];
+    const i = Math.min(Math.floor(Math.log(bytes) / Math.log(1024)), units.length - 1);
+    return `${(bytes / Math.pow(1024, i)).toFixed(i ? 1 : 0)} ${units[i]}`;
+}
+
 async function loadKnowledge() {
     const listBody = document.getElementById('knowledge-body');
     if (!listBody) return;
@@ -247,7 +388,7 @@ async function loadKnowledge() {
         
         listBody.innerHTML = '';
         if (data.length === 0) {
-            listBody.innerHTML = '<tr><td colspan="3" class="empty-msg">No hay documentos indexados.</td></tr>';
+            listBody.innerHTML = '<tr><td colspan="5" class="empty-msg">No hay documentos indexados.</td></tr>';
             return;
         }
         
@@ -255,14 +396,16 @@ async function loadKnowledge() {
             const row = document.createElement('tr');
             row.style.borderBottom = '1px solid var(--glass-border)';
             row.innerHTML = `
-                <td style="padding: 12px; font-size: 14px;">📄 ${doc.filename}</td>
-                <td style="padding: 12px; font-size: 14px; color: var(--text-dim);">${doc.created_at}</td>
+                <td style="padding: 12px; font-size: 14px;">📄 ${escapeHtml(doc.filename)}</td>
+                <td style="padding: 12px; font-size: 14px; color: var(--text-dim);">${doc.chunk_count}</td>
+                <td style="padding: 12px; font-size: 14px; color: var(--text-dim);">${formatBytes(doc.size_bytes)}</td>
+                <td style="padding: 12px; font-size: 14px; color: var(--text-dim);">${doc.updated_at || doc.created_at}</td>
                 <td style="padding: 12px; font-size: 14px;"><span style="color: var(--accent-blue); cursor: pointer;">🔍 Ver</span></td>
             `;
             listBody.appendChild(row);
         });
     } catch (e) {
-        listBody.innerHTML = '<tr><td colspan="3" class="empty-msg">Error al cargar conocimiento.</td></tr>';
+        listBody.innerHTML = '<tr><td colspan="5" class="empty-msg">Error al cargar conocimiento.</td></tr>';
     }
 }
 
@@ -334,5 +477,5 @@ async function handleSaveConfig() {
     }
 }
 
-setInterval(updateStatus, 5000);
 updateStatus();
+subscribeEvents();
@@ -0,0 +1,123 @@
+import os
+import sys
+import threading
+import pytest
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.app_state import AppState
+
+
+def test_concurrent_increments_are_not_lost():
+    state = AppState()
+
+    def work():
+        for _ in range(1000):
+            state.increment("emails_processed")
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert state["emails_processed"] == 8000
+
+
+def test_snapshots_are_immutable_and_versioned():
+    state = AppState()
+    version, before = state.snapshot()
+    state.update(status="Sincronizando", publish=False)
+    new_version, after = state.snapshot()
+
+    assert new_version == version + 1
+    assert before["status"] == "Iniciando..." and after["status"] == "Sincronizando"
+    with pytest.raises(KeyError):
+        state.update(desconocido=1)
+
+
+def test_tasks_and_shared_backend():
+    class FakeBackend:
+        refresh_secs = 0
+
+        def __init__(self):
+            self.data = {"emails_processed": 41, "active_tasks": {}}
+
+        def load(self):
+            return self.data
+
+        def merge(self, changes):
+            self.data.update(changes)
+
+        def increment(self, key, n):
+            self.data[key] += n
+            return self.data[key]
+
+        def set_task(self, task_id, task):
+            if task is None:
+                self.data["active_tasks"].pop(str(task_id), None)
+            else:
+                self.data["active_tasks"][str(task_id)] = task
+
+    state = AppState(backend=FakeBackend())
+    # Otro proceso ya había contado 41: el contador compartido manda
+    assert state.increment("emails_processed") == 42
+    state.add_task({"job_id": 7, "email_id": "x"})
+    assert [t["job_id"] for t in state["active_tasks"]] == [7]
+    state.remove_task(7)
+    assert state["active_tasks"] == []
+
+
+def test_mailbox_state_is_merged_per_address():
+    state = AppState()
+    state.set_mailbox("a@x.com", connected=True, status="Conectado", publish=False)
+    state.set_mailbox("b@x.com", connected=False, status="Error de Conexión", publish=False)
+    assert state["exchange_connected"] is True
+    state.set_mailbox("a@x.com", connected=False, publish=False)
+    assert state["mailboxes"]["a@x.com"] == {"connected": False, "status": "Conectado"}
+    assert state["exchange_connected"] is False
+    state.remove_mailbox("b@x.com")
+    assert list(state["mailboxes"]) == ["a@x.com"]
+
+
+def test_processes_sharing_a_backend_do_not_overwrite_each_others_mailboxes():
+    class SharedBackend:
+        refresh_secs = 60
+
+        def __init__(self):
+            self.data = {"mailboxes": {}, "exchange_connected": False}
+            self.merged = []
+
+        def load(self):
+            return self.data
+
+        def merge(self, changes):
+            self.merged.append(changes)
+            self.data.update(changes)
+
+        def set_mailbox(self, address, info):
+            mailboxes = dict(self.data["mailboxes"])
+            if info is None:
+                mailboxes.pop(address, None)
+            else:
+                mailboxes[address] = {**mailboxes.get(address, {}), **info}
+            self.data = {**self.data, "mailboxes": mailboxes,
+                         "exchange_connected": any(m.get("connected") for m in mailboxes.values())}
+            return {"mailboxes": mailboxes, "exchange_connected": self.data["exchange_connected"]}
+
+    backend = SharedBackend()
+    # Dos workers de uvicorn, cada uno con su copia local del estado
+    first, second = AppState(backend=backend), AppState(backend=backend)
+    first.set_mailbox("a@x.com", connected=True, publish=False)
+    second.set_mailbox("b@x.com", connected=False, publish=False)
+    first.set_mailbox("a@x.com", status="Conectado", publish=False)
+
+    assert backend.data["mailboxes"] == {"a@x.com": {"connected": True, "status": "Conectado"},
+                                         "b@x.com": {"connected": False}}
+    assert first["mailboxes"] == backend.data["mailboxes"]
+
+    second.remove_mailbox("b@x.com")
+    first.set_mailbox("c@x.com", connected=False, publish=False)
+    assert sorted(backend.data["mailboxes"]) == ["a@x.com", "c@x.com"]
+    assert backend.data["exchange_connected"] is True
+    assert not any("mailboxes" in changes for changes in backend.merged)
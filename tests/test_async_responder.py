@@ -0,0 +1,139 @@
+import os
+import sys
+import asyncio
+
+import httpx
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.domain.ai import async_responder
+from src.domain.ai.async_responder import AsyncAIResponder, CircuitBreaker, parse_retry_after
+
+
+def responder_for(handler, **kwargs):
+    kwargs.setdefault("retry_backoff", 0)
+    return AsyncAIResponder(api_url="http://llm", transport=httpx.MockTransport(handler), **kwargs)
+
+
+def test_retries_503_until_model_is_loaded():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) < 3:
+            return httpx.Response(503, json={"detail": "Model is not loaded"})
+        return httpx.Response(200, json={"response": "hola"})
+
+    async def scenario():
+        ai = responder_for(handler, max_retries=3)
+        try:
+            return await ai.generate_response("prompt"), ai.stats()
+        finally:
+            await ai.aclose()
+
+    result, stats = asyncio.run(scenario())
+    assert result == "hola"
+    assert len(calls) == 3 and stats["retries"] == 2
+    assert stats["circuit_breaker"]["state"] == "closed"
+
+
+def test_circuit_breaker_opens_after_repeated_failures():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(500)
+
+    async def scenario():
+        ai = responder_for(handler, max_retries=0, breaker=CircuitBreaker(threshold=2, reset_timeout=60))
+        try:
+            results = [await ai.generate_response("p") for _ in range(3)]
+            return results, ai.breaker.state
+        finally:
+            await ai.aclose()
+
+    results, state = asyncio.run(scenario())
+    assert results == [None, None, None]
+    # La tercera llamada no llega a salir: el breaker está abierto
+    assert len(calls) == 2 and state == "open"
+
+
+def test_half_open_probe_closes_breaker_on_success():
+    now = [0.0]
+    breaker = CircuitBreaker(threshold=1, reset_timeout=10, clock=lambda: now[0])
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    now[0] = 11
+    assert breaker.allow()
+    assert not breaker.allow()  # solo una petición de prueba a la vez
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_stream_yields_tokens():
+    body = 'data: {"token": "ho"}\n\ndata: {"token": "la"}\n\ndata: {"done": true, "response": "hola"}\n\n'
+
+    def handler(request):
+        assert request.url.path == "/generate/stream"
+        return httpx.Response(200, text=body, headers={"content-type": "text/event-stream"})
+
+    async def scenario():
+        ai = responder_for(handler)
+        try:
+            return [token async for token in ai.generate_stream("p")]
+        finally:
+            await ai.aclose()
+
+    assert asyncio.run(scenario()) == ["ho", "la"]
+
+
+def test_500_and_504_are_not_retried():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(504, json={"detail": "timeout"})
+
+    async def scenario():
+        ai = responder_for(handler, max_retries=3)
+        try:
+            return await ai.generate_response("p"), ai.breaker.failures
+        finally:
+            await ai.aclose()
+
+    result, failures = asyncio.run(scenario())
+    assert result is None
+    assert len(calls) == 1 and failures == 1
+
+
+def test_429_honors_retry_after_and_counts_as_failure(monkeypatch):
+    calls, sleeps = [], []
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(async_responder.asyncio, "sleep", fake_sleep)
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(429, headers={"Retry-After": "2"})
+
+    async def scenario():
+        ai = responder_for(handler, max_retries=1)
+        try:
+            return await ai.generate_response("p"), ai.breaker.failures
+        finally:
+            await ai.aclose()
+
+    result, failures = asyncio.run(scenario())
+    assert result is None
+    assert len(calls) == 2 and sleeps == [2.0]
+    assert failures == 1
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("5") == 5.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:10 GMT", now=1445412480) == 10.0
+    assert parse_retry_after("mañana") is None
+    assert parse_retry_after(None) is None
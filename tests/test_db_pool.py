@@ -0,0 +1,129 @@
+import os
+import sys
+import threading
+import pytest
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+import psycopg2.pool
+from src.infrastructure.database.postgres import ConnectionPool, KeepIdleConnectionPool
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=None):
+        if self.conn.dead:
+            raise psycopg2.OperationalError("server closed the connection")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeConn:
+    def __init__(self, dead=False):
+        self.closed = 0
+        self.dead = dead
+        self.status = psycopg2.extensions.STATUS_READY
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = psycopg2.extensions.STATUS_READY
+
+
+class FakePool:
+    def __init__(self, conns):
+        self.conns = list(conns)
+        self.closed = []
+
+    def getconn(self):
+        return self.conns.pop(0)
+
+    def putconn(self, conn, close=False):
+        if close:
+            self.closed.append(conn)
+        else:
+            self.conns.append(conn)
+
+
+def make_pool(conns, maxconn=2, timeout=0.05):
+    pool = ConnectionPool(minconn=1, maxconn=maxconn, timeout=timeout, healthcheck_secs=60)
+    fake = FakePool(conns)
+    pool._get_pool = lambda: fake
+    return pool, fake
+
+
+def test_dead_connections_are_discarded_on_checkout():
+    dead, alive = FakeConn(dead=True), FakeConn()
+    pool, fake = make_pool([dead, alive])
+    conn = pool.getconn()
+    assert conn is alive
+    assert fake.closed == [dead]
+    pool.putconn(conn)
+    assert pool.stats()["discarded"] == 1 and pool.stats()["in_use"] == 0
+
+
+def test_open_transactions_are_rolled_back_on_return():
+    pool, _ = make_pool([FakeConn()])
+    conn = pool.getconn()
+    conn.status = psycopg2.extensions.STATUS_IN_TRANSACTION
+    pool.putconn(conn)
+    assert conn.rollbacks >= 1
+
+
+def test_checkout_waits_and_times_out_when_exhausted():
+    pool, _ = make_pool([FakeConn(), FakeConn()], maxconn=1)
+    conn = pool.getconn()
+    with pytest.raises(PoolError):
+        pool.getconn()
+    assert pool.stats()["timeouts"] == 1
+
+    # Un hilo que espera recibe la conexión en cuanto se devuelve
+    result = {}
+    waiter = threading.Thread(target=lambda: result.setdefault("conn", pool.getconn()))
+    pool.timeout = 2
+    waiter.start()
+    pool.putconn(conn)
+    waiter.join()
+    assert result["conn"] is not None
+    assert pool.stats()["checkouts"] == 2
+
+
+def test_idle_connections_beyond_minconn_are_kept(monkeypatch):
+    class Info:
+        transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    class RealishConn(FakeConn):
+        info = Info()
+
+        def close(self):
+            self.closed = 1
+
+    monkeypatch.setattr(psycopg2.pool.psycopg2, "connect", lambda *args, **kwargs: RealishConn())
+    pool = KeepIdleConnectionPool(1, 3)
+    conns = [pool.getconn() for _ in range(3)]
+    for conn in conns:
+        pool.putconn(conn)
+    assert not any(conn.closed for conn in conns)
+    assert {id(pool.getconn()) for _ in range(3)} == {id(conn) for conn in conns}
+
+
+def test_last_used_entries_are_dropped_with_their_connection():
+    first, second = FakeConn(), FakeConn()
+    pool, _ = make_pool([first, second])
+    a, b = pool.getconn(), pool.getconn()
+    pool.putconn(a)
+    b.closed = 1
+    pool.putconn(b)
+    assert list(pool._last_used) == [a]
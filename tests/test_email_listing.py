@@ -0,0 +1,40 @@
+import os
+import sys
+from datetime import datetime
+import pytest
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.infrastructure.database.postgres import build_email_filters, email_cursor, parse_email_cursor
+
+
+def test_cursor_round_trip():
+    email = {"id": "AAMkAD+/x==", "date": datetime(2024, 5, 1, 9, 30, 15, 120)}
+    cursor = email_cursor(email)
+    assert parse_email_cursor(cursor) == (email["date"], email["id"])
+
+
+def test_invalid_cursor_is_rejected():
+    with pytest.raises(ValueError):
+        parse_email_cursor("no-es-un-cursor")
+    with pytest.raises(ValueError):
+        parse_email_cursor("ayer,abc")
+
+
+def test_filters_build_parametrized_clauses():
+    clauses, params = build_email_filters(status="PENDIENTE", sender="acme", is_read=False)
+    assert clauses == ["deleted_at IS NULL", "status = %s", "sender ILIKE %s", "is_read = %s"]
+    assert params == ["PENDIENTE", "%acme%", False]
+
+
+def test_mailbox_filter_is_resolved_by_address():
+    clauses, params = build_email_filters(status="PENDIENTE", mailbox="soporte@x.com")
+    assert clauses[1] == "mailbox_id = (SELECT id FROM mailboxes WHERE address = %s)"
+    assert params == ["soporte@x.com", "PENDIENTE"]
+
+
+def test_cursor_encodes_emails_without_date():
+    cursor = email_cursor({"id": "sin-fecha", "date": None})
+    assert cursor == ",sin-fecha"
+    assert parse_email_cursor(cursor) == (None, "sin-fecha")
@@ -0,0 +1,39 @@
+import os
+import sys
+import numpy as np
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.services import email_service
+
+
+def test_hybrid_search_blends_text_rank_and_similarity(monkeypatch):
+    def fake_search(query, limit, match_any=False, with_text=False, mailbox=None):
+        assert match_any and with_text
+        return [
+            {"id": "a", "rank": 1.0, "search_text": "factura pendiente"},
+            {"id": "b", "rank": 0.5, "search_text": "pago de la cuota"},
+        ]
+
+    # Consulta, a, b: b es semánticamente idéntico a la consulta
+    vectors = np.array([[1.0, 0.0], [0.0, 1.0], [1.0, 0.0]], dtype=np.float32)
+    monkeypatch.setattr(email_service, "search_emails_db", fake_search)
+    monkeypatch.setattr(email_service, "embed_texts", lambda texts: vectors)
+    monkeypatch.setattr(email_service, "SEARCH_TEXT_WEIGHT", 0.5)
+
+    results = email_service._hybrid_search("cobro", limit=2)
+    assert [r["id"] for r in results] == ["b", "a"]
+    assert results[0]["score"] == 0.75 and results[1]["score"] == 0.5
+    assert "search_text" not in results[0]
+
+
+def test_hybrid_search_falls_back_to_text_rank_without_model(monkeypatch):
+    monkeypatch.setattr(email_service, "search_emails_db", lambda *a, **k: [
+        {"id": "a", "rank": 0.2, "search_text": "x"}, {"id": "b", "rank": 0.4, "search_text": "y"}
+    ])
+    monkeypatch.setattr(email_service, "embed_texts", lambda texts: None)
+
+    results = email_service._hybrid_search("x", limit=5)
+    assert [r["id"] for r in results] == ["b", "a"]
+    assert results[0]["similarity"] is None
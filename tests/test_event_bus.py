@@ -0,0 +1,39 @@
+import os
+import sys
+import asyncio
+import threading
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.core.events import EventBus, format_sse
+
+
+def test_slow_client_drops_oldest_events():
+    async def scenario():
+        bus = EventBus(queue_size=2)
+        bus.attach_loop(asyncio.get_running_loop())
+        sub = bus.subscribe()
+        for i in range(5):
+            bus.publish("status", {"n": i})
+        events = [await sub.get(timeout=1), await sub.get(timeout=1)]
+        return events, sub.dropped, await sub.get(timeout=0.01)
+
+    events, dropped, empty = asyncio.run(scenario())
+    assert [e["data"]["n"] for e in events] == [3, 4]
+    assert dropped == 3 and empty is None
+
+
+def test_publish_from_worker_thread_reaches_subscribers():
+    async def scenario():
+        bus = EventBus()
+        bus.attach_loop(asyncio.get_running_loop())
+        subs = [bus.subscribe(), bus.subscribe()]
+        thread = threading.Thread(target=bus.publish, args=("sync", {"upserted": 3}))
+        thread.start()
+        thread.join()
+        return [await s.get(timeout=1) for s in subs]
+
+    events = asyncio.run(scenario())
+    assert all(e["type"] == "sync" and e["data"] == {"upserted": 3} for e in events)
+    assert format_sse(events[0]).startswith(f"id: {events[0]['id']}\nevent: sync\ndata: ")
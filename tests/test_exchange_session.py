@@ -0,0 +1,92 @@
+import os
+import sys
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.infrastructure.exchange.session import ExchangeSessionManager
+
+
+class FakeProtocol:
+    session_pool_size = 1
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeAccount:
+    def __init__(self, address):
+        self.primary_smtp_address = address
+        self.protocol = FakeProtocol()
+
+
+def make_manager(settings):
+    manager = ExchangeSessionManager(pool_size=2, max_accounts=2)
+    manager._load_settings = lambda: dict(settings)
+    manager._build_account = lambda s, address=None: FakeAccount(address or s["email"])
+    manager._mailbox_credentials = lambda address: None
+    return manager
+
+
+def test_account_is_reused_between_calls():
+    manager = make_manager({"email": "a@x.com", "password": "p", "server": "srv", "upn": "a"})
+    first = manager.get_account()
+    second = manager.get_account()
+    assert first is second
+    stats = manager.stats()
+    assert stats["misses"] == 1 and stats["hits"] == 1
+    assert stats["accounts"] == 1 and stats["pool_size"] == 2
+
+
+def test_reload_only_rebuilds_when_settings_change():
+    settings = {"email": "a@x.com", "password": "p", "server": "srv", "upn": "a"}
+    manager = make_manager(settings)
+    account = manager.get_account()
+    assert manager.reload_settings() is False
+    assert manager.get_account() is account
+
+    settings["password"] = "nueva"
+    manager._load_settings = lambda: dict(settings)
+    assert manager.reload_settings() is True
+    assert account.protocol.closed
+    assert manager.get_account() is not account
+    assert manager.stats()["rebuilds"] == 1
+
+
+def test_accounts_are_bounded():
+    manager = make_manager({"email": "a@x.com", "password": "p", "server": "srv", "upn": "a"})
+    oldest = manager.get_account("1@x.com")
+    manager.get_account("2@x.com")
+    manager.get_account("3@x.com")
+    assert manager.stats()["accounts"] == 2
+    assert oldest.protocol.closed
+
+
+def test_mailbox_credentials_override_global_settings():
+    manager = make_manager({"email": "a@x.com", "password": "p", "server": "srv", "upn": "a"})
+    built = {}
+
+    def build(settings, address=None):
+        built[address] = settings
+        return FakeAccount(address or settings["email"])
+
+    manager._build_account = build
+    manager._mailbox_credentials = lambda address: {"upn": "b", "password": "q"} if address == "b@x.com" else None
+    manager.get_account("b@x.com")
+    manager.get_account("c@x.com")
+    assert built["b@x.com"]["upn"] == "b" and built["b@x.com"]["password"] == "q"
+    assert built["b@x.com"]["server"] == "srv"
+    assert built["c@x.com"]["upn"] == "a"
+
+
+def test_forget_drops_one_mailbox_without_closing_shared_protocol():
+    manager = make_manager({"email": "a@x.com", "password": "p", "server": "srv", "upn": "a"})
+    shared = FakeProtocol()
+    first = manager.get_account("1@x.com")
+    second = manager.get_account("2@x.com")
+    first.protocol = second.protocol = shared
+    manager.forget("1@x.com")
+    assert not shared.closed
+    assert manager.get_account("2@x.com") is second
+    assert manager.get_account("1@x.com") is not first
@@ -0,0 +1,247 @@
+import os
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from exchangelib import Account, Build, Configuration, Credentials, DELEGATE, Version
+from exchangelib.transport import NOAUTH
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.infrastructure.exchange.notifications import InboxNotifier
+
+
+class StatusEvent:
+    watermark = "w-status"
+
+
+class NewMailEvent:
+    watermark = "w-new"
+
+
+class Notification:
+    def __init__(self, events):
+        self.events = events
+        self.more_events = False
+
+
+class FakeInbox:
+    """Simula el lado servidor de las suscripciones EWS."""
+
+    def __init__(self, streams=(), fail_subscribe=False):
+        self.streams = list(streams)
+        self.fail_subscribe = fail_subscribe
+        self.subscriptions = 0
+
+    def subscribe_to_streaming(self, event_types=None):
+        if self.fail_subscribe:
+            raise ConnectionError("EWS caído")
+        self.subscriptions += 1
+        return "sub-1"
+
+    def subscribe_to_pull(self, event_types=None, timeout=60):
+        self.subscriptions += 1
+        return "sub-1", "w-0"
+
+    def get_streaming_events(self, subscription_id, connection_timeout=1, max_notifications_returned=None):
+        if self.streams:
+            yield Notification(self.streams.pop(0))
+
+    def get_events(self, subscription_id, watermark):
+        yield Notification(self.streams.pop(0) if self.streams else [])
+
+
+class FakeAccount:
+    def __init__(self, inbox):
+        self.inbox = inbox
+
+
+def test_streaming_wakes_on_new_mail_and_skips_heartbeats():
+    inbox = FakeInbox(streams=[[StatusEvent()], [NewMailEvent()]])
+    notifier = InboxNotifier(mode='streaming', min_interval=0, max_interval=5,
+                             account_provider=lambda: FakeAccount(inbox))
+    assert notifier.wait() == 'notification'
+    assert inbox.subscriptions == 1
+    assert notifier.stats["notifications"] == 1
+
+
+def test_pull_tracks_watermark():
+    inbox = FakeInbox(streams=[[NewMailEvent()]])
+    notifier = InboxNotifier(mode='pull', min_interval=0, max_interval=5,
+                             account_provider=lambda: FakeAccount(inbox))
+    assert notifier.wait() == 'notification'
+    assert notifier._watermark == "w-new"
+
+
+def test_falls_back_to_adaptive_polling_when_subscription_fails():
+    inbox = FakeInbox(fail_subscribe=True)
+    notifier = InboxNotifier(mode='streaming', min_interval=0.01, max_interval=0.04,
+                             account_provider=lambda: FakeAccount(inbox))
+    assert notifier.wait() == 'poll'
+    assert notifier.stats["subscription_errors"] == 1
+    assert notifier.stats["subscribed"] is False
+    notifier.wait()
+    notifier.wait()
+    assert notifier.stats["interval"] == 0.04
+    notifier.wait(last_cycle_changed=True)
+    assert notifier.stats["interval"] == 0.01
+
+
+# --- Servidor EWS falso: respuestas SOAP enlatadas a través de la capa de protocolo de exchangelib ---
+
+SOAP_ENVELOPE = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Header>'
+    '<h:ServerVersionInfo MajorVersion="15" MinorVersion="1" MajorBuildNumber="2507" MinorBuildNumber="6" '
+    'xmlns:h="http://schemas.microsoft.com/exchange/services/2006/types"/>'
+    '</s:Header><s:Body>{}</s:Body></s:Envelope>'
+)
+EWS_NAMESPACES = (
+    'xmlns:m="http://schemas.microsoft.com/exchange/services/2006/messages" '
+    'xmlns:t="http://schemas.microsoft.com/exchange/services/2006/types"'
+)
+
+
+def soap_response(operation, content="", error=None):
+    if error:
+        status = (f'ResponseClass="Error"><m:MessageText>{error}</m:MessageText>'
+                  f'<m:ResponseCode>{error}</m:ResponseCode><m:DescriptiveLinkKey>0</m:DescriptiveLinkKey>')
+    else:
+        status = 'ResponseClass="Success"><m:ResponseCode>NoError</m:ResponseCode>'
+    return SOAP_ENVELOPE.format(
+        f'<m:{operation}Response {EWS_NAMESPACES}><m:ResponseMessages>'
+        f'<m:{operation}ResponseMessage {status}{content}</m:{operation}ResponseMessage>'
+        f'</m:ResponseMessages></m:{operation}Response>'
+    )
+
+
+def status_event(watermark):
+    return f'<t:StatusEvent><t:Watermark>{watermark}</t:Watermark></t:StatusEvent>'
+
+
+def new_mail_event(watermark):
+    return (f'<t:NewMailEvent><t:Watermark>{watermark}</t:Watermark><t:TimeStamp>2026-10-17T10:00:00Z</t:TimeStamp>'
+            '<t:ItemId Id="item-1" ChangeKey="ck"/><t:ParentFolderId Id="inbox-id" ChangeKey="ck"/></t:NewMailEvent>')
+
+
+class FakeEWSServer:
+    """
+    Endpoint EWS local: GetFolder, Subscribe (pull/streaming), GetEvents, GetStreamingEvents
+    y Unsubscribe. `events` son los eventos (XML) de cada GetEvents/GetStreamingEvents sucesivo
+    y `subscribe_error` hace fallar las suscripciones con ese código de error.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.subscribe_error = None
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                payload = server.respond(re.search(r"<s:Body><m:(\w+)", body).group(1), body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/xml; charset=utf-8")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/EWS/Exchange.asmx"
+
+    def operations(self, name):
+        return [body for op, body in self.requests if op == name]
+
+    def respond(self, operation, body):
+        self.requests.append((operation, body))
+        if operation == "GetFolder":
+            name = re.search(r'DistinguishedFolderId Id="(\w+)"', body).group(1)
+            return soap_response("GetFolder", f'<m:Folders><t:Folder><t:FolderId Id="{name}-id" ChangeKey="ck"/>'
+                                              f'<t:FolderClass>IPF.Note</t:FolderClass></t:Folder></m:Folders>')
+        if operation == "Subscribe":
+            if self.subscribe_error:
+                return soap_response("Subscribe", error=self.subscribe_error)
+            return soap_response("Subscribe", "<m:SubscriptionId>sub-1</m:SubscriptionId><m:Watermark>w-0</m:Watermark>")
+        events = "".join(self.events.pop(0)) if self.events else ""
+        if operation == "GetEvents":
+            # Sin cambios Exchange contesta con un StatusEvent que mantiene la marca de agua
+            events = events or status_event(re.search(r"<m:Watermark>([^<]*)<", body).group(1))
+            return soap_response("GetEvents", "<m:Notification><t:SubscriptionId>sub-1</t:SubscriptionId>"
+                                              f"<t:MoreEvents>false</t:MoreEvents>{events}</m:Notification>")
+        if operation == "GetStreamingEvents":
+            notifications = (f"<m:Notifications><m:Notification><t:SubscriptionId>sub-1</t:SubscriptionId>{events}"
+                             "</m:Notification></m:Notifications>") if events else ""
+            # Varios documentos SOAP en la misma respuesta, como el stream real; el último cierra la conexión
+            return (soap_response("GetStreamingEvents", notifications)
+                    + soap_response("GetStreamingEvents", "<m:ConnectionStatus>Closed</m:ConnectionStatus>"))
+        return soap_response(operation)
+
+
+@pytest.fixture
+def fake_ews():
+    server = FakeEWSServer()
+    thread = threading.Thread(target=server.httpd.serve_forever, daemon=True)
+    thread.start()
+    config = Configuration(service_endpoint=server.url, credentials=Credentials("buzon", "secreto"),
+                           auth_type=NOAUTH, version=Version(build=Build(15, 1)))
+    account = Account("buzon@example.com", config=config, autodiscover=False, access_type=DELEGATE)
+    server.account_provider = lambda: account
+    try:
+        yield server
+    finally:
+        server.httpd.shutdown()
+        server.httpd.server_close()
+
+
+def test_ews_streaming_subscription_wakes_on_new_mail(fake_ews):
+    fake_ews.events = [[status_event("w-1")], [new_mail_event("w-2")]]
+    notifier = InboxNotifier(mode='streaming', min_interval=0, max_interval=5, account_provider=fake_ews.account_provider)
+
+    assert notifier.wait() == 'notification'
+    subscribe, = fake_ews.operations("Subscribe")
+    assert "<m:StreamingSubscriptionRequest>" in subscribe and "<t:EventType>NewMailEvent</t:EventType>" in subscribe
+    # El latido (StatusEvent) no despierta al worker: hizo falta un segundo GetStreamingEvents
+    assert len(fake_ews.operations("GetStreamingEvents")) == 2
+
+    notifier.close()
+    assert "<m:SubscriptionId>sub-1</m:SubscriptionId>" in fake_ews.operations("Unsubscribe")[0]
+
+
+def test_ews_pull_subscription_advances_the_watermark(fake_ews):
+    fake_ews.events = [[new_mail_event("w-1")]]
+    notifier = InboxNotifier(mode='pull', min_interval=0.01, max_interval=0.05, account_provider=fake_ews.account_provider)
+
+    assert notifier.wait() == 'notification'
+    assert "<m:PullSubscriptionRequest>" in fake_ews.operations("Subscribe")[0]
+    assert notifier._watermark == "w-1"
+
+    # Sin cambios: la ventana expira y las siguientes consultas parten de la marca nueva
+    assert notifier.wait() == 'timeout'
+    assert "<m:Watermark>w-1</m:Watermark>" in fake_ews.operations("GetEvents")[1]
+    assert len(fake_ews.operations("Subscribe")) == 1
+
+
+def test_ews_subscription_error_falls_back_to_polling_and_resubscribes(fake_ews):
+    fake_ews.subscribe_error = "ErrorAccessDenied"
+    notifier = InboxNotifier(mode='streaming', min_interval=0.01, max_interval=0.04,
+                             account_provider=fake_ews.account_provider)
+
+    assert notifier.wait() == 'poll'
+    assert notifier.stats["subscription_errors"] == 1 and notifier.stats["subscribed"] is False
+    assert fake_ews.operations("GetStreamingEvents") == []
+
+    # El servidor se recupera: tras el backoff se vuelve a suscribir y recibe el aviso
+    fake_ews.subscribe_error = None
+    fake_ews.events = [[new_mail_event("w-1")]]
+    assert notifier.wait() == 'notification'
+    assert notifier.stats["subscribed"] is True
+    assert len(fake_ews.operations("Subscribe")) == 2
@@ -0,0 +1,47 @@
+import os
+import sys
+import asyncio
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.services import job_service
+from src.app_state import app_state
+
+
+def make_job(job_id, kind="generate_answer"):
+    return {"id": job_id, "kind": kind, "email_id": f"mail-{job_id}", "payload": {},
+            "attempts": 1, "started_at": "2024-01-01 00:00:00"}
+
+
+def test_workers_process_queue_and_record_outcomes(monkeypatch):
+    queue = [make_job(1), make_job(2), make_job(3, kind="desconocido")]
+    completed, failed = [], []
+    seen_active = []
+
+    monkeypatch.setattr(job_service, "requeue_stale_jobs", lambda secs: 0)
+    monkeypatch.setattr(job_service, "claim_job", lambda worker: queue.pop(0) if queue else None)
+    monkeypatch.setattr(job_service, "complete_job", completed.append)
+    monkeypatch.setattr(job_service, "fail_job", lambda job_id, error, retry_delay=None: failed.append((job_id, retry_delay)))
+
+    async def handler(job):
+        seen_active.append([t["job_id"] for t in app_state["active_tasks"]])
+        if job["id"] == 2:
+            raise RuntimeError("LLM caído")
+
+    async def scenario():
+        workers = job_service.JobWorkers(workers=1, poll_interval=0.01, handlers={"generate_answer": handler})
+        workers.start()
+        while queue:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        await workers.stop()
+        return workers.stats()
+
+    stats = asyncio.run(scenario())
+    assert completed == [1]
+    # Error transitorio: se reintenta con retraso; tipo desconocido: fallo definitivo
+    assert failed == [(2, job_service.JOB_RETRY_DELAY), (3, None)]
+    assert seen_active == [[1], [2]]
+    assert app_state["active_tasks"] == []
+    assert stats["completed"] == 1 and stats["failed"] == 2
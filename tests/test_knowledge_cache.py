@@ -0,0 +1,79 @@
+import os
+import sys
+import pytest
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.domain.knowledge import cache
+from src.domain.knowledge.cache import TTLCache, content_hash
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_eviction_and_hit_rate():
+    c = TTLCache(maxsize=2, ttl=60)
+    c.put("a", 1)
+    c.put("b", 2)
+    assert c.get("a") == 1      # "a" pasa a ser el más reciente
+    c.put("c", 3)               # se expulsa "b"
+    assert c.get("b") is None
+    assert c.get("c") == 3
+    stats = c.stats()
+    assert stats["size"] == 2 and stats["hits"] == 2 and stats["misses"] == 1
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    c = TTLCache(maxsize=10, ttl=5, clock=clock)
+    c.put("k", "v")
+    clock.now = 4.9
+    assert c.get("k") == "v"
+    clock.now = 5.1
+    assert c.get("k") is None
+    assert c.stats()["size"] == 0
+
+
+def test_generation_bump_invalidates_results():
+    key = (content_hash("consulta"), 3, None, None, cache.current_generation())
+    cache.result_cache.put(key, (("texto", "manual.pdf", 0.9),))
+    generation = cache.bump_generation()
+    assert generation == key[-1] + 1
+    assert cache.result_cache.get(key) is None
+
+
+def test_swap_rejects_other_dimensions_and_persists_the_choice(monkeypatch):
+    from src.domain.knowledge.model_provider import EmbeddingModelProvider
+    from src.infrastructure.database import postgres
+
+    class FakeModel:
+        def __init__(self, dimensions):
+            self.dimensions = dimensions
+
+        def get_sentence_embedding_dimension(self):
+            return self.dimensions
+
+    saved = {}
+    monkeypatch.setattr(postgres, "save_setting", lambda key, value: saved.update({key: value}))
+    monkeypatch.setattr(postgres, "get_setting", lambda key, default=None: saved.get(key, default))
+
+    provider = EmbeddingModelProvider("base", setting_key="EMBEDDING_MODEL", dimensions=384)
+    provider._load = lambda name: (FakeModel(768 if name == "grande" else 384), 0.1)
+    with pytest.raises(ValueError):
+        provider.swap("grande")
+    assert saved == {}
+
+    provider.swap("otro-384")
+    assert saved == {"EMBEDDING_MODEL": "otro-384"}
+
+    # Un arranque nuevo carga el modelo guardado, no el de EMBEDDING_MODEL
+    restarted = EmbeddingModelProvider("base", setting_key="EMBEDDING_MODEL", dimensions=384)
+    restarted._load = lambda name: (FakeModel(384), 0.1)
+    restarted.get()
+    assert restarted.model_name == "otro-384"
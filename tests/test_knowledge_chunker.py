@@ -0,0 +1,72 @@
+import os
+import sys
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.domain.knowledge.chunker import (
+    TextBlock, TokenCounter, StructureChunker, WordChunker, get_chunker, heading_level, iter_paragraphs
+)
+
+
+class FakeTokenizer:
+    """Un token por palabra y otro por cada signo de puntuación, como WordPiece."""
+
+    def tokenize(self, text):
+        return [t for word in text.split() for t in ([word.strip(".,;:")] + [c for c in word if c in ".,;:"])]
+
+
+def chunker(max_tokens=20, overlap_tokens=0):
+    return StructureChunker(TokenCounter(FakeTokenizer(), max_tokens), overlap_tokens=overlap_tokens)
+
+
+def test_chunks_never_exceed_the_token_limit():
+    counter = TokenCounter(FakeTokenizer(), 20)
+    long_paragraph = " ".join(f"palabra{i}." for i in range(30)) + " " + "x " * 45
+    blocks = [TextBlock("Párrafo corto de prueba.", 1), TextBlock(long_paragraph, 1)]
+    chunks = list(chunker(overlap_tokens=4).chunk(blocks))
+    assert len(chunks) > 3
+    for chunk in chunks:
+        assert counter.count(chunk.text) <= 20
+        assert chunk.metadata["tokens"] == counter.count(chunk.text)
+    # Todas las palabras acaban en algún fragmento
+    words = set(long_paragraph.split())
+    assert words <= {w for c in chunks for w in c.text.split()}
+
+
+def test_headings_and_pages_start_new_chunks_with_metadata():
+    blocks = [
+        TextBlock("1 Instalación", 1, 1),
+        TextBlock("Conecte el equipo.", 1),
+        TextBlock("1.1 Requisitos", 1, 2),
+        TextBlock("Necesita 220 V.", 1),
+        TextBlock("Sigue en la siguiente página.", 2),
+        TextBlock("2 Mantenimiento", 2, 1),
+        TextBlock("Limpie el filtro.", 2),
+    ]
+    chunks = list(chunker().chunk(blocks))
+    assert [c.text for c in chunks] == [
+        "1 Instalación\nConecte el equipo.",
+        "1.1 Requisitos\nNecesita 220 V.",
+        "Sigue en la siguiente página.",
+        "2 Mantenimiento\nLimpie el filtro.",
+    ]
+    assert chunks[1].metadata["section"] == "1 Instalación > 1.1 Requisitos"
+    assert chunks[1].metadata["page"] == 1
+    assert chunks[2].metadata["page"] == 2 and chunks[2].metadata["section"] == "1 Instalación > 1.1 Requisitos"
+    assert chunks[3].metadata["section"] == "2 Mantenimiento"
+
+
+def test_heading_detection_and_paragraph_splitting():
+    assert heading_level("2.1 Instalación del equipo") == 2
+    assert heading_level("## Requisitos") == 2
+    assert heading_level("GARANTÍA") == 1
+    assert heading_level("El equipo se entrega montado.") == 0
+    assert heading_level("Página 3") == 0
+    assert list(iter_paragraphs(["uno\n\ndo", "s\n\n\ntres"])) == ["uno", "dos", "tres"]
+
+
+def test_word_chunker_is_still_available():
+    assert isinstance(get_chunker("words"), WordChunker)
+    chunks = list(get_chunker("words").chunk([TextBlock("a b c")]))
+    assert [c.text for c in chunks] == ["a b c"] and chunks[0].metadata == {}
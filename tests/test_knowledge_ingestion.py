@@ -0,0 +1,46 @@
+import os
+import sys
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import fitz  # PyMuPDF
+
+from src.domain.knowledge import embedder
+from src.domain.knowledge.chunker import chunk_text, iter_chunks
+from src.domain.knowledge.embedder import iter_pdf_pages, iter_txt_text
+
+
+def test_streaming_chunks_match_whole_text_chunks():
+    text = " ".join(f"palabra{i}" for i in range(1234))
+    # Partes cortadas a mitad de palabra y sin espacios al final
+    parts = [text[i:i + 97] for i in range(0, len(text), 97)]
+    assert list(iter_chunks(parts, chunk_size=50, overlap=10)) == chunk_text(text, chunk_size=50, overlap=10)
+    assert list(iter_chunks([], chunk_size=50, overlap=10)) == []
+
+
+def test_pdf_pages_are_yielded_in_order_with_a_process_pool(tmp_path):
+    path = str(tmp_path / "manual.pdf")
+    doc = fitz.open()
+    for n in range(7):
+        doc.new_page().insert_text((72, 72), f"Pagina {n}")
+    doc.save(path)
+    doc.close()
+
+    try:
+        pages = list(iter_pdf_pages(path, workers=2, pages_per_task=2))
+        pool = embedder.get_pdf_pool()
+        assert [page.split()[1] for page in pages] == [str(n) for n in range(7)]
+        assert pages == list(iter_pdf_pages(path, workers=1))
+        # La siguiente subida reutiliza el mismo pool de procesos
+        assert list(iter_pdf_pages(path, workers=2, pages_per_task=3)) == pages
+        assert embedder.get_pdf_pool() is pool
+    finally:
+        embedder.shutdown_pdf_pool()
+
+
+def test_txt_is_read_in_blocks(tmp_path):
+    path = tmp_path / "notas.txt"
+    path.write_text("año " * 100, encoding="utf-8")
+    blocks = list(iter_txt_text(str(path), block_size=64))
+    assert len(blocks) > 1 and "".join(blocks) == "año " * 100
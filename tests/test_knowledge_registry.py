@@ -0,0 +1,51 @@
+import os
+import sys
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.domain.knowledge.cache import content_hash
+from src.domain.knowledge.chunker import Chunk
+from src.domain.knowledge.embedder import ChunkPlan, plan_chunk_changes, file_content_hash
+
+
+def chunks(*texts):
+    return [Chunk(t) for t in texts]
+
+
+def test_unchanged_chunks_are_kept():
+    texts = ["uno", "dos", "tres"]
+    existing = [(i, content_hash(t), {}) for i, t in enumerate(texts, start=1)]
+    delete, insert, kept = plan_chunk_changes(existing, chunks(*texts))
+    assert delete == [] and insert == [] and kept == 3
+
+
+def test_only_changed_chunks_are_embedded_and_removed_ones_deleted():
+    existing = [(1, content_hash("uno"), {}), (2, content_hash("dos"), {}), (3, content_hash("tres"), {})]
+    delete, insert, kept = plan_chunk_changes(existing, chunks("uno", "dos bis", "tres"))
+    assert delete == [2]
+    assert insert == [(content_hash("dos bis"), Chunk("dos bis"))]
+    assert kept == 2
+
+
+def test_duplicate_chunks_are_stored_once():
+    # Subidas antiguas duplicadas en la DB y fragmentos repetidos en el propio documento
+    existing = [(1, content_hash("uno"), {}), (2, content_hash("uno"), {})]
+    delete, insert, kept = plan_chunk_changes(existing, chunks("uno", "dos", "dos"))
+    assert delete == [2]
+    assert insert == [(content_hash("dos"), Chunk("dos"))]
+    assert kept == 1
+
+
+def test_moved_chunks_only_update_metadata():
+    existing = [(1, content_hash("uno"), {"page": 1}), (2, content_hash("dos"), {"page": 2})]
+    plan = ChunkPlan(existing)
+    new = list(plan.new_chunks([Chunk("uno", {"page": 1}), Chunk("dos", {"page": 3})]))
+    assert new == [] and plan.deleted_ids() == []
+    assert plan.metadata_updates == [(2, {"page": 3})]
+
+
+def test_file_hash_reads_in_blocks(tmp_path):
+    path = tmp_path / "manual.txt"
+    path.write_bytes(b"x" * 2500)
+    assert file_content_hash(str(path), block_size=1000) == file_content_hash(str(path))
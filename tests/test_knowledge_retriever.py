@@ -0,0 +1,118 @@
+import os
+import sys
+from contextlib import contextmanager
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+from src.domain.knowledge import retriever
+from src.domain.knowledge.retriever import (
+    lexical_query, fuse_ranks, rerank, drop_near_duplicates, pack_context, estimate_tokens
+)
+from src.infrastructure.database import postgres
+
+
+def candidate(name, similarity, text_rank=None, content=None, embedding=None):
+    return {
+        "id": name, "content": content or name, "filename": "manual.pdf", "metadata": {},
+        "similarity": similarity, "text_rank": text_rank,
+        "embedding": np.asarray(embedding, dtype=np.float32) if embedding is not None else None,
+    }
+
+
+class FakeCrossEncoder:
+    def predict(self, pairs):
+        return [float(len(content)) for _, content in pairs]
+
+
+def test_lexical_query_keeps_only_words():
+    assert lexical_query('Re: "precio" - oferta 2024, ¿precio final?') == "precio oferta final"
+
+
+def test_fusion_rewards_candidates_found_by_both_retrievers():
+    candidates = [candidate("a", 0.9), candidate("b", 0.8, text_rank=0.9), candidate("c", 0.1, text_rank=0.5)]
+    ranked = sorted(fuse_ranks(candidates), key=lambda c: c["fusion"], reverse=True)
+    assert [c["id"] for c in ranked] == ["b", "c", "a"]
+
+
+def test_rerank_uses_cross_encoder_or_falls_back_to_fusion():
+    candidates = fuse_ranks([candidate("a", 0.9, content="corto"), candidate("b", 0.1, content="mucho más largo")])
+    assert [c["id"] for c in rerank("consulta", candidates, FakeCrossEncoder())] == ["b", "a"]
+    assert [c["id"] for c in rerank("consulta", candidates)] == ["a", "b"]
+
+
+def test_near_duplicates_are_dropped():
+    candidates = [
+        candidate("a", 0.9, embedding=[1, 0]),
+        candidate("a2", 0.9, embedding=[0.999, 0.045]),
+        candidate("b", 0.5, embedding=[0, 1]),
+    ]
+    assert [c["id"] for c in drop_near_duplicates(candidates, threshold=0.95)] == ["a", "b"]
+
+
+def test_context_is_packed_into_the_token_budget():
+    long_text = "Frase de relleno. " * 100
+    candidates = [candidate("largo", 0.9, content=long_text), candidate("corto", 0.8, content="x" * 35)]
+    packed = pack_context(candidates, budget=100, max_snippets=5)
+    # El mejor no cabe entero: se recorta por el final de frase; el siguiente cabe en lo que queda
+    assert packed[0]["content"].endswith("…") and packed[0]["tokens"] <= 100
+    assert sum(c["tokens"] for c in packed) <= 100 + 1
+
+    packed = pack_context([candidate("a", 0.9, content="x" * 350), candidate("b", 0.8, content="y" * 350),
+                           candidate("c", 0.7, content="z" * 35)], budget=110)
+    assert [c["id"] for c in packed] == ["a", "c"]
+    assert packed[0]["tokens"] == estimate_tokens("x" * 350)
+
+
+class RecordingCursor:
+    def __init__(self, statements):
+        self.statements = statements
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+
+    def fetchall(self):
+        return [{"id": 1, "content": "x", "filename": "manual.pdf", "metadata": {},
+                 "similarity": 0.5, "text_rank": None, "embedding": "[1, 0]"}]
+
+    def close(self):
+        pass
+
+
+def test_fetch_candidates_sets_vector_search_params_for_the_transaction(monkeypatch):
+    statements = []
+
+    class FakeConn:
+        def cursor(self, cursor_factory=None):
+            return RecordingCursor(statements)
+
+    @contextmanager
+    def fake_connection():
+        yield FakeConn()
+
+    monkeypatch.setattr(postgres, "db_connection", fake_connection)
+    rows = retriever.fetch_candidates("precio", [1.0, 0.0], limit=5, ef_search=80, probes=10)
+
+    assert statements[0] == ("SELECT set_config('hnsw.ef_search', %s, true)", ("80",))
+    assert statements[1] == ("SELECT set_config('ivfflat.probes', %s, true)", ("10",))
+    assert len(statements) == 3 and rows[0]["embedding"].tolist() == [1.0, 0.0]
+
+
+def test_retrieve_context_forwards_recall_knobs_and_caches_per_setting(monkeypatch):
+    calls = []
+
+    def fake_fetch(query, query_embedding, limit, ef_search=None, probes=None):
+        calls.append((ef_search, probes))
+        return [candidate("a", 0.9, embedding=[1.0, 0.0])]
+
+    monkeypatch.setattr(retriever, "fetch_candidates", fake_fetch)
+    monkeypatch.setattr(retriever, "reranker_model", None)
+    retriever.embedding_cache.put(retriever.content_hash("consulta recall"), [1.0, 0.0])
+
+    assert retriever.retrieve_context("consulta recall", ef_search=200, probes=20)[0]["id"] == "a"
+    retriever.retrieve_context("consulta recall", ef_search=200, probes=20)
+    # Otro ajuste de recall no reutiliza el resultado cacheado con el anterior
+    retriever.retrieve_context("consulta recall", ef_search=40)
+    assert calls == [(200, 20), (40, retriever.IVFFLAT_PROBES)]
@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import pytest
+
+# El servicio LLM es una aplicación independiente: importamos su módulo directamente
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'llm_service')))
+
+from scheduler import InferenceScheduler, QueueFullError, JobCancelledError, wait_for_job, stream_job
+
+
+class FakeRequest:
+    def __init__(self):
+        self.disconnected = False
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+
+def slow_generate(release):
+    def generate(job):
+        # Simula la generación token a token, atenta a la cancelación
+        tokens = 0
+        while not release.is_set() and not job.cancelled:
+            time.sleep(0.01)
+            tokens += 1
+        return f"respuesta a {job.prompt}", tokens
+    return generate
+
+
+def test_jobs_are_processed_and_metrics_reported():
+    async def scenario():
+        release = threading.Event()
+        release.set()
+        scheduler = InferenceScheduler(slow_generate(release), max_queue=4)
+        scheduler.start()
+        job = scheduler.submit("hola", {"max_tokens": 10})
+        result = await wait_for_job(job, FakeRequest(), timeout=5)
+        metrics = scheduler.metrics()
+        scheduler.stop()
+        return result, metrics
+
+    result, metrics = asyncio.run(scenario())
+    assert result == "respuesta a hola"
+    assert metrics["completed"] == 1 and metrics["queue_length"] == 0
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    async def scenario():
+        release = threading.Event()
+        scheduler = InferenceScheduler(slow_generate(release), max_queue=1)
+        scheduler.start()
+        running = scheduler.submit("a", {})
+        while scheduler.in_flight == 0:
+            await asyncio.sleep(0.01)
+        scheduler.submit("b", {})
+        with pytest.raises(QueueFullError) as exc:
+            scheduler.submit("c", {})
+        release.set()
+        await wait_for_job(running, FakeRequest(), timeout=5)
+        scheduler.stop()
+        return exc.value.retry_after, scheduler.metrics()
+
+    retry_after, metrics = asyncio.run(scenario())
+    assert retry_after >= 1
+    assert metrics["rejected"] == 1
+
+
+def test_client_disconnect_cancels_running_generation():
+    async def scenario():
+        release = threading.Event()
+        scheduler = InferenceScheduler(slow_generate(release), max_queue=2)
+        scheduler.start()
+        request = FakeRequest()
+        job = scheduler.submit("hola", {})
+        request.disconnected = True
+        with pytest.raises(JobCancelledError):
+            await wait_for_job(job, request, timeout=5, poll_interval=0.05)
+        # El worker corta la generación y queda libre para el siguiente trabajo
+        for _ in range(100):
+            if scheduler.in_flight == 0:
+                break
+            await asyncio.sleep(0.01)
+        scheduler.stop()
+        return scheduler.metrics()
+
+    metrics = asyncio.run(scenario())
+    assert metrics["cancelled"] == 1 and metrics["in_flight"] == 0
+
+
+def test_stream_job_yields_tokens_then_done():
+    def generate(job):
+        for word in ("hola", " ", "mundo"):
+            job.emit(word)
+        return "hola mundo", 3
+
+    async def scenario():
+        scheduler = InferenceScheduler(generate, max_queue=2)
+        scheduler.start()
+        tokens = asyncio.Queue()
+        job = scheduler.submit("p", {}, on_token=tokens.put_nowait)
+        events = [event async for event in stream_job(job, tokens, FakeRequest(), timeout=5)]
+        scheduler.stop()
+        return events
+
+    events = asyncio.run(scenario())
+    assert events == [("token", "hola"), ("token", " "), ("token", "mundo"), ("done", "hola mundo")]
@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+import threading
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.app_state import AppState
+from src.core.rate_limit import TokenBucket
+from src.services import workflow_service
+from src.services.workflow_service import MailboxScheduler, MailboxWorker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeNotifier:
+    def __init__(self, mode="pull"):
+        self.mode = mode
+        self.stats = {"mode": mode}
+        self._stop = threading.Event()
+
+    def wait(self, last_cycle_changed=False):
+        self._stop.wait(0.01)
+
+    def close(self):
+        self._stop.set()
+
+
+class FakeWorker:
+    def __init__(self, mailbox, mode):
+        self.mailbox = mailbox
+        self.notifier = FakeNotifier(mode)
+        self.alive = False
+        self.busy = False
+
+    def start(self):
+        self.alive = True
+
+    def stop(self):
+        # Un worker ocupado sigue vivo hasta que termina su ciclo
+        self.alive = self.alive and self.busy
+
+    def join(self, timeout=None):
+        pass
+
+    def is_alive(self):
+        return self.alive
+
+
+def test_token_bucket_allows_bursts_then_throttles():
+    clock = FakeClock()
+    bucket = TokenBucket(rate_per_minute=60, burst=2, clock=clock)
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == 1.0
+    clock.now = 0.5
+    assert bucket.try_acquire() == 0.5
+    clock.now = 1.0
+    assert bucket.try_acquire() == 0.0
+    assert bucket.stats()["granted"] == 3
+
+
+def test_acquire_gives_up_when_stopped():
+    bucket = TokenBucket(rate_per_minute=1, burst=1)
+    bucket.try_acquire()
+    stop = threading.Event()
+    stop.set()
+    assert bucket.acquire(stop) is False
+
+
+def test_scheduler_follows_the_registry(monkeypatch):
+    monkeypatch.setattr(workflow_service.session_manager, "forget", lambda address: None)
+    registry = [{"address": "a@x.com", "tenant": "acme", "updated_at": 1}]
+    scheduler = MailboxScheduler(AppState(), registry=lambda: list(registry), worker_factory=FakeWorker)
+    scheduler.ex_config = {"notification_mode": "streaming"}
+
+    assert scheduler.refresh() == 1
+    first = scheduler.workers["a@x.com"]
+    assert first.notifier.mode == "streaming"
+
+    # Un segundo buzón: ambos pasan a pull y el primero se reinicia con el modo nuevo
+    registry.append({"address": "b@x.com", "tenant": "acme", "updated_at": 1})
+    assert scheduler.refresh() == 2
+    assert not first.alive
+    assert {w.notifier.mode for w in scheduler.workers.values()} == {"pull"}
+
+    # Modificado (updated_at) se reinicia; eliminado del registro se para
+    second = scheduler.workers["b@x.com"]
+    registry[:] = [{"address": "b@x.com", "tenant": "acme", "updated_at": 2}]
+    scheduler.ex_config = {"notification_mode": "pull"}
+    assert scheduler.refresh() == 1
+    assert not second.alive and scheduler.workers["b@x.com"] is not second
+
+    # Un worker a mitad de ciclo no se sustituye hasta que su hilo termina
+    busy = scheduler.workers["b@x.com"]
+    busy.busy = True
+    registry[0] = {**registry[0], "updated_at": 3}
+    assert scheduler.refresh() == 0
+    assert "b@x.com" not in scheduler.workers
+    busy.alive = False
+    assert scheduler.refresh() == 1
+    assert scheduler.workers["b@x.com"] is not busy
+
+    # Mismo tenant, mismo limitador
+    assert scheduler.limiter_for("acme") is scheduler.limiter_for("acme")
+    assert scheduler.limiter_for("acme") is not scheduler.limiter_for("otro")
+
+
+def test_slow_mailbox_does_not_stall_the_others(monkeypatch):
+    release = threading.Event()
+
+    def fake_sync(mailbox):
+        if mailbox["address"] == "lento@x.com":
+            release.wait(5)
+        return {"full_sync": False, "upserted": 0, "read_flags": 0, "deleted": 0}
+
+    monkeypatch.setattr(workflow_service, "test_connection", lambda address: True)
+    monkeypatch.setattr(workflow_service, "sync_inbox", fake_sync)
+    monkeypatch.setattr(workflow_service, "backfill_bodies", lambda mailbox=None: 0)
+    monkeypatch.setattr(workflow_service, "record_mailbox_sync", lambda *args, **kwargs: None)
+
+    state = AppState()
+    limiter = TokenBucket(rate_per_minute=60000, burst=100)
+    slow = MailboxWorker({"id": 1, "address": "lento@x.com"}, state, limiter, FakeNotifier())
+    fast = MailboxWorker({"id": 2, "address": "rapido@x.com"}, state, limiter, FakeNotifier())
+    slow.start()
+    fast.start()
+    try:
+        deadline = time.monotonic() + 2
+        while fast.cycles < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert fast.cycles >= 3
+        assert slow.cycles == 0
+    finally:
+        release.set()
+        slow.stop()
+        fast.stop()
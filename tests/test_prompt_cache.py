@@ -0,0 +1,54 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'llm_service')))
+
+import pytest
+from prompt_cache import PromptStateCache
+
+
+class FakeState:
+    def __init__(self, size):
+        self.llama_state_size = size
+
+
+def test_lookup_returns_longest_common_prefix():
+    cache = PromptStateCache(capacity_bytes=1000)
+    cache[[1, 2, 3, 4]] = "contexto"
+    cache[[1, 9]] = "otro"
+
+    assert cache[[1, 2, 3, 7, 8]] == "contexto"
+    with pytest.raises(KeyError):
+        cache[[5, 6]]
+
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1
+    assert stats["avg_reused_tokens"] == 3
+
+
+def test_evicts_least_recently_used_when_over_capacity():
+    cache = PromptStateCache(capacity_bytes=250)
+    cache[[1]] = FakeState(100)
+    cache[[2]] = FakeState(100)
+    cache[[1, 5]]  # [1] pasa a ser el más reciente
+    cache[[3]] = FakeState(100)
+
+    assert [2] not in cache
+    assert [1] in cache and [3] in cache
+    assert cache.stats()["evictions"] == 1
+
+
+def test_empty_cache_is_truthy():
+    # Llama solo guarda estados si `if self.cache:` es verdadero
+    assert PromptStateCache()
+
+
+def test_shared_header_alone_is_not_a_hit():
+    # Tokens 1-3 son la cabecera de sistema común a todas las peticiones
+    cache = PromptStateCache(capacity_bytes=1000, min_prefix_tokens=4)
+    cache[[1, 2, 3, 10, 11]] = "correo A"
+
+    with pytest.raises(KeyError):
+        cache[[1, 2, 3, 20, 21]]
+    assert cache[[1, 2, 3, 10, 12]] == "correo A"
+    assert cache.stats()["avg_reused_tokens"] == 4
@@ -0,0 +1,140 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# Añadir el directorio raíz al path para poder importar desde src
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.services import sync_service
+
+
+def test_backfill_fetches_in_batches_and_bulk_upserts(monkeypatch):
+    ids = [f"id-{i}" for i in range(250)]
+    fetched, written = [], []
+    lock = threading.Lock()
+
+    def fake_fetch(batch, chunk_size, mailbox=None):
+        with lock:
+            fetched.append(list(batch))
+        return [{"id": i, "body": "cuerpo"} for i in batch]
+
+    def fake_upsert(rows, mailbox_id=None):
+        written.append(len(rows))
+        return len(rows)
+
+    monkeypatch.setattr(sync_service, "get_email_ids_missing_body", lambda limit, mailbox_id=None: ids[:limit])
+    monkeypatch.setattr(sync_service, "fetch_email_details", fake_fetch)
+    monkeypatch.setattr(sync_service, "upsert_emails", fake_upsert)
+    monkeypatch.setattr(sync_service, "mark_bodies_fetched", lambda ids: len(ids))
+
+    total = sync_service.backfill_bodies(limit=1000, batch_size=100, workers=3)
+
+    assert total == 250
+    assert sorted(len(b) for b in fetched) == [50, 100, 100]
+    assert sorted(written) == [50, 100, 100]
+
+
+def test_failed_batch_does_not_stop_the_others(monkeypatch):
+    def fake_fetch(batch, chunk_size, mailbox=None):
+        if batch[0] == "id-0":
+            raise ConnectionError("timeout EWS")
+        return [{"id": i} for i in batch]
+
+    monkeypatch.setattr(sync_service, "get_email_ids_missing_body", lambda limit, mailbox_id=None: [f"id-{i}" for i in range(4)])
+    monkeypatch.setattr(sync_service, "fetch_email_details", fake_fetch)
+    monkeypatch.setattr(sync_service, "upsert_emails", lambda rows, mailbox_id=None: len(rows))
+    marked = []
+    monkeypatch.setattr(sync_service, "mark_bodies_fetched", marked.extend)
+
+    assert sync_service.backfill_bodies(batch_size=2, workers=2) == 2
+    # El lote que falló no se marca: se reintenta en el siguiente ciclo
+    assert sorted(marked) == ["id-2", "id-3"]
+
+
+def test_bodies_missing_on_the_server_are_not_requested_again(monkeypatch):
+    marked = []
+    # id-1 ya no existe en el servidor y id-2 tiene el cuerpo vacío
+    monkeypatch.setattr(sync_service, "get_email_ids_missing_body", lambda limit, mailbox_id=None: ["id-0", "id-1", "id-2"])
+    monkeypatch.setattr(sync_service, "fetch_email_details", lambda batch, chunk_size, mailbox=None: [{"id": "id-0"}])
+    monkeypatch.setattr(sync_service, "upsert_emails", lambda rows, mailbox_id=None: len(rows))
+    monkeypatch.setattr(sync_service, "mark_bodies_fetched", marked.extend)
+
+    assert sync_service.backfill_bodies(batch_size=10, workers=1) == 1
+    assert marked == ["id-0", "id-1", "id-2"]
+
+
+def test_sync_inbox_keeps_state_and_reconciles_per_mailbox(monkeypatch):
+    mailbox = {"id": 3, "address": "soporte@x.com"}
+    saved, reconciled = {}, {}
+
+    def fake_changes(sync_state, mailbox=None):
+        assert mailbox == "soporte@x.com"
+        return {"upserts": [{"id": "a"}], "deletes": [], "read_flags": []}, "estado-nuevo"
+
+    monkeypatch.setattr(sync_service, "get_mailbox_sync_state", lambda mailbox_id: None)
+    monkeypatch.setattr(sync_service, "get_inbox_changes", fake_changes)
+    monkeypatch.setattr(sync_service, "upsert_emails", lambda rows, mailbox_id=None: saved.update(upserted=mailbox_id) or len(rows))
+    monkeypatch.setattr(sync_service, "delete_emails_db", lambda ids, soft=False: 0)
+    monkeypatch.setattr(sync_service, "reconcile_emails",
+                        lambda ids, soft=False, mailbox_id=None: reconciled.update(ids=ids, mailbox_id=mailbox_id) or 0)
+    monkeypatch.setattr(sync_service, "save_mailbox_sync_state", lambda mailbox_id, state: saved.update(state=(mailbox_id, state)))
+
+    summary = sync_service.sync_inbox(mailbox)
+
+    assert summary["full_sync"] and summary["upserted"] == 1
+    assert saved == {"upserted": 3, "state": (3, "estado-nuevo")}
+    assert reconciled == {"ids": ["a"], "mailbox_id": 3}
+
+
+def test_failed_upsert_does_not_advance_the_sync_state(monkeypatch):
+    mailbox = {"id": 3, "address": "soporte@x.com"}
+    saved, reconciled = [], []
+
+    monkeypatch.setattr(sync_service, "get_mailbox_sync_state", lambda mailbox_id: "estado-viejo")
+    monkeypatch.setattr(sync_service, "get_inbox_changes",
+                        lambda sync_state, mailbox=None: ({"upserts": [{"id": "a"}, {"id": "b"}], "deletes": ["c"],
+                                                          "read_flags": []}, "estado-nuevo"))
+    # Postgres caído un momento: upsert_emails registra el error y devuelve 0
+    monkeypatch.setattr(sync_service, "upsert_emails", lambda rows, mailbox_id=None: 0)
+    monkeypatch.setattr(sync_service, "delete_emails_db", lambda ids, soft=False: 1)
+    monkeypatch.setattr(sync_service, "reconcile_emails", lambda *args, **kwargs: reconciled.append(args) or 0)
+    monkeypatch.setattr(sync_service, "save_mailbox_sync_state", lambda mailbox_id, state: saved.append(state))
+
+    with pytest.raises(sync_service.SyncWriteError):
+        sync_service.sync_inbox(mailbox)
+    assert saved == [] and reconciled == []
+
+    # Un borrado que falla tampoco deja avanzar el estado
+    monkeypatch.setattr(sync_service, "upsert_emails", lambda rows, mailbox_id=None: len(rows))
+    monkeypatch.setattr(sync_service, "delete_emails_db", lambda ids, soft=False: None)
+    with pytest.raises(sync_service.SyncWriteError):
+        sync_service.sync_inbox(mailbox)
+    assert saved == []
+
+
+def test_full_resync_does_not_reuse_the_folder_state(monkeypatch):
+    from src.infrastructure.exchange import connector
+
+    class FakeFolder:
+        item_sync_state = "estado-caducado"
+
+        def sync_items(self, sync_state=None, **kwargs):
+            # Igual que exchangelib: sin sync_state se usa el de la carpeta
+            used = sync_state or self.item_sync_state
+            if used:
+                raise connector.ErrorInvalidSyncStateData("estado no válido")
+            yield "create", None
+            self.item_sync_state = "estado-nuevo"
+
+    class FakeAccount:
+        inbox = FakeFolder()
+
+    monkeypatch.setattr(connector, "get_account", lambda mailbox=None: FakeAccount())
+    monkeypatch.setattr(connector, "_email_header", lambda item: {"id": "a"})
+
+    changes, state = connector.get_inbox_changes(None)
+
+    assert changes["upserts"] == [{"id": "a"}]
+    assert state == "estado-nuevo"